@@ -5,13 +5,13 @@ color 0A
 echo ==================================================
 echo      BUOC 1: QUET FOLDER NEN ANH (PREPARE)
 echo ==================================================
-python prepare_zip.py
+python ktb.py prepare
 
 echo.
 echo ==================================================
 echo      BUOC 2: UPLOAD LEN VPS (MAIN PROCESS)
 echo ==================================================
-python ktb-user-upload.py
+python ktb.py upload
 
 echo.
 echo ==================================================
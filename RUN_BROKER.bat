@@ -0,0 +1,14 @@
+@echo off
+title KTB SSH BROKER
+color 0A
+
+REM --- Quan trong: Di chuyen den thu muc chua file .bat nay ---
+cd /d "%~dp0"
+
+echo ==================================================
+echo      KTB BROKER: GIU KET NOI SSH GIUA CAC LAN UPLOAD
+echo      (Nhan Ctrl+C de dung)
+echo ==================================================
+python ktb.py broker
+
+pause
\ No newline at end of file
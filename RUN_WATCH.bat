@@ -0,0 +1,14 @@
+@echo off
+title KTB WATCH MODE
+color 0A
+
+REM --- Quan trong: Di chuyen den thu muc chua file .bat nay ---
+cd /d "%~dp0"
+
+echo ==================================================
+echo      KTB WATCH: TU DONG NEN ^& UPLOAD ANH MOI
+echo      (Nhan Ctrl+C de dung)
+echo ==================================================
+python ktb.py watch
+
+pause
\ No newline at end of file
@@ -1,68 +1,22 @@
 import os
-import json
-import subprocess
-import re
 import sys
-import time
 import glob
-import io
-import shutil 
 from datetime import datetime
-from zoneinfo import ZoneInfo
-import paramiko
-import requests
 from dotenv import load_dotenv
-import shlex
 from collections import defaultdict
+from ktb_uploader import upload_all_hosts, make_job_package, get_ssh_key, build_upload_opts
+from ktb_router import load_routing
+from ktb_scheduler import check_upload_order
+from ktb_telegram import make_notifier
+from ktb_metrics import open_metrics
+from ktb_planner import admin_candidates, build_plan, print_plan
+from ktb_journal import open_journal, stage_new_files, clean_committed
 
 # --- Cấu hình chung ---
 KTB_IMAGE_PATH = "../ktbproject/ktbimage"
 CONFIG_FILE = 'config.json'
 PROCESSING_DIR = 'Processing' 
 
-# --- THAY ĐỔI: Hàm lấy SSH Key đơn giản hóa ---
-def get_ssh_key():
-    key_path = os.getenv("SSH_KEY_PATH")
-    
-    if not key_path:
-        raise ValueError("Thieu 'SSH_KEY_PATH' trong file .env")
-    
-    key_path = os.path.expanduser(key_path)
-    if os.name == 'nt': # Xử lý đường dẫn Windows
-        if key_path.startswith('/c/'): key_path = 'C:/' + key_path[3:]
-        elif key_path.startswith('/d/'): key_path = 'D:/' + key_path[3:]
-        # Thêm ổ đĩa khác nếu cần
-    
-    print(f"Su dung SSH Key tu duong dan: {key_path}")
-    if not os.path.exists(key_path):
-        raise FileNotFoundError(f"Khong tim thay file key tai: {key_path}")
-        
-    try: return paramiko.Ed25519Key.from_private_key_file(key_path)
-    except paramiko.ssh_exception.SSHException:
-        try: return paramiko.RSAKey.from_private_key_file(key_path)
-        except paramiko.ssh_exception.SSHException:
-            raise ValueError("Khong the tai key (Chi ho tro RSA/Ed25519)")
-# --- KẾT THÚC THAY ĐỔI ---
-
-# --- Hàm Gửi Telegram Admin (Đã sửa) ---
-def send_admin_telegram_message(message_content):
-    # THAY ĐỔI: Đọc token và chat_id từ .env
-    bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
-    admin_chat_id = os.getenv('TELEGRAM_CHAT_ID') # Admin dùng chung chat_id với user
-
-    if not bot_token or not admin_chat_id:
-        print("[LOI] Thieu TELEGRAM_BOT_TOKEN hoac TELEGRAM_CHAT_ID trong .env")
-        return
-        
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    payload = {'chat_id': admin_chat_id, 'text': message_content}
-    try:
-        response = requests.post(url, json=payload, timeout=10)
-        response.raise_for_status()
-        print(f"✅ Da gui bao cao xep hang den Admin Telegram. (Response: {response.json().get('ok', 'Failed')})")
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Loi khi gui request den Telegram: {e}")
-
 # --- Hàm Xử lý Chính ---
 def main():
     print("--- Bat dau quy trinh KTB Admin Upload Queue ---")
@@ -73,16 +27,24 @@ def main():
     load_dotenv()
     
     try:
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = json.load(f)
+        # config.json + .env đọc 1 lần, router tra site/host theo prefix dài nhất (xem ktb_router.py)
+        config, router = load_routing(CONFIG_FILE)
         remote_queue_dir = config.get('remote_queue_dir')
         default_author = config.get('default_user_author') 
         if not remote_queue_dir:
             raise ValueError("Thieu 'remote_queue_dir' trong config.json")
+        check_upload_order(config.get('upload_order'))
     except Exception as e:
         print(f"Loi doc config.json: {e}")
         sys.exit(1)
 
+    # --dry-run: chỉ in kế hoạch (xem ktb_planner.py), không di chuyển file, không kết nối VPS
+    if '--dry-run' in sys.argv[1:]:
+        candidates = admin_candidates(os.path.join(KTB_IMAGE_PATH, 'OutputImage'), PROCESSING_DIR, config.get('job_journal_db'))
+        hosts, problems = build_plan(candidates, router)
+        print_plan(hosts, problems, config, '--files' in sys.argv[1:])
+        return
+
     # --- THAY ĐỔI: Đọc .env mới ---
     admin_vps_user = os.getenv("VPS_USERNAME") 
     telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -94,92 +56,94 @@ def main():
         sys.exit(1)
     # --- KẾT THÚC THAY ĐỔI ---
 
+    # Telegram gửi nền (xem ktb_telegram.py), upload không chờ
+    notifier = make_notifier(config, "Admin Telegram")
+
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     report_content = f"--- Bao cao KTB Admin Upload Queue ---\nUser: {default_author}\nTimestamp: {timestamp}\n"
     total_files_queued = 0
 
-    # ... (Logic di chuyển file vào Processing giữ nguyên) ...
+    # --- Nhật ký job (xem ktb_journal.py): stage zip mới bằng rename + khôi phục job dở dang ---
     source_dir = os.path.join(KTB_IMAGE_PATH, 'OutputImage')
     processing_dir = PROCESSING_DIR
     os.makedirs(processing_dir, exist_ok=True)
-    
-    print(f"Dang di chuyen file tu '{source_dir}' vao '{processing_dir}'...")
-    moved_count = 0
-    initial_zip_files = [f for f in os.listdir(source_dir) if f.endswith('.zip')]
-    
-    for filename in initial_zip_files:
-        source_path = os.path.join(source_dir, filename)
-        dest_path = os.path.join(processing_dir, filename)
-        try:
-            shutil.move(source_path, dest_path)
-            moved_count += 1
-        except Exception as e:
-            print(f"⚠️  [LOI] Khong the di chuyen file {filename}: {e}")
-            report_content += f"\n[LOI] MOVE: {filename} ({e})"
-
-    if moved_count > 0:
-        print(f"✅ Da di chuyen {moved_count} file zip.")
+    journal = open_journal(config.get('job_journal_db'))
+
+    print(f"Dang dua file tu '{source_dir}' vao '{processing_dir}' (nhat ky: {journal.db_path})...")
+    staged_count, stage_errors = stage_new_files(journal, source_dir, processing_dir, router)
+    for filename, error in stage_errors:
+        print(f"⚠️  [LOI] Khong the dua file {filename} vao '{processing_dir}': {error}")
+        report_content += f"\n[LOI] STAGE: {filename} ({error})"
+    if staged_count > 0:
+        print(f"✅ Da nhan {staged_count} file zip moi.")
     else:
         print("Khong co file zip moi nao trong 'OutputImage'.")
-    
-    files_to_upload = [f for f in os.listdir(processing_dir) if f.endswith('.zip')]
-    if not files_to_upload:
+
+    # Job đã commit trên VPS ở lần chạy trước (bị dừng trước khi dọn file local) -> chỉ dọn, không gửi lại
+    jobs = []
+    for job in journal.active_jobs():
+        if job['state'] == 'committed':
+            if clean_committed(journal, job):
+                print(f"   🧹 {job['filename']}: Da xep hang o lan chay truoc -> Chi don file local.")
+                report_content += f"\n[OK] {job['filename']} (da xep hang o lan chay truoc)"
+                total_files_queued += 1
+        elif job['state'] != 'discovered':
+            jobs.append(job)
+
+    if not jobs:
         print(f"Khong co file .zip nao trong '{processing_dir}' de xu ly.")
-        send_admin_telegram_message(report_content + f"\n\nKhong co file .zip nao trong '{processing_dir}'.")
+        notifier.send(report_content + f"\n\nKhong co file .zip nao trong '{processing_dir}'.")
         cleanup_temp_files()
+        journal.close()
+        notifier.close()
         return
 
     # --- Sắp xếp file theo Host VPS ---
     files_by_host = defaultdict(list)
     print("Dang phan loai file theo Host VPS...")
     
-    for filename in files_to_upload:
-        local_zip_file = os.path.join(processing_dir, filename) 
+    for job in jobs:
+        filename = job['filename']
+        local_zip_file = job['staged_path']
+        if not os.path.exists(local_zip_file):
+            print(f"⚠️  [LOI] {filename}: Khong con file '{local_zip_file}'. Bo khoi nhat ky.")
+            report_content += f"\n[LOI] {filename} (Mat file local)"
+            journal.set_state(job['job_id'], 'cleaned', "mat file local")
+            continue
         
-        site_config = next((site for site in config.get('sites', []) if filename.startswith(site['prefix'])), None)
-        if not site_config:
+        route = router.match(filename)
+        if not route:
             print(f"⚠️  [LOI] {filename}: Khong tim thay site config. File se nam lai trong '{processing_dir}'.")
             report_content += f"\n[LOI] {filename} (Khong tim thay site config, chua xoa)"
             continue
         
-        vps_prefix = site_config['vps_secret_prefix'] 
-        vps_host = os.getenv(f"{vps_prefix}_VPS_HOST")
-        vps_port = int(os.getenv(f"{vps_prefix}_VPS_PORT"))
+        site_config = route['site']
+        vps_prefix = route['vps_prefix']
+        vps_host = route['host']
+        vps_port = route['port']
         
         if not vps_host or not vps_port:
              print(f"⚠️  [LOI] {filename}: Khong tim thay HOST/PORT. File se nam lai trong '{processing_dir}'.")
              report_content += f"\n[LOI] {filename} (Loi .env, chua xoa)"
              continue
         
-        wp_author = site_config.get('wp_author')
-        if not wp_author:
-             wp_author = default_author 
+        # wp_author của site, không có thì dùng default_user_author (xem ktb_router.make_route)
+        wp_author = route['wp_author']
         
         if not wp_author:
              print(f"⚠️  [LOI] {filename}: Thieu 'wp_author' (site) VA 'default_user_author' (goc). File se nam lai trong '{processing_dir}'.")
              report_content += f"\n[LOI] {filename} (Thieu author config, chua xoa)"
              continue
 
-        # --- THAY ĐỔI: Thêm thông tin Telegram vào meta.json ---
-        meta_content = {
-            "wp_author": wp_author,
-            "wp_path": site_config['wp_path'],
-            "zip_filename": filename, 
-            "prefix": site_config['prefix'],
-            "telegram_bot_token": telegram_bot_token,
-            "telegram_chat_id": telegram_chat_id
-        }
-        # --- KẾT THÚC THAY ĐỔI ---
-        
+        # meta.json (kèm thông tin Telegram) + tên job = job_id trong nhật ký: xem make_job_package
         host_key = (vps_host, vps_port, vps_prefix)
-        unique_job_dir_name = f"job_{int(time.time())}_{wp_author}_{filename[:20]}"
-        
-        file_package = {
-            "original_filename": filename, 
-            "local_zip_path": local_zip_file,
-            "meta_content": meta_content,
-            "unique_job_dir_name": unique_job_dir_name, 
-        }
+        file_package = make_job_package(filename, local_zip_file, site_config, wp_author,
+                                        telegram_bot_token, telegram_chat_id, job_id=job['job_id'])
+        file_package['journal_id'] = job['job_id']
+        if job['state'] in ('uploading', 'uploaded'):
+            # Bị dừng giữa chừng: kiểm tra job trên VPS trước (đã mv thì không gửi lại)
+            print(f"   ↪️  {filename}: Tiep tuc job dang do ({job['state']}).")
+            file_package['retry'] = True
         files_by_host[host_key].append(file_package)
 
     # --- Vòng lặp kết nối và Upload ---
@@ -189,100 +153,33 @@ def main():
         ssh_key = get_ssh_key() 
     except Exception as e:
         print(f"❌ LOI FATAL: Khong the tai SSH Key. Dung script. Loi: {e}")
-        send_admin_telegram_message(f"LỖI ADMIN UPLOAD: KHÔNG THỂ TẢI SSH KEY. \nLỗi: {e}")
+        notifier.send(f"LỖI ADMIN UPLOAD: KHÔNG THỂ TẢI SSH KEY. \nLỗi: {e}")
+        journal.close()
+        notifier.close()
         sys.exit(1)
     # --- KẾT THÚC THAY ĐỔI ---
 
-    for (host, port, vps_prefix_key), file_list in files_by_host.items():
-        print("\n" + "="*50)
-        print(f"🚀 Dang ket noi den Host: {host}:{port} (User: {admin_vps_user}) - Su dung SSH Key")
-        
-        ssh = None
-        sftp = None
-        try:
-            # --- THAY ĐỔI: Sử dụng PKey (SSH Key) ---
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(host, port=port, username=admin_vps_user, pkey=ssh_key, timeout=10)
-            # --- KẾT THÚC THAY ĐỔI ---
-            
-            sftp = ssh.open_sftp()
-            print(f"✅ Ket noi {host} thanh cong. Bat dau upload {len(file_list)} job...")
-
-            # ... (Logic upload và dọn dẹp file trong Processing giữ nguyên) ...
-            for package in file_list:
-                filename = package['original_filename']
-                local_zip_path = package['local_zip_path']
-                meta_content = package['meta_content']
-                job_dir_name = package['unique_job_dir_name']
-                
-                local_meta_path = os.path.join(processing_dir, f"{job_dir_name}_meta.json")
-                remote_job_dir_path_tmp = f"{remote_queue_dir}/tmp_{job_dir_name}"
-                remote_job_dir_path_final = f"{remote_queue_dir}/{job_dir_name}"
-
-                remote_zip_path = f"{remote_job_dir_path_tmp}/{filename}"
-                remote_meta_path = f"{remote_job_dir_path_tmp}/meta.json" 
-
-                upload_successful = False
-                try:
-                    print(f"   Tao job folder tam: tmp_{job_dir_name}...")
-                    sftp.mkdir(remote_job_dir_path_tmp) 
-                    
-                    with open(local_meta_path, 'w', encoding='utf-8') as f:
-                        json.dump(meta_content, f)
-
-                    print(f"   Uploading meta.json (tam)...")
-                    sftp.put(local_meta_path, remote_meta_path) 
-                    
-                    print(f"   Uploading {filename} (tam)...")
-                    sftp.put(local_zip_path, remote_zip_path)
-
-                    print(f"   Kich hoat job (doi ten thu muc)...")
-                    command = f"mv {shlex.quote(remote_job_dir_path_tmp)} {shlex.quote(remote_job_dir_path_final)}"
-                    stdin, stdout, stderr = ssh.exec_command(command)
-                    exit_status = stdout.channel.recv_exit_status()
-                    
-                    if exit_status != 0:
-                        raise Exception(f"Loi doi ten thu muc job: {stderr.read().decode()}")
-
-                    upload_successful = True 
-                    
-                    print(f"   ✅ {filename}: Da xep hang thanh cong.")
-                    report_content += f"\n[OK] {filename} -> {host} (Admin)"
-                    total_files_queued += 1
-                    
-                except Exception as e:
-                    print(f"   [LOI] {filename}: Upload that bai: {e}")
-                    report_content += f"\n[LOI] {filename} (Upload failed: {e})"
-                    try: 
-                        sftp.remove(remote_zip_path)
-                        sftp.remove(remote_meta_path)
-                        sftp.rmdir(remote_job_dir_path_tmp)
-                    except: pass
-                    
-                finally:
-                    if os.path.exists(local_meta_path):
-                        os.remove(local_meta_path) 
-                        
-                    if upload_successful:
-                        try:
-                            os.remove(local_zip_path)
-                            print(f"   🧹 Da xoa file local: {local_zip_path}")
-                        except Exception as e_del:
-                             print(f"   [LOI] Khong the xoa file local {local_zip_path}: {e_del}")
-                    else:
-                        print(f"   ⚠️  File zip '{filename}' van con trong '{processing_dir}' do upload loi.")
-
-        except paramiko.AuthenticationException:
-            print(f"❌ LOI: Xac thuc SSH Key voi {host} that bai! Kiem tra key.")
-            report_content += f"\n\n❌ LỖI KẾT NỐI {host}: XÁC THỰC SSH KEY THẤT BẠI."
-        except Exception as e:
-            print(f"❌ LOI SCRIPT voi {host}: {e}")
-            report_content += f"\n\n❌ LỖI SCRIPT {host}: {e}"
-        finally:
-            if sftp: sftp.close()
-            if ssh: ssh.close()
-            print(f"--- Da ngat ket noi khoi {host} ---")
+    # --- Upload song song theo host (xem ktb_uploader.py) ---
+    upload_opts = build_upload_opts(config, router)
+    upload_opts.update({
+        "username": admin_vps_user,
+        "pkey": ssh_key,
+        "auth_label": "SSH Key",
+        "local_tmp_dir": processing_dir,
+        "ok_label": "Admin",
+        "delete_local": True,
+        "progress": notifier.progress,
+        "metrics": open_metrics(config.get('metrics_file'), 'ktb-admin-upload'),
+        "journal": journal,
+    })
+    try:
+        hosts_report, hosts_queued = upload_all_hosts(files_by_host, upload_opts)
+    finally:
+        if upload_opts["image_index"] is not None:
+            upload_opts["image_index"].close()
+        journal.close()
+    report_content += hosts_report
+    total_files_queued += hosts_queued
 
     # ... (Gửi báo cáo và dọn dẹp giữ nguyên) ...
     print("\n" + "="*50)
@@ -290,14 +187,16 @@ def main():
     if total_files_queued > 0:
         report_content += f"\n\nTong cong: {total_files_queued} file da duoc xep hang boi Admin."
     else:
-        report_content += f"\n\nKhong co file nao duoc xep hang thanh cong."
+        report_content += "\n\nKhong co file nao duoc xep hang thanh cong."
 
     print("--- Noi dung bao cao Admin ---")
     print(report_content)
     print("----------------------------")
-    send_admin_telegram_message(report_content)
+    print(upload_opts["metrics"].summary(files_queued=total_files_queued))
+    notifier.send(report_content)
     
     cleanup_temp_files() 
+    notifier.close()
     
     print("\n--- Hoan tat quy trinh KTB-Upload Sync (Queue Mode - Admin) ---")
 
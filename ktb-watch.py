@@ -0,0 +1,283 @@
+import os
+import sys
+import time
+import getpass
+import threading
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+try:
+    import paramiko
+except ImportError:
+    print("[LOI] Chua cai thu vien 'paramiko'.")
+    print("Vui long chay lenh: pip install -r requirements.txt")
+    sys.exit(1)
+from ktb_uploader import (open_host_session, close_host_session, session_is_alive,
+                          upload_with_session, make_job_package, log, build_upload_opts)
+from ktb_zip import IMAGE_SOURCE_DIR, find_image_folders, reserve_zip_filename
+from prepare_zip import plan_zip_tasks, run_zip_tasks
+from ktb_router import load_routing
+from ktb_scheduler import print_schedule, check_upload_order
+from ktb_telegram import make_notifier
+from ktb_metrics import open_metrics
+from ktb_image_opt import optimize_image_folders
+
+# watchdog là tùy chọn: không có thì chỉ dùng polling
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+# --- Watch mode: chạy liên tục, nén + upload output mới ngay khi xuất hiện ---
+# Giữ sẵn phiên SSH "ấm" tới từng VPS (theo vps_secret_prefix) giữa các lượt.
+INPUT_DIR = 'InputZip'
+CONFIG_FILE = 'config.json'
+
+class WakeHandler(FileSystemEventHandler):
+    def __init__(self, wake):
+        self.wake = wake
+
+    def on_any_event(self, event):
+        self.wake.set()
+
+# File/folder được coi là "xong" khi không có gì thay đổi trong settle_seconds
+# (tránh nén folder khi generator vẫn đang ghi ảnh vào).
+def is_settled(path, settle_seconds):
+    try:
+        newest = os.path.getmtime(path)
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for name in filenames:
+                    newest = max(newest, os.path.getmtime(os.path.join(dirpath, name)))
+    except OSError:
+        return False
+    return time.time() - newest >= settle_seconds
+
+def main():
+    print("--- Bat dau KTB Watch Mode ---")
+    load_dotenv()
+
+    try:
+        config, router = load_routing(CONFIG_FILE)
+    except FileNotFoundError:
+        print(f"[LOI] Khong tim thay file cau hinh {CONFIG_FILE}.")
+        sys.exit(1)
+
+    wp_author = config.get('default_user_author')
+    remote_queue_dir = config.get('remote_queue_dir')
+    stream_zip = config.get('stream_zip_upload', False)
+    poll_seconds = float(config.get('watch_poll_seconds', 10))
+    settle_seconds = float(config.get('watch_settle_seconds', 5))
+    retry_seconds = float(config.get('watch_retry_seconds', 60))
+    try:
+        check_upload_order(config.get('upload_order'))
+    except ValueError as e:
+        print(f"[LOI] {e}")
+        sys.exit(1)
+
+    vps_user = os.getenv("VPS_USERNAME")
+    telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+    telegram_chat_id = os.getenv("TELEGRAM_CHAT_ID")
+
+    if not wp_author or not vps_user or not remote_queue_dir or not telegram_bot_token or not telegram_chat_id:
+        print("❌ Loi: Kiem tra thieu 'default_user_author', 'remote_queue_dir' trong config.json")
+        print("   hoac 'VPS_USERNAME', 'TELEGRAM_BOT_TOKEN', 'TELEGRAM_CHAT_ID' trong .env")
+        sys.exit(1)
+
+    try:
+        vps_password = getpass.getpass(f"Nhap Mat khau VPS cho user '{vps_user}' (se bi an): ")
+    except EOFError:
+        print("\nDa huy bo.")
+        sys.exit(1)
+    if not vps_password:
+        print("[LOI] Mat khau khong duoc de trong.")
+        sys.exit(1)
+
+    os.makedirs(INPUT_DIR, exist_ok=True)
+    # Telegram gửi nền (xem ktb_telegram.py), vòng watch không chờ
+    notifier = make_notifier(config)
+
+    # --- Host của từng vps_secret_prefix (router đã đọc .env 1 lần) ---
+    for route in router.routes.values():
+        if not route['host'] or not route['port']:
+            print(f"⚠️  [LOI] Khong tim thay HOST/PORT cho prefix '{route['vps_prefix']}'. Site '{route['prefix']}' se bi bo qua.")
+    hosts = router.hosts()
+
+    upload_opts = build_upload_opts(config, router)
+    upload_opts.update({
+        "username": vps_user,
+        "password": vps_password,
+        "auth_label": "Password",
+        "local_tmp_dir": INPUT_DIR,
+        "ok_label": "Watch",
+        # Watch mode bắt buộc xóa zip sau khi upload, nếu không sẽ upload lại ở lượt sau
+        "delete_local": True,
+        # Phiên "ấm" giữa các lượt cần keepalive (script chạy 1 lần thì không)
+        "keepalive_seconds": config.get('ssh_keepalive_seconds', 30),
+        "progress": notifier.progress,
+    })
+    channel_count = max(1, int(config.get('sftp_channels_per_host', 1)))
+
+    # --- Phiên SSH "ấm" theo vps_secret_prefix ---
+    sessions = {}
+    sessions_lock = threading.Lock()
+
+    def get_session(vps_prefix):
+        with sessions_lock:
+            session = sessions.get(vps_prefix)
+            if session and session_is_alive(session):
+                return session
+            if session:
+                close_host_session(session)
+            host, port = hosts[vps_prefix]
+            log(host, f"🚀 Dang ket noi den Host: {host}:{port} (User: {vps_user}) - Su dung Password")
+            session = open_host_session(host, port, upload_opts, channel_count)
+            sessions[vps_prefix] = session
+            log(host, f"✅ Ket noi {host} thanh cong ({channel_count} kenh SFTP, giu ket noi).")
+            return session
+
+    def drop_session(vps_prefix):
+        with sessions_lock:
+            session = sessions.pop(vps_prefix, None)
+        if session:
+            close_host_session(session)
+
+    for vps_prefix in hosts:
+        try:
+            get_session(vps_prefix)
+        except paramiko.AuthenticationException:
+            print(f"❌ LOI: Xac thuc {hosts[vps_prefix][0]} that bai! Kiem tra lai mat khau VPS.")
+            sys.exit(1)
+        except Exception as e:
+            print(f"⚠️  Chua ket noi duoc {hosts[vps_prefix][0]}: {e} (se thu lai khi co job)")
+
+    def upload_prefix(vps_prefix, file_list):
+        host = hosts[vps_prefix][0]
+        try:
+            session = get_session(vps_prefix)
+            return upload_with_session(host, session, file_list, upload_opts)
+        except Exception as e:
+            # Phiên hỏng -> bỏ, lượt sau sẽ kết nối lại
+            log(host, f"❌ LOI SCRIPT voi {host}: {e}")
+            drop_session(vps_prefix)
+            return f"\n\n❌ LỖI SCRIPT {host}: {e}", 0
+
+    # --- Theo dõi thay đổi (watchdog), fallback polling ---
+    wake = threading.Event()
+    observer = None
+    if Observer is not None:
+        observer = Observer()
+        handler = WakeHandler(wake)
+        if os.path.isdir(IMAGE_SOURCE_DIR):
+            observer.schedule(handler, IMAGE_SOURCE_DIR, recursive=True)
+        observer.schedule(handler, INPUT_DIR, recursive=False)
+        observer.start()
+        print(f"👀 Dang theo doi thay doi (watchdog), polling du phong moi {poll_seconds:.0f}s.")
+    else:
+        print(f"👀 Khong co 'watchdog' -> polling moi {poll_seconds:.0f}s.")
+
+    retry_after = {}
+    try:
+        while True:
+            pending = False
+            now = time.time()
+
+            # 1. Folder ảnh mới trong OutputImage
+            folders = []
+            if os.path.isdir(IMAGE_SOURCE_DIR):
+                for folder in find_image_folders(IMAGE_SOURCE_DIR, router, verbose=False):
+                    if retry_after.get(folder[1], 0) > now:
+                        continue
+                    if not is_settled(folder[1], settle_seconds):
+                        pending = True
+                        continue
+                    folders.append(folder)
+
+            # Metrics theo từng lượt (mỗi lượt 1 run_id + summary riêng)
+            upload_opts["metrics"] = open_metrics(config.get('metrics_file'), 'ktb-watch')
+            optimize_image_folders(folders, config, upload_opts["metrics"])
+
+            candidates = []   # (filename, local_zip_path, source_folder)
+            if folders and stream_zip:
+                used_names = set()
+                for folder_name, folder_path, matched_site in folders:
+                    zip_filename = reserve_zip_filename(f"{matched_site['prefix']}.{wp_author}", used_names)
+                    candidates.append((zip_filename, None, folder_path))
+            elif folders:
+                run_zip_tasks(plan_zip_tasks(folders, config, wp_author), config, upload_opts["metrics"])
+
+            # 2. Zip sẵn sàng trong InputZip
+            for filename in os.listdir(INPUT_DIR):
+                local_zip_path = os.path.join(INPUT_DIR, filename)
+                if not filename.endswith('.zip') or retry_after.get(local_zip_path, 0) > now:
+                    continue
+                if not is_settled(local_zip_path, settle_seconds):
+                    pending = True
+                    continue
+                candidates.append((filename, local_zip_path, None))
+
+            # 3. Phân loại theo VPS và upload qua phiên ấm
+            files_by_prefix = defaultdict(list)
+            report_content = ""
+            for filename, local_zip_path, source_folder in candidates:
+                route = router.match(filename)
+                if not route or route['vps_prefix'] not in hosts:
+                    print(f"⚠️  [LOI] {filename}: Khong tim thay site config / host. Bo qua.")
+                    retry_after[local_zip_path or source_folder] = now + retry_seconds
+                    continue
+                files_by_prefix[route['vps_prefix']].append(
+                    make_job_package(filename, local_zip_path, route['site'], wp_author,
+                                     telegram_bot_token, telegram_chat_id, source_folder))
+
+            if files_by_prefix:
+                total_files_queued = 0
+                print_schedule({hosts[vps_prefix]: file_list for vps_prefix, file_list in files_by_prefix.items()}, upload_opts)
+                max_workers = max(1, min(int(config.get('max_parallel_hosts', 1)), len(files_by_prefix)))
+                with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                    futures = [pool.submit(upload_prefix, vps_prefix, file_list)
+                               for vps_prefix, file_list in files_by_prefix.items()]
+                    for future in futures:
+                        host_report, host_count = future.result()
+                        report_content += host_report
+                        total_files_queued += host_count
+
+                # Job lỗi vẫn còn file/folder local -> chờ retry_seconds rồi thử lại
+                for file_list in files_by_prefix.values():
+                    for package in file_list:
+                        path = package['local_zip_path'] or package.get('source_folder')
+                        if os.path.exists(path):
+                            retry_after[path] = time.time() + retry_seconds
+
+                timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                report_content = (f"--- Bao cao KTB Watch ---\nUser: {wp_author}\nTimestamp: {timestamp}\n"
+                                  + report_content
+                                  + f"\n\nTong cong: {total_files_queued} file da duoc xep hang.")
+                print(report_content)
+                print(upload_opts["metrics"].summary(files_queued=total_files_queued))
+                notifier.send(report_content)
+
+            # Dọn các mục retry đã hết hạn
+            retry_after = {path: until for path, until in retry_after.items() if until > time.time()}
+
+            # Chờ sự kiện file hệ thống hoặc hết chu kỳ polling.
+            # Còn mục chưa "settle" -> kiểm tra lại sau settle_seconds.
+            wake.wait(timeout=min(poll_seconds, settle_seconds) if pending else poll_seconds)
+            wake.clear()
+
+    except KeyboardInterrupt:
+        print("\n--- Dung KTB Watch Mode ---")
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        for vps_prefix in list(sessions):
+            drop_session(vps_prefix)
+        if upload_opts["image_index"] is not None:
+            upload_opts["image_index"].close()
+        notifier.close()
+
+if __name__ == "__main__":
+    main()
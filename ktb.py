@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+
+STARTED = time.perf_counter()
+
+# --- Điểm vào chung cho mọi lệnh ---
+#   python ktb.py <lenh> [tham so...]
+# Chỉ nạp module của đúng lệnh được gọi: lệnh chạy local (list, plan, prepare, prepare-manual)
+# không import paramiko / requests. Các script cũ (prepare_zip.py, ktb-user-upload.py...)
+# vẫn chạy trực tiếp được; lệnh ở đây chạy đúng script đó với tham số còn lại.
+# --timing: in thời gian từ lúc khởi động và các thư viện nặng đã bị nạp.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# lenh -> (script, mô tả)
+COMMANDS = {
+    "prepare": ("prepare_zip.py", "Nen cac folder anh trong OutputImage thanh zip (InputZip)"),
+    "prepare-manual": ("prepare_zip_manual.py", "Nen phan moi cua cac folder thu cong <prefix>.<suffix>"),
+    "upload": ("ktb-user-upload.py", "Upload zip trong InputZip len VPS (user, mat khau)"),
+    "admin-upload": ("ktb-admin-upload.py", "Upload zip cua admin len VPS (SSH key)"),
+    "watch": ("ktb-watch.py", "Chay lien tuc: nen + upload ngay khi co anh moi"),
+    "broker": ("ktb_broker.py", "Giu ket noi SSH giua cac lan upload"),
+    "bench": ("ktb_bench.py", "Benchmark upload voi SFTP server local"),
+    "tune-ssh": ("ktb_ssh_tune.py", "Do va luu thong so SSH (cipher, window, nen) nhanh nhat cho tung VPS"),
+}
+HEAVY_MODULES = ('paramiko', 'requests', 'PIL')
+
+def print_usage():
+    print("Cach dung: python ktb.py [--timing] <lenh> [tham so...]\n")
+    print(f"   {'list':<16} Liet ke nhung gi se duoc upload (khong ket noi mang)")
+    print(f"   {'plan':<16} Uoc tinh dung luong + thoi gian theo host tu toc do cac luot truoc"
+          " [--admin] [--files]")
+    for name, (script, description) in COMMANDS.items():
+        print(f"   {name:<16} {description}")
+
+# Lệnh local: zip trong InputZip + folder ảnh chưa nén, gom theo VPS và sắp theo upload_order
+def list_pending():
+    from ktb_router import load_routing
+    from ktb_planner import user_candidates, build_plan
+    from ktb_scheduler import make_bandwidth_limiter, print_schedule
+
+    config, router = load_routing()
+    hosts, problems = build_plan(user_candidates(config, router), router)
+    for filename, reason in problems:
+        print(f"   ⚠️ {filename}: {reason}")
+    if not hosts:
+        print("Khong co gi de upload.")
+        return
+    print_schedule(hosts, {"upload_order": config.get('upload_order'),
+                           "bandwidth": make_bandwidth_limiter(config),
+                           "max_parallel_hosts": config.get('max_parallel_hosts', 1)})
+
+# Dry-run: tổng dung lượng + thời gian ước tính theo host (xem ktb_planner.py)
+def plan(args):
+    from ktb_router import load_routing
+    from ktb_planner import user_candidates, admin_candidates, build_plan, print_plan
+
+    config, router = load_routing()
+    if '--admin' in args:
+        # Như ktb-admin-upload.py: nhật ký job + zip trong OutputImage / Processing
+        candidates = admin_candidates(os.path.join('..', 'ktbproject', 'ktbimage', 'OutputImage'), 'Processing',
+                                      config.get('job_journal_db'))
+    else:
+        candidates = user_candidates(config, router)
+    hosts, problems = build_plan(candidates, router)
+    print_plan(hosts, problems, config, '--files' in args)
+
+def run_script(script, args):
+    import runpy
+    sys.argv = [script] + args
+    runpy.run_path(os.path.join(SCRIPT_DIR, script), run_name="__main__")
+
+def main(argv):
+    timing = '--timing' in argv[:1]
+    if timing:
+        argv = argv[1:]
+    if not argv or argv[0] in ('-h', '--help', 'help'):
+        print_usage()
+        return 0
+    command, args = argv[0], argv[1:]
+    if command not in ('list', 'plan') and command not in COMMANDS:
+        print(f"[LOI] Khong co lenh '{command}'.\n")
+        print_usage()
+        return 2
+
+    # Như các file .bat: chạy từ thư mục chứa script (config.json, InputZip... là đường dẫn tương đối)
+    os.chdir(SCRIPT_DIR)
+    sys.path.insert(0, SCRIPT_DIR)
+    try:
+        if command == 'list':
+            list_pending()
+        elif command == 'plan':
+            plan(args)
+        else:
+            run_script(COMMANDS[command][0], args)
+    finally:
+        if timing:
+            loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+            print(f"\n⏱️  {command}: {(time.perf_counter() - STARTED) * 1000:.0f} ms, "
+                  f"thu vien nang da nap: {', '.join(loaded) or 'khong'}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,440 @@
+import os
+import sys
+import io
+import json
+import time
+import queue
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from contextlib import redirect_stdout
+from collections import defaultdict
+import paramiko
+from paramiko import (ServerInterface, SFTPServerInterface, SFTPServer, SFTPAttributes, SFTPHandle,
+                      SFTP_OK, AUTH_SUCCESSFUL, OPEN_SUCCEEDED)
+
+# --- Benchmark upload trên máy local, không đụng VPS thật ---
+# Dựng 1 SSH/SFTP server paramiko local (thay cho VPS), sinh folder OutputImage giả,
+# rồi chạy đúng luồng thật: prepare_zip (plan_zip_tasks/run_zip_tasks) ->
+# ktb_router -> luồng của ktb-admin-upload.py: SSH key (key tạm, server local chấp nhận mọi key),
+# nhật ký job tạm (stage_new_files -> upload_all_hosts -> clean_committed).
+# --stream bỏ qua nhật ký (zip được nén thẳng lên SFTP, không có file để stage).
+# Mỗi "VPS" là 1 proxy TCP có thể thêm độ trễ (--latency-ms, RTT) để so sánh
+# số kênh SFTP / batch commit / số host song song trong cùng điều kiện.
+#
+#   python ktb_bench.py --folders 20 --images 30 --image-kb 400 --latency-ms 80 --channels 3
+#
+# Lệnh remote (mv, sha256sum) chạy bằng bash/sh local (trên Windows cần Git Bash trong PATH).
+
+BENCH_AUTHOR = 'bench'
+
+# --- Server SFTP local ---
+
+class BenchHandle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+class BenchSFTP(SFTPServerInterface):
+    def _error(self, e):
+        return SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        try:
+            result = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                result.append(attr)
+            return result
+        except OSError as e:
+            return self._error(e)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return self._error(e)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return self._error(e)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'r+b'
+        else:
+            mode = 'rb'
+        handle = BenchHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return self._error(e)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as e:
+            return self._error(e)
+        return SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            return self._error(e)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            return self._error(e)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        return SFTP_OK
+
+class BenchServer(ServerInterface):
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        def run():
+            shell = shutil.which('bash') or shutil.which('sh')
+            result = subprocess.run([shell, '-c', command.decode() if isinstance(command, bytes) else command],
+                                    capture_output=True)
+            channel.sendall(result.stdout)
+            channel.sendall_stderr(result.stderr)
+            channel.send_exit_status(result.returncode)
+            channel.close()
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+def start_sftp_server():
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(64)
+
+    def serve():
+        while True:
+            sock, _ = listener.accept()
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, BenchSFTP)
+            transport.start_server(server=BenchServer())
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+# --- Proxy TCP thêm độ trễ: mỗi chiều trễ latency/2, không giới hạn băng thông ---
+# drop_after_bytes: cắt kết nối sau khi client gửi quá số byte này (giả lập đường truyền chập chờn)
+
+def start_latency_proxy(target_port, latency_seconds, drop_after_bytes=0):
+    delay = latency_seconds / 2
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(64)
+
+    def pump(src, dst, drop_after):
+        pending = queue.Queue()
+
+        def reader():
+            received = 0
+            while True:
+                try:
+                    data = src.recv(64 * 1024)
+                except OSError:
+                    data = b''
+                received += len(data)
+                if drop_after and received > drop_after:
+                    for sock in (src, dst):
+                        try:
+                            sock.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
+                    data = b''
+                pending.put((time.monotonic() + delay, data))
+                if not data:
+                    return
+
+        threading.Thread(target=reader, daemon=True).start()
+        while True:
+            due, data = pending.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if not data:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+            except OSError:
+                return
+
+    def serve():
+        while True:
+            client, _ = listener.accept()
+            upstream = socket.create_connection(('127.0.0.1', target_port))
+            for src, dst, drop_after in ((client, upstream, drop_after_bytes), (upstream, client, 0)):
+                src.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(target=pump, args=(src, dst, drop_after), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+# --- Dữ liệu giả ---
+
+def make_sites(host_count, workspace):
+    return [{
+        "slug": f"bench{h:02d}",
+        "prefix": f"bench{h:02d}",
+        "wp_path": f"{workspace}/wp{h:02d}",
+        "wp_author": BENCH_AUTHOR,
+        "vps_secret_prefix": f"BENCH{h:02d}",
+    } for h in range(host_count)]
+
+# Ảnh giả = byte ngẫu nhiên (không nén được, giống jpg thật)
+def generate_output_images(source_dir, sites, folders, images, image_kb):
+    total = 0
+    for site in sites:
+        for index in range(folders):
+            folder = os.path.join(source_dir, f"{site['prefix']}_{index:04d}")
+            os.makedirs(folder)
+            for image in range(images):
+                with open(os.path.join(folder, f"img_{image:04d}.jpg"), 'wb') as f:
+                    f.write(os.urandom(image_kb * 1024))
+                total += image_kb * 1024
+    return total
+
+# --- Báo cáo ---
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def phase_latency(metrics_path, run_id):
+    samples = defaultdict(list)
+    with open(metrics_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("run_id") == run_id and record["event"] == "phase":
+                samples[record["phase"]].append(record["seconds"])
+    return {phase: {"count": len(values),
+                    "avg_ms": round(sum(values) / len(values) * 1000, 1),
+                    "p50_ms": round(percentile(values, 0.5) * 1000, 1),
+                    "p95_ms": round(percentile(values, 0.95) * 1000, 1)}
+            for phase, values in samples.items()}
+
+def run_benchmark(args):
+    # Import muộn: prepare_zip dùng đường dẫn tương đối (InputZip) theo thư mục hiện tại
+    import prepare_zip
+    from ktb_zip import find_image_folders, reserve_zip_filename
+    from ktb_router import SiteRouter
+    from ktb_uploader import upload_all_hosts, make_job_package, build_upload_opts
+    from ktb_metrics import open_metrics, mbps
+    from ktb_journal import open_journal, stage_new_files, clean_committed
+
+    base_config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r', encoding='utf-8') as f:
+            base_config = json.load(f)
+
+    workspace = tempfile.mkdtemp(prefix='ktb_bench_')
+    original_cwd = os.getcwd()
+    try:
+        os.chdir(workspace)
+        source_dir = os.path.join(workspace, 'OutputImage')
+        remote_dir = os.path.join(workspace, 'remote')
+        os.makedirs(source_dir)
+        os.makedirs(remote_dir)
+        os.makedirs(prepare_zip.INPUT_ZIP_DIR)
+        processing_dir = os.path.join(workspace, 'Processing')
+        os.makedirs(processing_dir)
+
+        # 1 server SFTP, mỗi host giả = 1 proxy (host, port) riêng
+        server_port = start_sftp_server()
+        sites = make_sites(args.hosts, workspace)
+        for site in sites:
+            os.makedirs(site['wp_path'])
+            os.environ[f"{site['vps_secret_prefix']}_VPS_HOST"] = '127.0.0.1'
+            os.environ[f"{site['vps_secret_prefix']}_VPS_PORT"] = str(start_latency_proxy(
+                server_port, args.latency_ms / 1000, int(args.drop_every_mb * 1024 * 1024)))
+
+        config = dict(base_config)
+        config.update({
+            "sites": sites,
+            "zip_workers": args.zip_workers if args.zip_workers is not None else base_config.get('zip_workers', 1),
+            "image_index_db": "",
+            "job_journal_db": os.path.join(workspace, 'job_journal.sqlite3'),
+            "metrics_file": os.path.join(workspace, 'metrics.jsonl'),
+        })
+        router = SiteRouter(sites, BENCH_AUTHOR)
+        metrics = open_metrics(config['metrics_file'], 'ktb_bench')
+        raw_bytes = generate_output_images(source_dir, sites, args.folders, args.images, args.image_kb)
+        image_count = len(sites) * args.folders * args.images
+
+        output = sys.stdout if args.verbose else io.StringIO()
+        with redirect_stdout(output):
+            # Prepare (nén local) hoặc streaming
+            folders = find_image_folders(source_dir, router, verbose=False)
+            prepare_started = time.perf_counter()
+            packages = []
+            journal = None
+            if args.stream:
+                used_names = set()
+                for folder_name, folder_path, site in folders:
+                    packages.append((reserve_zip_filename(f"{site['prefix']}.{BENCH_AUTHOR}", used_names), None, folder_path, None))
+            else:
+                prepare_zip.run_zip_tasks(prepare_zip.plan_zip_tasks(folders, config, BENCH_AUTHOR), config, metrics)
+                # Stage vào Processing qua nhật ký như ktb-admin-upload.py
+                journal = open_journal(config['job_journal_db'])
+                stage_new_files(journal, prepare_zip.INPUT_ZIP_DIR, processing_dir, router)
+                for job in journal.active_jobs():
+                    packages.append((job['filename'], job['staged_path'], None, job['job_id']))
+            prepare_seconds = time.perf_counter() - prepare_started
+
+            # Upload: gom theo host như ktb-admin-upload.py
+            files_by_host = defaultdict(list)
+            for filename, local_zip_path, source_folder, job_id in packages:
+                route = router.match(filename)
+                package = make_job_package(filename, local_zip_path, route['site'], route['wp_author'],
+                                           None, None, source_folder, job_id=job_id)
+                package['journal_id'] = job_id
+                files_by_host[(route['host'], route['port'], route['vps_prefix'])].append(package)
+            upload_opts = build_upload_opts(config, router)
+            upload_opts.update({
+                "username": "bench",
+                "pkey": paramiko.RSAKey.generate(2048),
+                "auth_label": "SSH Key",
+                "remote_queue_dir": remote_dir,
+                "local_tmp_dir": processing_dir,
+                "ok_label": "Bench",
+                "delete_local": True,
+                "max_parallel_hosts": args.parallel_hosts or config.get('max_parallel_hosts', 1),
+                "sftp_channels_per_host": args.channels or config.get('sftp_channels_per_host', 1),
+                "resumable_uploads": args.resumable,
+                "batch_commit": args.batch_commit,
+                "upload_retries": args.retries if args.retries is not None else config.get('upload_retries', 0),
+                "split_threshold_mb": args.split_mb if args.split_mb is not None else config.get('split_threshold_mb', 0),
+                "split_part_mb": args.part_mb or config.get('split_part_mb', 64),
+                "split_channels": args.channels or config.get('split_channels', 1),
+                # Broker thật (nếu đang chạy) không biết server SFTP giả lập
+                "ssh_broker_port": None,
+                "metrics": metrics,
+                "journal": journal,
+            })
+            upload_started = time.perf_counter()
+            _, queued = upload_all_hosts(files_by_host, upload_opts)
+            # Job committed mà chưa dọn file local: dọn như đầu lần chạy admin tiếp theo
+            journal_left = 0
+            if journal is not None:
+                for job in journal.active_jobs():
+                    if job['state'] != 'committed' or not clean_committed(journal, job):
+                        journal_left += 1
+                journal.close()
+            upload_seconds = time.perf_counter() - upload_started
+            metrics.summary(files_queued=queued)
+
+        uploaded_bytes = sum(os.path.getsize(os.path.join(dirpath, name))
+                             for dirpath, _, names in os.walk(remote_dir) for name in names if name.endswith('.zip'))
+        total_seconds = prepare_seconds + upload_seconds
+        return {
+            "settings": {key: value for key, value in vars(args).items() if key not in ('config', 'output', 'verbose')},
+            "jobs": len(packages),
+            "jobs_queued": queued,
+            "journal_left": journal_left,
+            "images": image_count,
+            "raw_mb": round(raw_bytes / (1024 * 1024), 1),
+            "uploaded_mb": round(uploaded_bytes / (1024 * 1024), 1),
+            "prepare_seconds": round(prepare_seconds, 3),
+            "upload_seconds": round(upload_seconds, 3),
+            "images_per_second": round(image_count / total_seconds, 1) if total_seconds else None,
+            "jobs_per_second": round(len(packages) / upload_seconds, 2) if upload_seconds else None,
+            "upload_mb_per_second": round(uploaded_bytes / (1024 * 1024) / upload_seconds, 2) if upload_seconds else None,
+            "upload_mbps": mbps(uploaded_bytes, upload_seconds),
+            "phases": phase_latency(config['metrics_file'], metrics.run_id),
+        }
+    finally:
+        os.chdir(original_cwd)
+        if args.keep:
+            print(f"📁 Giu lai thu muc benchmark: {workspace}")
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+def print_result(result):
+    print(f"\n📊 {result['jobs_queued']}/{result['jobs']} job, {result['images']} anh, "
+          f"{result['raw_mb']} MB anh -> {result['uploaded_mb']} MB zip, "
+          f"{result['journal_left']} job con trong nhat ky")
+    print(f"   Prepare: {result['prepare_seconds']:.2f}s | Upload: {result['upload_seconds']:.2f}s")
+    print(f"   {result['images_per_second']} anh/s, {result['jobs_per_second']} job/s, "
+          f"{result['upload_mb_per_second']} MB/s ({result['upload_mbps']} Mbps)")
+    print(f"   {'phase':<10}{'lan':>6}{'avg ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for phase, stats in result['phases'].items():
+        print(f"   {phase:<10}{stats['count']:>6}{stats['avg_ms']:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark luong prepare + upload voi SFTP server local")
+    parser.add_argument('--folders', type=int, default=10, help="So folder anh moi host")
+    parser.add_argument('--images', type=int, default=20, help="So anh moi folder")
+    parser.add_argument('--image-kb', type=int, default=300, help="Kich thuoc moi anh (KB)")
+    parser.add_argument('--hosts', type=int, default=1, help="So VPS gia lap")
+    parser.add_argument('--latency-ms', type=float, default=0, help="Do tre RTT them vao moi ket noi")
+    parser.add_argument('--drop-every-mb', type=float, default=0,
+                        help="Cat moi ket noi SSH sau N MB (kiem tra reconnect/retry)")
+    parser.add_argument('--retries', type=int, help="upload_retries (mac dinh: config.json)")
+    parser.add_argument('--split-mb', type=float, help="split_threshold_mb: zip >= N MB chia phan (0 = tat)")
+    parser.add_argument('--part-mb', type=float, help="split_part_mb: kich thuoc moi phan")
+    parser.add_argument('--channels', type=int, help="sftp_channels_per_host (mac dinh: config.json)")
+    parser.add_argument('--parallel-hosts', type=int, help="max_parallel_hosts (mac dinh: config.json)")
+    parser.add_argument('--zip-workers', type=int, help="zip_workers (mac dinh: config.json)")
+    parser.add_argument('--batch-commit', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--resumable', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--stream', action='store_true', help="Nen thang len SFTP (stream_zip_upload)")
+    parser.add_argument('--repeat', type=int, default=1, help="Chay lai N lan voi cung tham so")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--output', help="Ghi ket qua (JSONL) vao file nay, vd: bench_output.txt")
+    parser.add_argument('--keep', action='store_true', help="Khong xoa thu muc tam sau khi chay")
+    parser.add_argument('--verbose', action='store_true', help="Hien log cua uploader")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("--- KTB Benchmark (SFTP server local) ---")
+    for attempt in range(1, args.repeat + 1):
+        result = run_benchmark(args)
+        result["attempt"] = attempt
+        print_result(result)
+        if args.output:
+            with open(args.output, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import select
+import secrets
+import socket
+import threading
+from dotenv import load_dotenv
+from ktb_ssh_tune import load_profile, connect_options
+
+# --- SSH connection broker ---
+# Process chạy nền trên máy local, giữ sẵn các SSH transport đã xác thực theo
+# (host, port, user), có keepalive và tự đóng transport rảnh quá lâu.
+# Uploader (xem ktb_uploader.connect_host) gắn vào broker thay vì bắt tay SSH
+# lại từ đầu; broker không chạy thì uploader tự kết nối trực tiếp như cũ.
+# Mặc định tắt ("ssh_broker_port": null). Bật: đặt "ssh_broker_port": 52022 trong config.json,
+# chạy `python ktb_broker.py` ở một terminal riêng rồi chạy uploader như bình thường.
+#
+# Giao thức (TCP localhost): client gửi 1 dòng JSON, broker trả 1 dòng JSON.
+#   op=connect: đảm bảo có transport (xác thực nếu cần), trả session cho các request sau
+#   op=exec:    chạy lệnh, trả exit_status/stdout/stderr (base64)
+#   op=sftp:    mở kênh subsystem sftp, sau dòng trả lời socket thành luồng SFTP thô
+#   op=status:  transport của session còn sống không (BrokeredSSH.is_active)
+# Mọi request phải kèm token đọc từ BROKER_TOKEN_FILE (file 0600, chỉ user hiện tại đọc được).
+# Mật khẩu VPS chỉ gửi ở op=connect; exec/sftp chỉ gửi session. Transport của session đã chết
+# hoặc đã bị đóng -> broker trả reconnect, client connect lại (kèm mật khẩu) rồi gửi lại request.
+
+CONFIG_FILE = 'config.json'
+# Token nằm cạnh script (uploader chạy từ thư mục nào cũng đọc được)
+BROKER_TOKEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.ssh_broker_token')
+DEFAULT_BROKER_PORT = 52022
+RELAY_CHUNK_SIZE = 64 * 1024
+
+def recv_line(sock):
+    data = bytearray()
+    while True:
+        byte = sock.recv(1)
+        if not byte:
+            raise EOFError("Broker dong ket noi")
+        if byte == b'\n':
+            return bytes(data)
+        data += byte
+
+def send_json(sock, payload):
+    sock.sendall(json.dumps(payload).encode('utf-8') + b'\n')
+
+# --- Phía client (dùng trong uploader) ---
+
+# Bọc socket tới broker thành "channel" mà paramiko.SFTPClient dùng được
+class BrokerChannel:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def recv(self, n):
+        return self.sock.recv(n)
+
+    def recv_ready(self):
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+
+    def get_name(self):
+        return "broker"
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.sock.gettimeout()
+
+    def setblocking(self, blocking):
+        self.sock.setblocking(blocking)
+
+    def close(self):
+        self.sock.close()
+
+class BrokerCommandOutput:
+    def __init__(self, data, exit_status):
+        self.data = data
+        self.channel = self
+        self.exit_status = exit_status
+
+    def read(self):
+        return self.data
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+# Thay thế paramiko.SSHClient cho các lệnh uploader dùng:
+# open_sftp(), exec_command(), get_transport().is_active()/set_keepalive(), close()
+class BrokeredSSH:
+    def __init__(self, broker_port, token, host, port, username, password=None):
+        self.broker_port = broker_port
+        self.token = token
+        self.target = {"host": host, "port": port, "username": username}
+        self.password = password
+        self.session = None
+
+    def _send(self, request):
+        sock = socket.create_connection(("127.0.0.1", self.broker_port), timeout=30)
+        try:
+            send_json(sock, dict(request, token=self.token))
+            if request["op"] in ("exec", "sftp"):
+                # exec chỉ trả lời khi lệnh chạy xong (sha256sum / ghép phần / mv zip lớn có thể > 30s),
+                # sftp thành luồng SFTP không giới hạn thời gian
+                sock.settimeout(None)
+            reply = json.loads(recv_line(sock))
+        except Exception:
+            sock.close()
+            raise
+        if not reply.get("ok"):
+            sock.close()
+        return sock, reply
+
+    def _call(self, op, **extra):
+        sock, reply = self._send(dict(op=op, session=self.session, **extra))
+        if reply.get("reconnect"):
+            self.connect()
+            sock, reply = self._send(dict(op=op, session=self.session, **extra))
+        if not reply.get("ok"):
+            raise Exception(f"Broker: {reply.get('error')}")
+        return sock, reply
+
+    def connect(self):
+        sock, reply = self._send(dict(self.target, op="connect", password=self.password))
+        if not reply.get("ok"):
+            if reply.get("auth_failed"):
+                import paramiko
+                raise paramiko.AuthenticationException(reply.get("error"))
+            raise Exception(f"Broker: {reply.get('error')}")
+        sock.close()
+        self.session = reply["session"]
+
+    def open_sftp(self):
+        import paramiko
+        sock, _ = self._call("sftp")
+        return paramiko.SFTPClient(BrokerChannel(sock))
+
+    def exec_command(self, command):
+        sock, reply = self._call("exec", command=command)
+        sock.close()
+        stdout = BrokerCommandOutput(base64.b64decode(reply["stdout"]), reply["exit_status"])
+        stderr = BrokerCommandOutput(base64.b64decode(reply["stderr"]), reply["exit_status"])
+        return None, stdout, stderr
+
+    def get_transport(self):
+        return self
+
+    # Hỏi broker: transport của session còn sống không. Broker không chạy / session hết hạn -> False
+    # (uploader kết nối lại, watch mode bỏ phiên cũ).
+    def is_active(self):
+        try:
+            sock, reply = self._send({"op": "status", "session": self.session})
+        except (OSError, EOFError, ValueError):
+            return False
+        sock.close()
+        return bool(reply.get("ok") and reply.get("alive"))
+
+    def set_keepalive(self, interval):
+        # Keepalive do broker lo
+        pass
+
+    def close(self):
+        # Transport vẫn được broker giữ cho lần chạy sau
+        pass
+
+# Gắn vào broker nếu đang chạy. Trả về BrokeredSSH, hoặc None nếu broker không chạy.
+def attach_broker(host, port, opts):
+    broker_port = opts.get('ssh_broker_port')
+    if not broker_port:
+        return None
+    try:
+        with open(BROKER_TOKEN_FILE, 'r', encoding='utf-8') as f:
+            token = f.read().strip()
+    except OSError:
+        return None
+
+    ssh = BrokeredSSH(int(broker_port), token, host, port, opts['username'], opts.get('password'))
+    try:
+        ssh.connect()
+    except (ConnectionRefusedError, socket.timeout, EOFError, OSError):
+        return None
+    return ssh
+
+# --- Phía server (python ktb_broker.py) ---
+
+class Broker:
+    def __init__(self, port, token, keepalive_seconds, idle_seconds, tuning_file=None):
+        self.port = port
+        self.tuning_file = tuning_file
+        self.token = token
+        self.keepalive_seconds = keepalive_seconds
+        self.idle_seconds = idle_seconds
+        self.lock = threading.Lock()
+        self.clients = {}       # (host, port, user) -> paramiko.SSHClient
+        self.last_used = {}
+        self.in_use = {}        # client -> số request đang chạy (relay SFTP, exec): không đóng khi > 0
+        self.retired = set()    # client đã bị thay (xác thực lại) nhưng còn request đang chạy
+        self.credentials = {}   # key -> sha256 mật khẩu đã dùng để xác thực ("" = SSH key)
+        self.sessions = {}      # key -> session cấp ở op=connect (đổi mỗi lần xác thực lại)
+        self.connect_locks = {}
+
+    # Đảm bảo có transport cho (host, port, user), xác thực nếu cần. Trả về session của transport.
+    def open_session(self, request):
+        import paramiko
+        key = (request["host"], int(request["port"]), request["username"])
+        with self.lock:
+            connect_lock = self.connect_locks.setdefault(key, threading.Lock())
+        # Mỗi key 1 lock riêng: host chậm không chặn host khác
+        with connect_lock:
+            credential = hashlib.sha256(request["password"].encode('utf-8')).hexdigest() if request.get("password") else ""
+            with self.lock:
+                client = self.clients.get(key)
+                same_credential = self.credentials.get(key) == credential
+            transport = client.get_transport() if client else None
+            # Mật khẩu khác lần trước -> xác thực lại, không cho dùng transport cũ
+            if transport is None or not transport.is_active() or not same_credential:
+                old_client = client
+                print(f"[broker] 🚀 Ket noi moi {key[2]}@{key[0]}:{key[1]}")
+                from ktb_uploader import new_ssh_client
+                client = new_ssh_client()
+                # Đọc lại profile mỗi lần kết nối mới: tune-ssh không cần khởi động lại broker
+                tuning = connect_options(load_profile(self.tuning_file), key[0], key[1])
+                if request.get("password"):
+                    client.connect(key[0], port=key[1], username=key[2], password=request["password"],
+                                   timeout=10, disabled_algorithms={'publickey': []}, **tuning)
+                else:
+                    from ktb_uploader import get_ssh_key
+                    client.connect(key[0], port=key[1], username=key[2], pkey=get_ssh_key(), timeout=10, **tuning)
+                client.get_transport().set_keepalive(self.keepalive_seconds)
+                # Session cũ (mật khẩu cũ / transport đã chết) hết hiệu lực; client cũ đóng
+                # khi không còn request nào của lần chạy khác đang dùng
+                with self.lock:
+                    self.clients[key] = client
+                    self.sessions[key] = secrets.token_hex(16)
+                if old_client:
+                    self.retire(old_client)
+            with self.lock:
+                self.clients[key] = client
+                self.credentials[key] = credential
+                self.last_used[key] = time.time()
+                return self.sessions[key]
+
+    # Đóng client cũ; đang có request dùng thì để release đóng sau khi request cuối xong
+    def retire(self, client):
+        with self.lock:
+            if self.in_use.get(client):
+                self.retired.add(client)
+                return
+        client.close()
+
+    # (key, client) còn sống của session, hoặc (None, None). Gọi khi đang giữ self.lock.
+    def session_client(self, session):
+        key = next((key for key, value in self.sessions.items() if session and secrets.compare_digest(value, session)), None)
+        client = self.clients.get(key)
+        transport = client.get_transport() if client else None
+        if transport is None or not transport.is_active():
+            return None, None
+        return key, client
+
+    def is_alive(self, session):
+        with self.lock:
+            return self.session_client(session)[1] is not None
+
+    # (key, client) của session, đã giữ chỗ (phải gọi release); (None, None) nếu phải connect lại
+    def acquire(self, session):
+        with self.lock:
+            key, client = self.session_client(session)
+            if client is None:
+                return None, None
+            self.in_use[client] = self.in_use.get(client, 0) + 1
+            self.last_used[key] = time.time()
+        return key, client
+
+    def release(self, key, client):
+        with self.lock:
+            self.in_use[client] -= 1
+            if key in self.last_used:
+                self.last_used[key] = time.time()
+            if self.in_use[client]:
+                return
+            del self.in_use[client]
+            if client not in self.retired:
+                return
+            self.retired.discard(client)
+        client.close()
+
+    def evict_idle(self):
+        while True:
+            time.sleep(min(60, self.idle_seconds))
+            now = time.time()
+            with self.lock:
+                # Transfer dài hơn idle_seconds vẫn đang dùng transport -> không đóng
+                idle = [key for key, used in self.last_used.items()
+                        if now - used > self.idle_seconds and not self.in_use.get(self.clients.get(key))]
+                evicted = [(key, self.clients.pop(key, None)) for key in idle]
+                for key in idle:
+                    self.last_used.pop(key, None)
+                    self.credentials.pop(key, None)
+                    self.sessions.pop(key, None)
+            for key, client in evicted:
+                if client:
+                    client.close()
+                    print(f"[broker] 🧹 Dong ket noi ranh {key[2]}@{key[0]}:{key[1]}")
+
+    def handle(self, sock):
+        import paramiko
+        try:
+            request = json.loads(recv_line(sock))
+            if not secrets.compare_digest(str(request.get("token", "")), self.token):
+                send_json(sock, {"ok": False, "error": "Sai token"})
+                return
+            op = request.get("op")
+            if op == "connect":
+                try:
+                    session = self.open_session(request)
+                except paramiko.AuthenticationException as e:
+                    send_json(sock, {"ok": False, "auth_failed": True, "error": str(e)})
+                    return
+                send_json(sock, {"ok": True, "session": session})
+                return
+            if op == "status":
+                send_json(sock, {"ok": True, "alive": self.is_alive(request.get("session"))})
+                return
+            if op not in ("exec", "sftp"):
+                send_json(sock, {"ok": False, "error": f"op khong hop le: {op}"})
+                return
+
+            key, client = self.acquire(request.get("session"))
+            if client is None:
+                send_json(sock, {"ok": False, "reconnect": True, "error": "Session het han"})
+                return
+            try:
+                if op == "exec":
+                    stdin, stdout, stderr = client.exec_command(request["command"])
+                    out = stdout.read()
+                    err = stderr.read()
+                    exit_status = stdout.channel.recv_exit_status()
+                    send_json(sock, {"ok": True, "exit_status": exit_status,
+                                     "stdout": base64.b64encode(out).decode(), "stderr": base64.b64encode(err).decode()})
+                else:
+                    channel = client.get_transport().open_session()
+                    channel.invoke_subsystem('sftp')
+                    send_json(sock, {"ok": True})
+                    self.relay(sock, channel)
+            finally:
+                self.release(key, client)
+        except Exception as e:
+            try:
+                send_json(sock, {"ok": False, "error": str(e)})
+            except Exception:
+                pass
+        finally:
+            sock.close()
+
+    # Chuyển byte 2 chiều giữa socket local và kênh SFTP trên transport ấm
+    def relay(self, sock, channel):
+        try:
+            while True:
+                readable, _, _ = select.select([sock, channel], [], [], 60)
+                if sock in readable:
+                    data = sock.recv(RELAY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    channel.sendall(data)
+                if channel in readable:
+                    data = channel.recv(RELAY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    sock.sendall(data)
+        finally:
+            channel.close()
+
+    def serve_forever(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("127.0.0.1", self.port))
+        server.listen(64)
+        threading.Thread(target=self.evict_idle, daemon=True).start()
+        print(f"[broker] ✅ Dang chay tai 127.0.0.1:{self.port} (keepalive {self.keepalive_seconds}s, dong sau {self.idle_seconds}s ranh)")
+        while True:
+            sock, _ = server.accept()
+            threading.Thread(target=self.handle, args=(sock,), daemon=True).start()
+
+def main():
+    load_dotenv()
+    try:
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        print(f"[LOI] Khong tim thay file cau hinh {CONFIG_FILE}.")
+        sys.exit(1)
+
+    port = int(config.get('ssh_broker_port') or DEFAULT_BROKER_PORT)
+    token = secrets.token_hex(16)
+    # Ai có token là chạy được lệnh trên VPS bằng SSH key admin -> chỉ user hiện tại được đọc
+    if os.path.exists(BROKER_TOKEN_FILE):
+        os.remove(BROKER_TOKEN_FILE)
+    with os.fdopen(os.open(BROKER_TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+        f.write(token)
+
+    broker = Broker(port, token,
+                    int(config.get('ssh_keepalive_seconds', 30)),
+                    int(config.get('ssh_broker_idle_seconds', 900)),
+                    config.get('ssh_tuning_file'))
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[broker] Dung broker.")
+    finally:
+        if os.path.exists(BROKER_TOKEN_FILE):
+            os.remove(BROKER_TOKEN_FILE)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import zipfile
+from datetime import datetime
+
+# --- Index SHA-256 các ảnh đã upload thành công, theo từng site prefix ---
+# prepare_zip.py / prepare_zip_manual.py (và streaming mode) bỏ ảnh trùng khỏi zip,
+# uploader ghi hash vào index sau khi mv commit thành công.
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def sha256_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+class ImageIndex:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # Uploader ghi từ nhiều thread (nhiều host / nhiều kênh SFTP) -> dùng chung 1 connection + lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS uploaded_images ("
+            " prefix TEXT NOT NULL,"
+            " sha256 TEXT NOT NULL,"
+            " filename TEXT,"
+            " uploaded_at TEXT,"
+            " PRIMARY KEY (prefix, sha256))"
+        )
+        self.conn.commit()
+
+    def contains(self, prefix, sha256):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM uploaded_images WHERE prefix = ? AND sha256 = ?", (prefix, sha256)
+            ).fetchone()
+        return row is not None
+
+    # entries: [(filename, sha256)]
+    def add(self, prefix, entries):
+        uploaded_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO uploaded_images (prefix, sha256, filename, uploaded_at) VALUES (?, ?, ?, ?)",
+                [(prefix, sha256, filename, uploaded_at) for filename, sha256 in entries]
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def open_image_index(db_path):
+    if not db_path:
+        return None
+    return ImageIndex(db_path)
+
+# --- File hash đi kèm zip local (<zip>.hashes.json) ---
+# prepare_zip ghi lại hash các ảnh đã cho vào zip; uploader đọc file này sau khi commit.
+def hashes_sidecar_path(zip_path):
+    return f"{zip_path}.hashes.json"
+
+def save_zip_hashes(zip_path, prefix, entries):
+    with open(hashes_sidecar_path(zip_path), 'w', encoding='utf-8') as f:
+        json.dump({"prefix": prefix, "images": entries}, f)
+
+# Lấy [(filename, sha256)] các ảnh trong zip: ưu tiên file .hashes.json,
+# nếu không có (zip do nơi khác tạo, vd: admin upload) thì đọc thẳng entry trong zip.
+def load_zip_hashes(zip_path, image_exts):
+    try:
+        with open(hashes_sidecar_path(zip_path), 'r', encoding='utf-8') as f:
+            return [tuple(entry) for entry in json.load(f).get("images", [])]
+    except (OSError, ValueError):
+        pass
+
+    entries = []
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(image_exts):
+                continue
+            sha256 = hashlib.sha256()
+            with zf.open(info) as f:
+                while True:
+                    chunk = f.read(HASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+            entries.append((info.filename, sha256.hexdigest()))
+    return entries
+
+def clear_zip_hashes(zip_path):
+    try:
+        os.remove(hashes_sidecar_path(zip_path))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,179 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from ktb_zip import VALID_IMG_EXTS
+from ktb_metrics import NULL_METRICS
+
+# Pillow là tùy chọn (không có thì bỏ qua bước tối ưu ảnh) và chỉ được nạp khi có ảnh cần tối ưu
+Image = None
+PngImagePlugin = None
+
+def load_pillow():
+    global Image, PngImagePlugin
+    if Image is None:
+        try:
+            from PIL import Image, PngImagePlugin
+        except ImportError:
+            return False
+    return True
+
+# --- Tối ưu ảnh trước khi nén zip (resize / encode lại) ---
+# 'image_optimize' trong config.json là mặc định chung, 'image_optimize' trong từng site ghi đè từng khóa:
+#   enabled       : bật/tắt
+#   max_dimension : cạnh dài tối đa (px), 0 = giữ nguyên kích thước
+#   quality       : chất lượng JPEG/WebP (1-95)
+#   format        : "jpeg" / "png" / "webp", rỗng = giữ định dạng gốc
+# 'image_optimize_workers': số process (mặc định = zip_workers).
+# Ảnh được ghi đè tại chỗ (đổi đuôi nếu đổi định dạng), chỉ giữ bản mới nếu nhỏ hơn bản gốc.
+# Giữ tên file (importer trên VPS lấy tiêu đề từ tên ảnh), EXIF, ICC, DPI, text PNG và mtime.
+# Ảnh có nền trong suốt không bị chuyển sang JPEG, PNG có text chunk giữ định dạng PNG;
+# GIF động không bị đụng tới. JPEG/WebP giữ định dạng mà không cần resize cũng không bị encode lại:
+# ảnh có thể đi qua bước này nhiều lần (watch thử lại, chạy lại prepare_zip), mỗi lần encode lossy
+# lại làm ảnh xấu thêm.
+
+SAVE_FORMATS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+FORMAT_ALIASES = {"JPG": "JPEG"}
+
+# Cấu hình tối ưu của 1 site (None = tắt)
+def site_settings(config, site):
+    settings = dict(config.get('image_optimize') or {})
+    settings.update((site or {}).get('image_optimize') or {})
+    return settings if settings.get('enabled') else None
+
+def has_alpha(img):
+    return img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+
+def save_options(img, target, settings):
+    options = {}
+    for key in ('exif', 'icc_profile', 'dpi'):
+        if img.info.get(key):
+            options[key] = img.info[key]
+    quality = int(settings.get('quality') or 85)
+    if target == 'JPEG':
+        options.update(quality=quality, optimize=True, progressive=True)
+    elif target == 'WEBP':
+        options.update(quality=quality, method=4)
+    elif target == 'PNG':
+        options['optimize'] = True
+        text = getattr(img, 'text', None)
+        if text:
+            pnginfo = PngImagePlugin.PngInfo()
+            for key, value in text.items():
+                pnginfo.add_text(key, value)
+            options['pnginfo'] = pnginfo
+    return options
+
+# Worker (chạy trong process pool): tối ưu 1 ảnh.
+# Trả về (đường dẫn sau cùng, byte trước, byte sau, lỗi hoặc None).
+def optimize_image(file_path, settings):
+    before = os.path.getsize(file_path)
+    part_path = None
+    try:
+        load_pillow()
+        with Image.open(file_path) as img:
+            if getattr(img, 'is_animated', False):
+                return file_path, before, before, None
+            source = img.format
+            target = (settings.get('format') or '').upper()
+            target = FORMAT_ALIASES.get(target, target) or source
+            if (target == 'JPEG' and has_alpha(img)) or (target != 'PNG' and getattr(img, 'text', None)):
+                # Nền trong suốt / text chunk PNG không giữ được khi đổi định dạng
+                target = source
+            if target not in SAVE_FORMATS:
+                return file_path, before, before, None
+
+            max_dimension = int(settings.get('max_dimension') or 0)
+            resize = bool(max_dimension and max(img.size) > max_dimension)
+            if target == source and target in ('JPEG', 'WEBP') and not resize:
+                return file_path, before, before, None
+
+            options = save_options(img, target, settings)
+            if resize:
+                img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            if target == 'JPEG' and img.mode not in ('RGB', 'L', 'CMYK'):
+                img = img.convert('RGB')
+
+            stem, _ = os.path.splitext(file_path)
+            output_path = file_path if target == source else stem + SAVE_FORMATS[target]
+            if output_path != file_path and os.path.exists(output_path):
+                # Đã có file khác trùng tên đích -> giữ định dạng gốc
+                return file_path, before, before, None
+            part_path = f"{os.path.dirname(file_path)}/.{os.path.basename(output_path)}.part"
+            img.save(part_path, format=target, **options)
+
+        after = os.path.getsize(part_path)
+        if after >= before:
+            return file_path, before, before, None
+        stat = os.stat(file_path)
+        os.replace(part_path, output_path)
+        part_path = None
+        os.utime(output_path, (stat.st_atime, stat.st_mtime))
+        if output_path != file_path:
+            os.remove(file_path)
+        return output_path, before, after, None
+    except Exception as e:
+        return file_path, before, before, str(e)
+    finally:
+        if part_path and os.path.exists(part_path):
+            os.remove(part_path)
+
+# Tối ưu ảnh (tại chỗ) trong các folder [(folder_name, folder_path, site)] theo cấu hình của site.
+# Trả về dict thống kê (None nếu không folder nào bật tối ưu).
+def optimize_image_folders(folders, config, metrics=NULL_METRICS):
+    tasks = []
+    for folder_name, folder_path, site in folders:
+        settings = site_settings(config, site)
+        if not settings:
+            continue
+        # Cả thư mục con: zip (ktb_zip.folder_entries) lấy toàn bộ cây thư mục
+        for dirpath, dirnames, filenames in os.walk(folder_path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.lower().endswith(VALID_IMG_EXTS) and not name.startswith('.'):
+                    tasks.append((os.path.join(dirpath, name), settings))
+    return optimize_images(tasks, config, metrics)
+
+# Tối ưu các ảnh [(đường dẫn, settings)]. Trả về dict thống kê, trong đó stats["paths"] là
+# đường dẫn sau cùng của từng ảnh theo đúng thứ tự (None nếu không có ảnh / thiếu Pillow).
+def optimize_images(tasks, config, metrics=NULL_METRICS):
+    if not tasks:
+        return None
+    if not load_pillow():
+        print("   ⚠️ 'image_optimize' dang bat nhung chua cai Pillow (pip install Pillow) -> Bo qua buoc toi uu anh.")
+        return None
+
+    workers = max(1, int(config.get('image_optimize_workers', config.get('zip_workers', 1))))
+    print(f"   🖼️ Toi uu {len(tasks)} anh ({min(workers, len(tasks))} process)...")
+    stats = {"files": len(tasks), "optimized": 0, "errors": 0, "bytes_before": 0, "bytes_after": 0, "seconds": 0.0,
+             "paths": []}
+    started = time.perf_counter()
+    if workers == 1 or len(tasks) == 1:
+        results = [optimize_image(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            results = list(pool.map(optimize_image, *zip(*tasks), chunksize=8))
+
+    for output_path, before, after, error in results:
+        stats["paths"].append(output_path)
+        stats["bytes_before"] += before
+        stats["bytes_after"] += after
+        if error:
+            stats["errors"] += 1
+            print(f"      ⚠️ Khong toi uu duoc {output_path}: {error}")
+        elif after < before:
+            stats["optimized"] += 1
+    stats["seconds"] = time.perf_counter() - started
+
+    metrics.add_phase("optimize", stats["seconds"], num_bytes=stats["bytes_before"])
+    metrics.record("optimize", files=stats["files"], optimized=stats["optimized"], errors=stats["errors"],
+                   bytes_before=stats["bytes_before"], bytes_after=stats["bytes_after"],
+                   bytes_saved=stats["bytes_before"] - stats["bytes_after"], seconds=round(stats["seconds"], 4))
+    print(f"      ✅ {format_optimize_stats(stats)}")
+    return stats
+
+def format_optimize_stats(stats):
+    before_mb = stats["bytes_before"] / (1024 * 1024)
+    after_mb = stats["bytes_after"] / (1024 * 1024)
+    return (f"Toi uu {stats['optimized']}/{stats['files']} anh: {before_mb:.1f} MB -> {after_mb:.1f} MB "
+            f"(tiet kiem {before_mb - after_mb:.1f} MB), {stats['seconds']:.1f}s"
+            + (f", {stats['errors']} loi" if stats['errors'] else ""))
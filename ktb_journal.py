@@ -0,0 +1,167 @@
+import os
+import time
+import uuid
+import errno
+import sqlite3
+import threading
+from datetime import datetime
+from ktb_image_index import hashes_sidecar_path
+
+# --- Nhật ký job local (SQLite) cho ktb-admin-upload.py ---
+# Mỗi zip là 1 job, job_id duy nhất (cũng là tên thư mục job trên VPS), trạng thái:
+#   discovered -> staged -> uploading -> uploaded -> committed -> cleaned
+# Mỗi lần đổi trạng thái được ghi xuống đĩa ngay, nên sau khi script bị dừng giữa chừng lần chạy
+# sau biết từng zip đã tới đâu:
+#   staged / uploading / uploaded: upload tiếp với đúng job_id (ktb_uploader.transfer_job thấy
+#     thư mục job đã được mv trên VPS thì coi là committed, thấy tmp_<job_id> thì dùng lại)
+#   committed: đã xếp hàng trên VPS -> chỉ dọn file local, không gửi lại
+# Staging: rename vào Processing (cùng ổ đĩa). Khác ổ đĩa thì giữ file tại chỗ và upload thẳng
+# từ đó, không copy. Upload lỗi -> job quay về staged (kèm lỗi) để lần chạy sau thử lại.
+
+JOURNAL_FILE = 'job_journal.sqlite3'
+ACTIVE_STATES = ('discovered', 'staged', 'uploading', 'uploaded', 'committed')
+
+# Tên job duy nhất kể cả khi nhiều zip cùng tên được tạo trong cùng 1 giây
+def new_job_id(filename, wp_author=None):
+    author = f"_{wp_author}" if wp_author else ""
+    return f"job_{int(time.time())}_{uuid.uuid4().hex[:8]}{author}_{filename[:20]}"
+
+class JobJournal:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # Uploader cập nhật trạng thái từ nhiều thread (nhiều host / nhiều kênh SFTP) -> 1 connection + lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " filename TEXT NOT NULL,"
+            " source_path TEXT,"
+            " staged_path TEXT,"
+            " state TEXT NOT NULL,"
+            " host TEXT,"
+            " error TEXT,"
+            " created_at TEXT,"
+            " updated_at TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self.conn.commit()
+
+    # wp_author: đưa vào tên job (job_<ts>_<uuid>_<author>_...), như job không qua nhật ký
+    def add(self, filename, source_path, state='discovered', staged_path=None, wp_author=None):
+        job_id = new_job_id(filename, wp_author)
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO jobs (job_id, filename, source_path, staged_path, state, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, filename, source_path, staged_path, state, now, now)
+            )
+            self.conn.commit()
+        return job_id
+
+    # fields: staged_path, host. error luôn được ghi đè (None = xóa lỗi cũ).
+    def set_state(self, job_id, state, error=None, **fields):
+        columns = ["state = ?", "error = ?", "updated_at = ?"]
+        values = [state, error, datetime.now().strftime('%Y-%m-%d %H:%M:%S')]
+        for key in ('staged_path', 'host'):
+            if key in fields:
+                columns.append(f"{key} = ?")
+                values.append(fields[key])
+        with self.lock:
+            self.conn.execute(f"UPDATE jobs SET {', '.join(columns)} WHERE job_id = ?", values + [job_id])
+            self.conn.commit()
+
+    # Các job chưa xong (state != cleaned), theo thứ tự phát hiện
+    def active_jobs(self):
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT * FROM jobs WHERE state IN ({', '.join('?' * len(ACTIVE_STATES))}) ORDER BY created_at, rowid",
+                ACTIVE_STATES
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def open_journal(db_path):
+    return JobJournal(db_path or JOURNAL_FILE)
+
+# Rename zip (+ file .hashes.json đi kèm) vào processing_dir. Trả về đường dẫn sau khi stage:
+# khác ổ đĩa -> giữ nguyên chỗ cũ; trùng tên với zip đang chờ trong processing_dir -> thêm hậu tố.
+def stage_file(source_path, processing_dir):
+    filename = os.path.basename(source_path)
+    dest_path = os.path.join(processing_dir, filename)
+    if os.path.exists(dest_path):
+        stem, ext = os.path.splitext(filename)
+        dest_path = os.path.join(processing_dir, f"{stem}.{uuid.uuid4().hex[:8]}{ext}")
+    try:
+        os.rename(source_path, dest_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        return source_path
+    if os.path.exists(hashes_sidecar_path(source_path)):
+        os.rename(hashes_sidecar_path(source_path), hashes_sidecar_path(dest_path))
+    return dest_path
+
+# 1. Job bị dừng giữa discovered -> staged: stage lại với đúng job_id
+# 2. Zip mới trong source_dir: discovered -> staged
+# 3. Zip trong processing_dir chưa có trong nhật ký (vd: còn lại từ bản cũ dùng shutil.move,
+#    hoặc đã rename nhưng chưa kịp ghi staged) -> staged
+# router (ktb_router.SiteRouter, tùy chọn): lấy wp_author của site cho tên job mới.
+# Trả về (số zip mới, [(filename, lỗi)]).
+def stage_new_files(journal, source_dir, processing_dir, router=None):
+    def author_of(filename):
+        route = router.match(filename) if router is not None else None
+        return route['wp_author'] if route else None
+
+    pending = {}         # source_path -> job_id của job còn ở discovered
+    known_paths = set()  # nơi file của các job đang chờ đang nằm
+    for job in journal.active_jobs():
+        if job['state'] != 'discovered':
+            known_paths.add(job['staged_path'])
+        elif os.path.exists(job['source_path']):
+            pending[job['source_path']] = job['job_id']
+        else:
+            # Đã rename (zip được nhận lại ở bước 3) hoặc đã bị xóa tay
+            journal.set_state(job['job_id'], 'cleaned', "khong con file o cho cu")
+
+    staged_count = 0
+    errors = []
+    if os.path.isdir(source_dir):
+        for filename in sorted(os.listdir(source_dir)):
+            source_path = os.path.join(source_dir, filename)
+            if not filename.endswith('.zip') or source_path in known_paths:
+                continue
+            job_id = pending.get(source_path) or journal.add(filename, source_path, wp_author=author_of(filename))
+            try:
+                staged_path = stage_file(source_path, processing_dir)
+            except OSError as e:
+                errors.append((filename, str(e)))
+                journal.set_state(job_id, 'discovered', str(e))
+                continue
+            journal.set_state(job_id, 'staged', staged_path=staged_path)
+            known_paths.add(staged_path)
+            staged_count += 1
+
+    for filename in sorted(os.listdir(processing_dir)):
+        path = os.path.join(processing_dir, filename)
+        if filename.endswith('.zip') and path not in known_paths:
+            journal.add(filename, path, 'staged', path, author_of(filename))
+    return staged_count, errors
+
+# Job đã committed trên VPS nhưng chưa dọn file local: xóa zip + file đi kèm -> cleaned.
+# Trả về True nếu đã dọn xong.
+def clean_committed(journal, job):
+    try:
+        for path in (job['staged_path'], f"{job['staged_path']}.resume.json", hashes_sidecar_path(job['staged_path'])):
+            if path and os.path.exists(path):
+                os.remove(path)
+    except OSError as e:
+        journal.set_state(job['job_id'], 'committed', str(e))
+        return False
+    journal.set_state(job['job_id'], 'cleaned')
+    return True
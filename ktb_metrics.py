@@ -0,0 +1,116 @@
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# --- Số liệu thời gian / thông lượng theo từng phase, ghi dạng JSONL ---
+# Mỗi dòng 1 record: {"ts", "run_id", "script", "event", ...}
+#   event=phase  : 1 bước (connect, mkdir, meta, put, checksum, commit, zip...) + seconds (+ bytes, mbps)
+#   event=job    : 1 job upload: bytes, seconds, mbps, status
+#   event=host   : 1 lượt upload của 1 host: jobs, ok, bytes, seconds, mbps
+#   event=zip    : 1 folder đã nén: raw_bytes, zip_bytes, seconds, mbps
+#   event=optimize: 1 lượt tối ưu ảnh: files, optimized, bytes_before, bytes_after, bytes_saved, seconds
+#   event=preflight: kiểm tra VPS trước khi upload 1 host: queue_depth, free_bytes, jobs, deferred
+#   event=summary: cuối lượt chạy, tổng theo host và theo phase
+# Đường dẫn file: 'metrics_file' trong config.json (để trống = tắt).
+
+def mbps(num_bytes, seconds):
+    return round(num_bytes * 8 / seconds / 1000 / 1000, 2) if seconds > 0 else None
+
+class MetricsRecorder:
+    def __init__(self, path, script):
+        self.path = path
+        self.script = script
+        self.run_id = uuid.uuid4().hex[:12]
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phase_totals = {}    # phase -> {"count", "seconds", "bytes"}
+        self.host_totals = {}     # host -> {"jobs", "ok", "bytes", "seconds"}
+
+    def record(self, event, **fields):
+        if not self.path:
+            return
+        line = {"ts": datetime.now().isoformat(timespec='milliseconds'), "run_id": self.run_id,
+                "script": self.script, "event": event}
+        line.update(fields)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    def add_phase(self, phase, seconds, host=None, job=None, num_bytes=None):
+        with self.lock:
+            total = self.phase_totals.setdefault(phase, {"count": 0, "seconds": 0.0, "bytes": 0})
+            total["count"] += 1
+            total["seconds"] += seconds
+            total["bytes"] += num_bytes or 0
+        fields = {"phase": phase, "host": host, "job": job, "seconds": round(seconds, 4)}
+        if num_bytes is not None:
+            fields["bytes"] = num_bytes
+            fields["mbps"] = mbps(num_bytes, seconds)
+        self.record("phase", **fields)
+
+    # with metrics.phase("put", host, job) as m: ...; m["bytes"] = n
+    @contextmanager
+    def phase(self, name, host=None, job=None):
+        extra = {}
+        started = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            self.add_phase(name, time.perf_counter() - started, host, job, extra.get("bytes"))
+
+    def job(self, host, filename, num_bytes, seconds, status):
+        self.record("job", host=host, job=filename, bytes=num_bytes, seconds=round(seconds, 4),
+                    mbps=mbps(num_bytes, seconds), status=status)
+
+    # 1 lượt upload của 1 host; seconds = thời gian thực (nhiều kênh SFTP chạy song song)
+    def host(self, host, jobs, ok, num_bytes, seconds):
+        with self.lock:
+            total = self.host_totals.setdefault(host, {"jobs": 0, "ok": 0, "bytes": 0, "seconds": 0.0})
+            total["jobs"] += jobs
+            total["ok"] += ok
+            total["bytes"] += num_bytes
+            total["seconds"] += seconds
+        self.record("host", host=host, jobs=jobs, ok=ok, bytes=num_bytes, seconds=round(seconds, 4),
+                    mbps=mbps(num_bytes, seconds))
+
+    # 1 folder đã nén (stats của ktb_zip.write_folder_zip), tính vào phase "zip"
+    def zip(self, folder, zip_filename, stats, error=None):
+        if error or not stats:
+            self.record("zip", folder=folder, zip=zip_filename, error=error)
+            return
+        with self.lock:
+            total = self.phase_totals.setdefault("zip", {"count": 0, "seconds": 0.0, "bytes": 0})
+            total["count"] += 1
+            total["seconds"] += stats["seconds"]
+            total["bytes"] += stats["raw_bytes"]
+        self.record("zip", folder=folder, zip=zip_filename, files=stats["files"], raw_bytes=stats["raw_bytes"],
+                    zip_bytes=stats["zip_bytes"], duplicates=stats.get("duplicates", 0),
+                    seconds=round(stats["seconds"], 4), mbps=mbps(stats["raw_bytes"], stats["seconds"]))
+
+    # Ghi record summary và trả về vài dòng tóm tắt để in ra console
+    def summary(self, **fields):
+        elapsed = time.perf_counter() - self.started
+        with self.lock:
+            hosts = {host: dict(total, seconds=round(total["seconds"], 3), mbps=mbps(total["bytes"], total["seconds"]))
+                     for host, total in self.host_totals.items()}
+            phases = {phase: dict(total, seconds=round(total["seconds"], 3))
+                      for phase, total in self.phase_totals.items()}
+        self.record("summary", seconds=round(elapsed, 3), hosts=hosts, phases=phases, **fields)
+
+        lines = [f"⏱️  Tong thoi gian: {elapsed:.1f}s"]
+        for phase, total in phases.items():
+            lines.append(f"   {phase}: {total['seconds']:.1f}s / {total['count']} lan")
+        for host, total in hosts.items():
+            lines.append(f"   [{host}] {total['ok']}/{total['jobs']} job, {total['bytes'] / (1024 * 1024):.1f} MB"
+                         + (f", {total['mbps']} Mbps" if total['mbps'] else ""))
+        return "\n".join(lines)
+
+# Luôn trả về recorder (path rỗng -> không ghi file) để nơi gọi không phải kiểm tra None
+def open_metrics(path, script):
+    return MetricsRecorder(path or None, script)
+
+# Dùng trong ktb_uploader khi opts không có 'metrics'
+NULL_METRICS = MetricsRecorder(None, None)
@@ -0,0 +1,170 @@
+import os
+import json
+from collections import deque
+from ktb_zip import IMAGE_SOURCE_DIR, find_image_folders, reserve_zip_filename
+from ktb_scheduler import package_size, make_bandwidth_limiter, format_eta, print_schedule
+from ktb_journal import JOURNAL_FILE, open_journal
+
+# --- Dry-run: lập kế hoạch upload, chỉ đọc (không di chuyển file, không kết nối VPS) ---
+# Gom zip / folder ảnh theo site -> VPS, tổng dung lượng từng host, đánh dấu file không
+# upload được (không khớp site, thiếu HOST/PORT trong .env, thiếu wp_author) và ước lượng
+# thời gian từ tốc độ thực tế các lượt trước: event 'host' trong metrics_file (xem ktb_metrics.py).
+#   python ktb.py plan [--admin] [--files]
+#   python ktb-admin-upload.py --dry-run / python ktb-user-upload.py --dry-run
+
+# Số lượt upload gần nhất của mỗi host dùng để tính tốc độ
+HISTORY_RUNS = 20
+
+# Candidate: (filename, local_zip_path, source_folder)
+# User: zip trong InputZip + folder ảnh chưa nén trong OutputImage (sẽ được nén / stream)
+def user_candidates(config, router, input_dir='InputZip'):
+    candidates = []
+    if os.path.isdir(input_dir):
+        for filename in sorted(os.listdir(input_dir)):
+            if filename.endswith('.zip'):
+                candidates.append((filename, os.path.join(input_dir, filename), None))
+    if os.path.isdir(IMAGE_SOURCE_DIR):
+        wp_author = config.get('default_user_author', 'unknown')
+        used_names = {filename for filename, _, _ in candidates}
+        for folder_name, folder_path, site in find_image_folders(IMAGE_SOURCE_DIR, router, verbose=False):
+            zip_filename = reserve_zip_filename(f"{site['prefix']}.{wp_author}", used_names, input_dir)
+            candidates.append((zip_filename, None, folder_path))
+    return candidates
+
+# Admin: như ktb-admin-upload.py, theo nhật ký job (xem ktb_journal.py):
+# job chưa xong trong nhật ký (bỏ job đã committed: chỉ còn dọn file local, không gửi lại)
+# + zip trong Processing / OutputImage chưa có trong nhật ký
+def admin_candidates(source_dir, processing_dir, journal_db=None):
+    jobs = []
+    # Chưa có nhật ký thì không tạo file mới (dry-run chỉ đọc)
+    if os.path.exists(journal_db or JOURNAL_FILE):
+        journal = open_journal(journal_db)
+        try:
+            jobs = journal.active_jobs()
+        finally:
+            journal.close()
+
+    candidates = []
+    known_paths = set()
+    for job in jobs:
+        # discovered: zip vẫn nằm trong OutputImage, được tính ở lượt quét thư mục bên dưới
+        if job['state'] == 'discovered':
+            continue
+        known_paths.add(job['staged_path'])
+        if job['state'] != 'committed' and os.path.exists(job['staged_path']):
+            candidates.append((job['filename'], job['staged_path'], None))
+    for folder in (processing_dir, source_dir):
+        if os.path.isdir(folder):
+            for filename in sorted(os.listdir(folder)):
+                path = os.path.join(folder, filename)
+                if filename.endswith('.zip') and path not in known_paths:
+                    candidates.append((filename, path, None))
+    return candidates
+
+# Trả về (hosts, problems):
+#   hosts    {(host, port, vps_prefix): [package]}, package như ktb_uploader.make_job_package (rút gọn)
+#   problems [(filename, lý do)]
+def build_plan(candidates, router):
+    hosts = {}
+    problems = []
+    for filename, local_zip_path, source_folder in candidates:
+        route = router.match(filename)
+        if not route:
+            problems.append((filename, "khong khop prefix nao trong config.json"))
+            continue
+        if not route['host'] or not route['port']:
+            problems.append((filename, f"thieu {route['vps_prefix']}_VPS_HOST/PORT trong .env"))
+            continue
+        if not route['wp_author']:
+            problems.append((filename, "thieu 'wp_author' (site) va 'default_user_author'"))
+            continue
+        hosts.setdefault((route['host'], route['port'], route['vps_prefix']), []).append({
+            "original_filename": filename,
+            "local_zip_path": local_zip_path,
+            "source_folder": source_folder,
+            "priority": route['site'].get('upload_priority', 0),
+        })
+    return hosts, problems
+
+# {host: (byte/s, số lượt)} từ HISTORY_RUNS event 'host' gần nhất của từng host.
+# byte/s = tổng bytes / tổng seconds (thời gian thực của cả lượt, đã gồm overhead SSH, mv...).
+def load_host_rates(metrics_file, runs=HISTORY_RUNS):
+    history = {}
+    try:
+        with open(metrics_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('event') == 'host' and record.get('bytes') and record.get('seconds'):
+                    history.setdefault(record['host'], deque(maxlen=runs)).append((record['bytes'], record['seconds']))
+    except (OSError, TypeError):
+        return {}
+    return {host: (sum(b for b, _ in entries) / sum(s for _, s in entries), len(entries))
+            for host, entries in history.items()}
+
+# (byte/s, nguồn) dùng để ước lượng cho 1 host
+def host_rate(host, rates, limiter, active_hosts):
+    if host in rates:
+        rate, runs = rates[host]
+        source = f"lich su {runs} luot"
+    elif rates:
+        # Host chưa có lịch sử -> tốc độ trung bình của các host khác
+        rate = sum(r for r, _ in rates.values()) / len(rates)
+        source = "TB cac host khac"
+    else:
+        rate, source = None, "chua co lich su"
+    cap = limiter.host_rate(active_hosts) if limiter else None
+    if cap and (rate is None or cap < rate):
+        rate, source = cap, "tran bang thong"
+    return rate, source
+
+# Thời gian xong cả lượt khi chạy tối đa `workers` host cùng lúc (host dài nhất xếp trước)
+def wall_clock(durations, workers):
+    loads = [0.0] * max(1, workers)
+    for seconds in sorted(durations, reverse=True):
+        loads[loads.index(min(loads))] += seconds
+    return max(loads)
+
+def print_plan(hosts, problems, config, show_files=False):
+    rates = load_host_rates(config.get('metrics_file'))
+    limiter = make_bandwidth_limiter(config)
+    workers = max(1, int(config.get('max_parallel_hosts', 1)))
+    active_hosts = min(len(hosts), workers)
+
+    print("\n📋 Ke hoach upload (chi doc: khong di chuyen file, khong ket noi VPS):")
+    total_files = 0
+    total_bytes = 0
+    durations = []
+    unknown = 0
+    for (host, port, vps_prefix), packages in hosts.items():
+        num_bytes = sum(package_size(package) for package in packages)
+        total_files += len(packages)
+        total_bytes += num_bytes
+        rate, source = host_rate(host, rates, limiter, active_hosts)
+        if rate:
+            durations.append(num_bytes / rate)
+            eta = f"~{rate / (1024 * 1024):.1f} MB/s ({source}) -> ~{format_eta(num_bytes / rate)}"
+        else:
+            unknown += 1
+            eta = f"? ({source})"
+        print(f"   [{host}] {vps_prefix}: {len(packages)} file, {num_bytes / (1024 * 1024):.1f} MB, {eta}")
+
+    if problems:
+        print(f"\n⚠️  {len(problems)} file se KHONG duoc upload:")
+        for filename, reason in problems:
+            print(f"   - {filename}: {reason}")
+
+    summary = (f"\n📊 Tong: {total_files} file, {total_bytes / (1024 * 1024):.1f} MB, {len(hosts)} host"
+               f" (toi da {workers} host cung luc)")
+    if durations:
+        summary += f" -> xong ~{format_eta(wall_clock(durations, workers))}"
+        if unknown:
+            summary += f" (chua tinh {unknown} host chua co lich su)"
+    print(summary)
+
+    if show_files and hosts:
+        print_schedule(hosts, {"upload_order": config.get('upload_order'), "bandwidth": limiter,
+                               "max_parallel_hosts": workers})
+    return total_files, total_bytes
@@ -0,0 +1,87 @@
+import os
+import json
+from dotenv import load_dotenv
+
+# --- Định tuyến tên file/folder -> site -> VPS, dùng chung cho 4 script ---
+# Đọc config.json và .env 1 lần, dựng trie theo prefix của các site.
+# Tra cứu = prefix dài nhất khớp với tên (vd: 'ktbteeshop.x.zip' -> site 'ktbteeshop'
+# chứ không phải 'ktbtee'), chi phí theo độ dài tên, không theo số site.
+
+CONFIG_FILE = 'config.json'
+
+# Route của 1 site: dict gồm site (config gốc), prefix, vps_prefix, host, port,
+# wp_path, wp_author. host/port = None nếu .env thiếu hoặc port không hợp lệ.
+def make_route(site, default_author=None):
+    vps_prefix = site['vps_secret_prefix']
+    host = os.getenv(f"{vps_prefix}_VPS_HOST")
+    port = os.getenv(f"{vps_prefix}_VPS_PORT")
+    try:
+        port = int(port) if port else None
+    except ValueError:
+        port = None
+    return {
+        "site": site,
+        "prefix": site['prefix'],
+        "vps_prefix": vps_prefix,
+        "host": host or None,
+        "port": port,
+        "wp_path": site.get('wp_path'),
+        "wp_author": site.get('wp_author') or default_author,
+    }
+
+class SiteRouter:
+    def __init__(self, sites, default_author=None):
+        self.trie = {}
+        self.routes = {}   # prefix -> route (theo thứ tự trong config)
+        for site in sites:
+            route = make_route(site, default_author)
+            # Trùng prefix: giữ site khai báo trước, như next(...) trước đây
+            if route["prefix"] in self.routes:
+                continue
+            self.routes[route["prefix"]] = route
+            node = self.trie
+            for char in route["prefix"]:
+                node = node.setdefault(char, {})
+            node[None] = route
+
+    # Route có prefix dài nhất là tiền tố của name, hoặc None
+    def match(self, name):
+        node = self.trie
+        found = node.get(None)
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def match_site(self, name):
+        route = self.match(name)
+        return route["site"] if route else None
+
+    # Route có đúng prefix này (không so tiền tố), hoặc None
+    def route_for_prefix(self, prefix):
+        return self.routes.get(prefix)
+
+    # {vps_prefix: (host, port)} của các VPS có đủ HOST/PORT trong .env
+    def hosts(self):
+        result = {}
+        for route in self.routes.values():
+            if route["host"] and route["port"]:
+                result.setdefault(route["vps_prefix"], (route["host"], route["port"]))
+        return result
+
+    # {host: {khóa: giá trị}} từ 'host_overrides' trong config.json ({vps_secret_prefix: {khóa: giá trị}}),
+    # dùng để ghi đè 1 số tùy chọn upload cho riêng 1 VPS (xem ktb_uploader.host_option)
+    def host_options(self, overrides):
+        hosts = self.hosts()
+        return {hosts[vps_prefix][0]: dict(values) for vps_prefix, values in (overrides or {}).items()
+                if vps_prefix in hosts}
+
+# Đọc .env + config.json và dựng router. Trả về (config, router).
+# Ném FileNotFoundError / ValueError như json.load để script tự báo lỗi.
+def load_routing(config_file=CONFIG_FILE):
+    load_dotenv()
+    with open(config_file, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    return config, SiteRouter(config.get('sites', []), config.get('default_user_author'))
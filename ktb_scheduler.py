@@ -0,0 +1,161 @@
+import os
+import time
+import threading
+
+# --- Thứ tự upload + giới hạn băng thông ---
+# upload_order (config.json), mặc định "fifo" (như trước khi có scheduler); đổi sang
+# "size" hoặc "priority" để bật sắp xếp:
+#   "fifo"     : giữ nguyên thứ tự quét file
+#   "size"     : file nhỏ trước (job nhỏ lên web sớm, zip lớn không chặn cả hàng)
+#   "priority" : 'upload_priority' của site (lớn hơn = trước), cùng mức thì file nhỏ trước
+# bandwidth_per_host_mbps / bandwidth_total_mbps: trần Mbit/s cho mỗi VPS và cho
+# toàn bộ uplink (0 = không giới hạn). Áp dụng cho mọi byte zip gửi đi, kể cả streaming.
+
+UPLOAD_ORDERS = ('fifo', 'size', 'priority')
+
+def folder_size(folder_path):
+    total = 0
+    for dirpath, _, filenames in os.walk(folder_path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+# Kích thước dự kiến của job (zip local, hoặc tổng dung lượng folder nếu streaming).
+# Lưu vào package['size_bytes'] để không phải tính lại.
+def package_size(package):
+    if 'size_bytes' not in package:
+        try:
+            if package.get('source_folder'):
+                package['size_bytes'] = folder_size(package['source_folder'])
+            else:
+                package['size_bytes'] = os.path.getsize(package['local_zip_path'])
+        except OSError:
+            package['size_bytes'] = 0
+    return package['size_bytes']
+
+# upload_order đã kiểm tra (mặc định fifo). Giá trị lạ -> ValueError, không âm thầm chạy fifo.
+def check_upload_order(order):
+    order = order or 'fifo'
+    if order not in UPLOAD_ORDERS:
+        raise ValueError(f"upload_order khong hop le: '{order}' (chon 1 trong: {', '.join(UPLOAD_ORDERS)})")
+    return order
+
+# Trả về bản sao file_list đã sắp theo upload_order (sort ổn định: cùng khóa giữ thứ tự cũ)
+def schedule_jobs(file_list, opts):
+    order = check_upload_order(opts.get('upload_order'))
+    if order == 'size':
+        return sorted(file_list, key=package_size)
+    if order == 'priority':
+        return sorted(file_list, key=lambda package: (-package.get('priority', 0), package_size(package)))
+    return list(file_list)
+
+# --- Hoãn job theo tình trạng VPS (kết quả pre-flight, xem ktb_uploader.preflight_host) ---
+# Nhận job theo đúng thứ tự file_list trong khi còn chỗ trong hàng đợi (max_jobs - queue_depth)
+# và còn dung lượng (free_bytes - min_free_bytes); job không vừa thì hoãn, job nhỏ hơn phía sau
+# vẫn được xét. Zip chia phần (>= split_threshold) cần gấp đôi chỗ lúc ghép trên VPS.
+# max_jobs / min_free_bytes = 0, hoặc free_bytes = None (không đọc được) -> không giới hạn theo mục đó.
+# Trả về (job được upload, [(job bị hoãn, lý do)]).
+def admit_jobs(file_list, queue_depth, free_bytes, max_jobs=0, min_free_bytes=0, split_threshold=0):
+    slots = max(0, max_jobs - queue_depth) if max_jobs else None
+    budget = free_bytes - min_free_bytes if min_free_bytes and free_bytes is not None else None
+    admitted, deferred = [], []
+    for package in file_list:
+        if slots is not None and len(admitted) >= slots:
+            deferred.append((package, f"hang doi VPS da co {queue_depth} job, gioi han {max_jobs}"))
+            continue
+        needed = package_size(package)
+        if split_threshold and not package.get('source_folder') and needed >= split_threshold:
+            needed *= 2
+        if budget is not None and needed > budget:
+            deferred.append((package, f"VPS con trong {free_bytes / (1024 * 1024):.0f} MB, can "
+                                      f"{needed / (1024 * 1024):.0f} MB + {min_free_bytes / (1024 * 1024):.0f} MB du phong"))
+            continue
+        if budget is not None:
+            budget -= needed
+        admitted.append(package)
+    return admitted, deferred
+
+class TokenBucket:
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        # Cho phép dồn tối đa 1 giây băng thông khi rảnh
+        self.capacity = bytes_per_second
+        self.tokens = bytes_per_second
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Trừ n byte; nếu "nợ" thì ngủ đến khi đủ. Thread gọi trước trả nợ trước -> chia đều giữa các luồng.
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class BandwidthLimiter:
+    def __init__(self, per_host_bps=0, total_bps=0):
+        self.per_host_bps = per_host_bps
+        self.total = TokenBucket(total_bps) if total_bps else None
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    # Hàm throttle(n_bytes) cho 1 host: trừ cả trần của host và trần tổng
+    def for_host(self, host):
+        with self.lock:
+            if self.per_host_bps and host not in self.hosts:
+                self.hosts[host] = TokenBucket(self.per_host_bps)
+            host_bucket = self.hosts.get(host)
+
+        def throttle(n):
+            if host_bucket is not None:
+                host_bucket.consume(n)
+            if self.total is not None:
+                self.total.consume(n)
+        return throttle
+
+    # Tốc độ tối đa (byte/s) 1 host đạt được khi active_hosts host cùng upload, None = không giới hạn
+    def host_rate(self, active_hosts=1):
+        rates = []
+        if self.per_host_bps:
+            rates.append(self.per_host_bps)
+        if self.total is not None:
+            rates.append(self.total.rate / max(1, active_hosts))
+        return min(rates) if rates else None
+
+def mbps_to_bps(mbps):
+    return float(mbps or 0) * 1000 * 1000 / 8
+
+# None nếu không đặt trần nào
+def make_bandwidth_limiter(config):
+    per_host = mbps_to_bps(config.get('bandwidth_per_host_mbps'))
+    total = mbps_to_bps(config.get('bandwidth_total_mbps'))
+    if not per_host and not total:
+        return None
+    return BandwidthLimiter(per_host, total)
+
+def format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m{seconds:02d}s" if minutes else f"{seconds}s"
+
+# In thứ tự hoàn thành dự kiến của từng host trước khi upload.
+# Có trần băng thông thì kèm thời điểm xong ước tính (bỏ qua overhead SSH và nhiều kênh SFTP).
+def print_schedule(files_by_host, opts):
+    limiter = opts.get('bandwidth')
+    active_hosts = min(len(files_by_host), max(1, int(opts.get('max_parallel_hosts', 1))))
+    rate = limiter.host_rate(active_hosts) if limiter else None
+    print(f"\n📋 Thu tu upload du kien ({check_upload_order(opts.get('upload_order'))}"
+          + (f", ~{rate * 8 / 1000 / 1000:.1f} Mbps/host" if rate else "") + "):")
+    for host_key, file_list in files_by_host.items():
+        host = host_key[0]
+        done_bytes = 0
+        for position, package in enumerate(schedule_jobs(file_list, opts), 1):
+            size = package_size(package)
+            done_bytes += size
+            eta = f", xong ~{format_eta(done_bytes / rate)}" if rate else ""
+            print(f"   [{host}] {position}. {package['original_filename']} ({size / (1024 * 1024):.1f} MB{eta})")
@@ -0,0 +1,198 @@
+import os
+import io
+import sys
+import json
+import time
+import getpass
+import argparse
+from datetime import datetime
+
+# --- Tự chọn thông số SSH transport nhanh nhất cho từng VPS ---
+# Mặc định paramiko: window 2 MB, packet 32 KB, không nén, cipher theo thứ tự ưu tiên của paramiko.
+# Với VPS xa (RTT cao) bộ mặc định có thể giới hạn tốc độ 1 luồng dưới mức đường truyền.
+#   python ktb.py tune-ssh [--admin] [--sample-mb 16] [--host 1.2.3.4]
+# upload 1 file mẫu (dữ liệu ngẫu nhiên: không nén được, giống zip ảnh) vào remote_queue_dir với
+# từng ứng viên, tìm theo từng trục (cipher -> window -> packet -> nén): giữ bộ tốt nhất hiện tại,
+# đổi 1 thông số, chỉ nhận nếu nhanh hơn ít nhất MIN_GAIN. Kết quả lưu vào 'ssh_tuning_file'
+# (mặc định ssh_tuning.json): {"host:port": {cipher, window_size, max_packet_size, compress, mbps, ...}}.
+# connect_host (ktb_uploader.py) và ktb_broker.py tự áp dụng profile ở các lần kết nối sau.
+# --admin: xác thực bằng SSH_KEY_PATH như ktb-admin-upload.py, mặc định hỏi mật khẩu như ktb-user-upload.py.
+
+PROFILE_FILE = 'ssh_tuning.json'
+DEFAULT_SAMPLE_MB = 16
+MIN_GAIN = 0.05
+
+# Cipher paramiko không hỗ trợ hoặc VPS không bật sẽ bị bỏ qua khi đo
+CANDIDATE_CIPHERS = ("aes128-ctr", "aes256-ctr", "aes128-gcm@openssh.com", "aes256-gcm@openssh.com")
+CANDIDATE_WINDOWS = (2 * 1024 * 1024, 8 * 1024 * 1024, 32 * 1024 * 1024)
+CANDIDATE_PACKETS = (32 * 1024, 64 * 1024, 128 * 1024)
+CANDIDATE_COMPRESS = (False, True)
+
+# --- Dùng profile khi kết nối ---
+
+def load_profile(path):
+    try:
+        with open(path or PROFILE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_profile(path, profile):
+    part_path = f"{path}.part"
+    with open(part_path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, ensure_ascii=False, indent=1)
+    os.replace(part_path, path)
+
+def profile_key(host, port):
+    return f"{host}:{port}"
+
+# Transport có window / packet / cipher ưu tiên theo settings. Cipher chỉ được đưa lên đầu danh sách
+# (không tắt các cipher khác) nên VPS đổi cấu hình cũng không làm hỏng kết nối.
+def make_transport_factory(settings):
+    import paramiko
+
+    def factory(sock, **kwargs):
+        transport = paramiko.Transport(
+            sock,
+            default_window_size=int(settings.get('window_size') or paramiko.common.DEFAULT_WINDOW_SIZE),
+            default_max_packet_size=int(settings.get('max_packet_size') or paramiko.common.DEFAULT_MAX_PACKET_SIZE),
+            **kwargs)
+        cipher = settings.get('cipher')
+        options = transport.get_security_options()
+        if cipher and cipher in options.ciphers:
+            options.ciphers = (cipher,) + tuple(c for c in options.ciphers if c != cipher)
+        return transport
+    return factory
+
+# Tham số thêm cho SSHClient.connect theo profile của host ({} nếu host chưa được tune)
+def connect_options(profile, host, port):
+    settings = (profile or {}).get(profile_key(host, port))
+    if not settings:
+        return {}
+    return {"transport_factory": make_transport_factory(settings), "compress": bool(settings.get('compress'))}
+
+# --- Chế độ tune ---
+
+def measure(host, port, username, auth, settings, remote_path, sample):
+    from ktb_uploader import new_ssh_client
+    ssh = new_ssh_client()
+    ssh.connect(host, port=port, username=username, timeout=10, compress=settings['compress'],
+                transport_factory=make_transport_factory(settings), **auth)
+    try:
+        cipher = ssh.get_transport().local_cipher
+        sftp = ssh.open_sftp()
+        started = time.perf_counter()
+        sftp.putfo(io.BytesIO(sample), remote_path)
+        seconds = time.perf_counter() - started
+        sftp.remove(remote_path)
+        sftp.close()
+    finally:
+        ssh.close()
+    return cipher, len(sample) / seconds
+
+def format_settings(settings):
+    return (f"{settings['cipher']}, window {settings['window_size'] // 1024} KB, packet {settings['max_packet_size'] // 1024} KB, "
+            f"{'nen' if settings['compress'] else 'khong nen'}")
+
+def tune_host(host, port, username, auth, remote_queue_dir, sample):
+    import paramiko
+    remote_path = f"{remote_queue_dir}/.ktb_tune_{os.getpid()}.bin"
+    # Danh sách cipher paramiko hỗ trợ chỉ có ở thuộc tính nội bộ; bản paramiko khác không có thì thử
+    # hết CANDIDATE_CIPHERS (cipher không thỏa thuận được sẽ bị bỏ ở bước đo, xem bên dưới)
+    supported = getattr(paramiko.Transport, '_preferred_ciphers', None) or CANDIDATE_CIPHERS
+    best = {"cipher": None, "window_size": paramiko.common.DEFAULT_WINDOW_SIZE,
+            "max_packet_size": paramiko.common.DEFAULT_MAX_PACKET_SIZE, "compress": False}
+
+    # Lượt đầu: mặc định paramiko (cipher thỏa thuận được ghi lại làm mốc)
+    best["cipher"], best_rate = measure(host, port, username, auth, best, remote_path, sample)
+    baseline = best_rate
+    print(f"   Mac dinh: {format_settings(best)} -> {best_rate / (1024 * 1024):.1f} MB/s")
+
+    axes = (("cipher", [c for c in CANDIDATE_CIPHERS if c in supported]), ("window_size", CANDIDATE_WINDOWS),
+            ("max_packet_size", CANDIDATE_PACKETS), ("compress", CANDIDATE_COMPRESS))
+    for key, candidates in axes:
+        for value in candidates:
+            if value == best[key]:
+                continue
+            trial = dict(best, **{key: value})
+            try:
+                cipher, rate = measure(host, port, username, auth, trial, remote_path, sample)
+            except paramiko.AuthenticationException:
+                raise
+            except Exception as e:
+                print(f"   ⚠️ {format_settings(trial)}: {e}")
+                continue
+            if key == "cipher" and cipher != value:
+                # VPS không bật cipher này -> đã thỏa thuận cipher khác, bỏ kết quả
+                print(f"   - {value}: VPS khong ho tro")
+                continue
+            better = rate > best_rate * (1 + MIN_GAIN)
+            print(f"   {'+' if better else '-'} {format_settings(trial)} -> {rate / (1024 * 1024):.1f} MB/s")
+            if better:
+                best, best_rate = trial, rate
+
+    return dict(best, mbps=round(best_rate * 8 / 1000 / 1000, 2), baseline_mbps=round(baseline * 8 / 1000 / 1000, 2),
+                sample_mb=round(len(sample) / (1024 * 1024), 1), tuned_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Do toc do upload voi tung bo thong so SSH va luu bo nhanh nhat cho moi VPS")
+    parser.add_argument('--admin', action='store_true', help="Xac thuc bang SSH key (SSH_KEY_PATH) thay vi mat khau")
+    parser.add_argument('--sample-mb', type=float, help=f"Kich thuoc file mau (mac dinh: ssh_tune_sample_mb hoac {DEFAULT_SAMPLE_MB})")
+    parser.add_argument('--host', action='append', help="Chi tune host nay (co the lap lai)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    from ktb_router import load_routing
+    try:
+        config, router = load_routing()
+    except FileNotFoundError:
+        print("[LOI] Khong tim thay file cau hinh config.json.")
+        sys.exit(1)
+
+    username = os.getenv("VPS_USERNAME")
+    remote_queue_dir = config.get('remote_queue_dir')
+    if not username or not remote_queue_dir:
+        print("❌ Loi: Kiem tra thieu 'remote_queue_dir' trong config.json hoac 'VPS_USERNAME' trong .env")
+        sys.exit(1)
+    hosts = sorted(set(router.hosts().values()))
+    if args.host:
+        hosts = [(host, port) for host, port in hosts if host in args.host]
+    if not hosts:
+        print("Khong co VPS nao (kiem tra <PREFIX>_VPS_HOST/PORT trong .env).")
+        return
+
+    if args.admin:
+        from ktb_uploader import get_ssh_key
+        auth = {"pkey": get_ssh_key()}
+    else:
+        try:
+            password = getpass.getpass(f"Nhap Mat khau VPS cho user '{username}' (se bi an): ")
+        except EOFError:
+            print("\nDa huy bo.")
+            sys.exit(1)
+        auth = {"password": password, "disabled_algorithms": {'publickey': []}}
+
+    sample_mb = args.sample_mb or config.get('ssh_tune_sample_mb') or DEFAULT_SAMPLE_MB
+    sample = os.urandom(int(float(sample_mb) * 1024 * 1024))
+    profile_path = config.get('ssh_tuning_file') or PROFILE_FILE
+    profile = load_profile(profile_path)
+
+    import paramiko
+    for host, port in hosts:
+        print(f"\n[{host}] 🔧 Tune SSH ({sample_mb} MB moi lan do)...")
+        try:
+            settings = tune_host(host, port, username, auth, remote_queue_dir, sample)
+        except paramiko.AuthenticationException:
+            print(f"[{host}] ❌ Xac thuc that bai -> Bo qua.")
+            continue
+        except Exception as e:
+            print(f"[{host}] ❌ Khong do duoc: {e}")
+            continue
+        profile[profile_key(host, port)] = settings
+        save_profile(profile_path, profile)
+        print(f"[{host}] ✅ {format_settings(settings)}: {settings['mbps']} Mbps (mac dinh {settings['baseline_mbps']} Mbps)")
+    print(f"\n💾 Profile: {profile_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import os
+import time
+import queue
+import threading
+
+# --- Gửi báo cáo Telegram chạy nền ---
+# Upload không bao giờ chờ Telegram: send()/progress() chỉ đưa vào hàng đợi, 1 thread
+# nền gửi lần lượt, tự chia tin > 4096 ký tự, thử lại với backoff khi lỗi mạng / 429 / 5xx.
+# TELEGRAM_API_BASE (.env) cho phép trỏ tới server HTTP giả lập khi kiểm thử.
+# 'requests' chỉ được nạp trong thread gửi (lần gửi đầu tiên), không làm chậm lúc khởi động.
+
+TELEGRAM_MAX_LENGTH = 4096
+# Báo cáo dài hơn số tin này -> gộp các dòng [OK] thành 1 dòng tổng, giữ nguyên dòng lỗi
+TELEGRAM_MAX_PARTS = 5
+TELEGRAM_RETRIES = 5
+TELEGRAM_MAX_BACKOFF = 60
+
+def telegram_api_base():
+    return os.getenv('TELEGRAM_API_BASE', 'https://api.telegram.org').rstrip('/')
+
+# Chia text thành các đoạn <= limit ký tự, ưu tiên cắt ở đầu dòng
+def split_message(text, limit=TELEGRAM_MAX_LENGTH):
+    parts = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            parts.append(current)
+            current = ""
+        current += line
+    if current:
+        parts.append(current)
+    return [part for part in parts if part.strip()]
+
+def summarize_report(text, limit=TELEGRAM_MAX_LENGTH, max_parts=TELEGRAM_MAX_PARTS):
+    if len(split_message(text, limit)) <= max_parts:
+        return text
+    lines = text.splitlines()
+    ok_count = sum(1 for line in lines if line.startswith("[OK]"))
+    kept = []
+    for line in lines:
+        if not line.startswith("[OK]"):
+            kept.append(line)
+        elif ok_count:
+            # Dòng tổng đặt ở vị trí dòng [OK] đầu tiên
+            kept.append(f"[OK] {ok_count} file (an chi tiet do bao cao qua dai)")
+            ok_count = 0
+    return "\n".join(kept)
+
+class TelegramNotifier:
+    def __init__(self, bot_token, chat_id, progress_seconds=0, label="Telegram"):
+        self.enabled = bool(bot_token and chat_id)
+        if not self.enabled:
+            print("[LOI] Thieu TELEGRAM_BOT_TOKEN hoac TELEGRAM_CHAT_ID trong .env")
+        self.url = f"{telegram_api_base()}/bot{bot_token}/sendMessage"
+        self.chat_id = chat_id
+        self.label = label
+        self.progress_seconds = float(progress_seconds or 0)
+        self.messages = queue.Queue()
+        self.progress_lock = threading.Lock()
+        self.progress_lines = {}     # host -> dòng tiến độ mới nhất
+        self.progress_dirty = False
+        self.last_progress = 0.0
+        self.thread = None
+        if self.enabled:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    # Xếp báo cáo vào hàng đợi (không chặn)
+    def send(self, text):
+        if self.enabled:
+            for part in split_message(summarize_report(text)):
+                self.messages.put(part)
+
+    # Cập nhật tiến độ của 1 host; gửi gộp tất cả host, tối đa 1 tin mỗi progress_seconds
+    def progress(self, host, line):
+        if not self.enabled or not self.progress_seconds:
+            return
+        with self.progress_lock:
+            self.progress_lines[host] = line
+            self.progress_dirty = True
+
+    # Chờ gửi hết hàng đợi (gọi 1 lần khi script kết thúc)
+    def close(self, timeout=120):
+        if self.thread is None:
+            return
+        self.messages.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print(f"⚠️  {self.label}: Het {timeout}s ma chua gui xong bao cao, bo qua.")
+
+    def _take_progress(self):
+        with self.progress_lock:
+            if not self.progress_dirty or time.time() - self.last_progress < self.progress_seconds:
+                return None
+            self.progress_dirty = False
+            self.last_progress = time.time()
+            lines = [f"[{host}] {line}" for host, line in self.progress_lines.items()]
+        return "⏳ Tien do upload:\n" + "\n".join(lines)
+
+    def _run(self):
+        while True:
+            try:
+                message = self.messages.get(timeout=1)
+            except queue.Empty:
+                message = self._take_progress()
+                if message:
+                    self._post(message)
+                continue
+            if message is None:
+                return
+            self._post(message)
+
+    def _post(self, text):
+        import requests
+        delay = 1
+        for attempt in range(1, TELEGRAM_RETRIES + 1):
+            try:
+                response = requests.post(self.url, json={'chat_id': self.chat_id, 'text': text}, timeout=10)
+                if response.status_code == 429:
+                    # Telegram báo số giây phải chờ trong parameters.retry_after
+                    try:
+                        delay = max(delay, int(response.json()['parameters']['retry_after']))
+                    except (ValueError, KeyError, TypeError):
+                        pass
+                    raise requests.exceptions.RequestException("429 Too Many Requests")
+                if 400 <= response.status_code < 500:
+                    # Lỗi phía request (sai token/chat_id...) -> thử lại cũng vô ích
+                    print(f"❌ {self.label}: Telegram tu choi tin nhan ({response.status_code}): {response.text[:200]}")
+                    return False
+                response.raise_for_status()
+                return True
+            except requests.exceptions.RequestException as e:
+                if attempt == TELEGRAM_RETRIES:
+                    print(f"❌ {self.label}: Khong the gui tin nhan sau {attempt} lan: {e}")
+                    return False
+                print(f"⚠️  {self.label}: Gui that bai ({e}), thu lai sau {delay}s...")
+                time.sleep(delay)
+                delay = min(delay * 2, TELEGRAM_MAX_BACKOFF)
+        return False
+
+def make_notifier(config, label="Telegram"):
+    return TelegramNotifier(os.getenv('TELEGRAM_BOT_TOKEN'), os.getenv('TELEGRAM_CHAT_ID'),
+                            config.get('telegram_progress_seconds', 0), label)
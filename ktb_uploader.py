@@ -0,0 +1,1002 @@
+import os
+import json
+import time
+import errno
+import random
+import socket
+import shlex
+import hashlib
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import paramiko
+from paramiko.sftp import CMD_EXTENDED, CMD_EXTENDED_REPLY
+from ktb_zip import StreamWriter, write_folder_zip, VALID_IMG_EXTS
+from ktb_image_index import load_zip_hashes, clear_zip_hashes, open_image_index
+from ktb_broker import attach_broker
+from ktb_ssh_tune import connect_options, load_profile
+from ktb_journal import new_job_id
+from ktb_scheduler import schedule_jobs, admit_jobs, print_schedule, make_bandwidth_limiter, check_upload_order
+from ktb_metrics import NULL_METRICS
+
+# --- Logic upload dùng chung cho ktb-admin-upload.py và ktb-user-upload.py ---
+# opts là dict cấu hình dựng 1 lần bằng build_upload_opts(config, router); mỗi script chỉ thêm/ghi đè
+# username, pkey/password, auth_label, ok_label, local_tmp_dir, delete_local, progress, metrics, journal:
+#   username, pkey, password, auth_label, remote_queue_dir, local_tmp_dir,
+#   ok_label, delete_local, max_parallel_hosts, sftp_channels_per_host,
+#   resumable_uploads, zip_store_exts, image_index (ktb_image_index.ImageIndex hoặc None),
+#   batch_commit, keepalive_seconds, ssh_broker_port (xem ktb_broker.py),
+#   upload_order, bandwidth (ktb_scheduler.BandwidthLimiter hoặc None),
+#   progress (hàm progress(host, dòng) không chặn, vd: ktb_telegram.TelegramNotifier.progress),
+#   metrics (ktb_metrics.MetricsRecorder: thời gian từng phase, bytes, MB/s theo job/host),
+#   upload_retries, retry_backoff_seconds, retry_backoff_max_seconds,
+#   split_threshold_mb, split_part_mb, split_channels (zip lớn chia nhiều phần, xem put_split),
+#   remote_queue_max_jobs, remote_min_free_mb (pre-flight, xem preflight_host),
+#   ssh_tuning (profile của ktb_ssh_tune.py: cipher / window / packet / nén theo host),
+#   journal (ktb_journal.JobJournal hoặc None: ghi trạng thái các package có journal_id),
+#   host_options ({host: {khóa: giá trị}} ghi đè các khóa trên cho từng host, xem host_option)
+# package: original_filename, local_zip_path, meta_content, unique_job_dir_name, priority,
+#   source_folder (chỉ có ở streaming mode: nén folder thẳng vào file SFTP, local_zip_path = None),
+#   retry (True khi job được thử lại sau lỗi tạm thời, hoặc tiếp tục job dở dang theo nhật ký),
+#   journal_id (job_id trong ktb_journal.JobJournal, nếu có)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Phần opts chung của mọi script, đọc từ config.json (+ host_overrides theo router).
+# Mở image_index: script tự đóng (opts['image_index'].close()) khi xong.
+def build_upload_opts(config, router):
+    channels = config.get('sftp_channels_per_host', 1)
+    return {
+        "remote_queue_dir": config.get('remote_queue_dir'),
+        "max_parallel_hosts": config.get('max_parallel_hosts', 1),
+        "sftp_channels_per_host": channels,
+        "resumable_uploads": config.get('resumable_uploads', False),
+        "batch_commit": config.get('batch_commit', False),
+        "zip_store_exts": config.get('zip_store_exts'),
+        "ssh_broker_port": config.get('ssh_broker_port'),
+        "upload_order": check_upload_order(config.get('upload_order')),
+        "upload_retries": config.get('upload_retries', 0),
+        "retry_backoff_seconds": config.get('retry_backoff_seconds', 2),
+        "retry_backoff_max_seconds": config.get('retry_backoff_max_seconds', 60),
+        "split_threshold_mb": config.get('split_threshold_mb', 0),
+        "split_part_mb": config.get('split_part_mb', 64),
+        "split_channels": config.get('split_channels', channels),
+        "remote_queue_max_jobs": config.get('remote_queue_max_jobs', 0),
+        "remote_min_free_mb": config.get('remote_min_free_mb', 0),
+        "host_options": router.host_options(config.get('host_overrides')),
+        "ssh_tuning": load_profile(config.get('ssh_tuning_file')),
+        "bandwidth": make_bandwidth_limiter(config),
+        "image_index": open_image_index(config.get('image_index_db')),
+    }
+
+def log(host, message):
+    # Gắn tên host vào đầu dòng để log các host chạy song song không bị lẫn
+    print(f"[{host}] {message}")
+
+# --- Phân loại lỗi + backoff ---
+# Tạm thời (mất kết nối, timeout, checksum lệch...) -> kết nối lại và thử lại job.
+# Vĩnh viễn (sai mật khẩu, không có quyền, đường dẫn sai, VPS đầy đĩa, mv lỗi...) -> báo lỗi luôn.
+
+class TransientError(Exception):
+    pass
+
+TRANSIENT_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.ECONNREFUSED, errno.EPIPE,
+                    errno.ETIMEDOUT, errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENETDOWN)
+
+# ssh: kết nối đang dùng khi lỗi xảy ra (nếu có), để phân biệt lỗi SFTP với mất kết nối
+def is_transient_error(e, ssh=None):
+    if isinstance(e, (paramiko.AuthenticationException, paramiko.BadHostKeyException)):
+        return False
+    if isinstance(e, (TransientError, EOFError, socket.timeout, ConnectionError, paramiko.SSHException)):
+        return True
+    if isinstance(e, OSError):
+        if e.errno is not None:
+            return e.errno in TRANSIENT_ERRNOS
+        # paramiko ném IOError(text) không errno cho mọi status SFTP khác ENOENT/EACCES
+        # (SSH_FX_FAILURE: đầy đĩa, quota, thư mục đã có...) -> lỗi thật, trừ khi chính kết nối đã chết
+        return str(e) == "Socket is closed" or (ssh is not None and not transport_alive(ssh))
+    return False
+
+# Exponential backoff + jitter (attempt bắt đầu từ 1)
+def backoff_delay(attempt, opts):
+    base = float(opts.get('retry_backoff_seconds', 2))
+    cap = float(opts.get('retry_backoff_max_seconds', 60))
+    return random.uniform(0.5, 1.0) * min(cap, base * 2 ** (attempt - 1))
+
+# Ghi trạng thái job vào nhật ký (chỉ với package đến từ nhật ký, xem ktb_journal.py)
+def journal_state(opts, package, state, error=None, **fields):
+    if opts.get('journal') is not None and package.get('journal_id'):
+        opts['journal'].set_state(package['journal_id'], state, error, **fields)
+
+# Tùy chọn của 1 host: host_options[host] ghi đè opts (xem ktb_router.SiteRouter.host_options)
+def host_option(opts, host, key, default=None):
+    return (opts.get('host_options') or {}).get(host, {}).get(key, opts.get(key, default))
+
+# Dựng package cho 1 job (meta.json gửi kèm + tên thư mục job trên VPS).
+# job_id: tên thư mục job trên VPS (mặc định tạo mới, xem ktb_journal.new_job_id).
+def make_job_package(filename, local_zip_path, site_config, wp_author, telegram_bot_token, telegram_chat_id,
+                     source_folder=None, job_id=None):
+    meta_content = {
+        "wp_author": wp_author,
+        "wp_path": site_config['wp_path'],
+        "zip_filename": filename,
+        "prefix": site_config['prefix'],
+        "telegram_bot_token": telegram_bot_token,
+        "telegram_chat_id": telegram_chat_id
+    }
+    package = {
+        "original_filename": filename,
+        "local_zip_path": local_zip_path,
+        "meta_content": meta_content,
+        "unique_job_dir_name": job_id or new_job_id(filename, wp_author),
+        "priority": site_config.get('upload_priority', 0),
+    }
+    if source_folder:
+        package["source_folder"] = source_folder
+    return package
+
+# Lấy SSH Key từ SSH_KEY_PATH trong .env (admin upload và ktb_broker.py dùng chung)
+def get_ssh_key():
+    key_path = os.getenv("SSH_KEY_PATH")
+    
+    if not key_path:
+        raise ValueError("Thieu 'SSH_KEY_PATH' trong file .env")
+    
+    key_path = os.path.expanduser(key_path)
+    if os.name == 'nt': # Xử lý đường dẫn Windows
+        if key_path.startswith('/c/'): key_path = 'C:/' + key_path[3:]
+        elif key_path.startswith('/d/'): key_path = 'D:/' + key_path[3:]
+        # Thêm ổ đĩa khác nếu cần
+    
+    print(f"Su dung SSH Key tu duong dan: {key_path}")
+    if not os.path.exists(key_path):
+        raise FileNotFoundError(f"Khong tim thay file key tai: {key_path}")
+        
+    try: return paramiko.Ed25519Key.from_private_key_file(key_path)
+    except paramiko.ssh_exception.SSHException:
+        try: return paramiko.RSAKey.from_private_key_file(key_path)
+        except paramiko.ssh_exception.SSHException:
+            raise ValueError("Khong the tai key (Chi ho tro RSA/Ed25519)")
+
+# SSHClient dùng cho mọi kết nối trực tiếp (uploader, ktb_broker.py, ktb_ssh_tune.py):
+# known_hosts của hệ thống được nạp, VPS đã biết mà đổi host key -> BadHostKeyException, không kết nối.
+# VPS chưa có trong known_hosts vẫn được chấp nhận như trước.
+def new_ssh_client():
+    ssh = paramiko.SSHClient()
+    ssh.load_system_host_keys()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    return ssh
+
+def connect_host(host, port, opts):
+    # Broker đang chạy -> dùng lại SSH transport đã xác thực sẵn (không bắt tay lại)
+    ssh = attach_broker(host, port, opts)
+    if ssh is not None:
+        log(host, "♻️  Dung lai ket noi SSH tu broker.")
+        return ssh
+
+    ssh = new_ssh_client()
+    # Thông số transport đã tune cho host này (python ktb.py tune-ssh), chưa tune thì để mặc định
+    tuning = connect_options(opts.get('ssh_tuning'), host, port)
+    if opts.get('pkey') is not None:
+        ssh.connect(host, port=port, username=opts['username'], pkey=opts['pkey'], timeout=10, **tuning)
+    else:
+        # Chỉ dùng Password, tắt SSH Key
+        ssh.connect(
+            host,
+            port=port,
+            username=opts['username'],
+            password=opts['password'],
+            timeout=10,
+            disabled_algorithms={'publickey': []},
+            **tuning
+        )
+    return ssh
+
+# --- Resumable upload ---
+# Mặc định tắt; bật bằng "resumable_uploads": true trong config.json.
+# File trạng thái nằm cạnh file zip local, lưu tên job đã dùng cho host đó để
+# lần chạy sau quay lại đúng thư mục tmp_<job> và tiếp tục từ byte đã có.
+def resume_state_path(local_zip_path):
+    return f"{local_zip_path}.resume.json"
+
+def load_resume_job_dir(local_zip_path, host):
+    try:
+        with open(resume_state_path(local_zip_path), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        st = os.stat(local_zip_path)
+    except (OSError, ValueError):
+        return None
+    # File local đã đổi (kích thước/mtime) hoặc khác host -> bắt đầu lại job mới
+    if state.get('host') != host or state.get('size') != st.st_size or state.get('mtime') != int(st.st_mtime):
+        return None
+    return state.get('job_dir_name')
+
+def save_resume_state(local_zip_path, host, job_dir_name):
+    st = os.stat(local_zip_path)
+    state = {"host": host, "job_dir_name": job_dir_name, "size": st.st_size, "mtime": int(st.st_mtime)}
+    with open(resume_state_path(local_zip_path), 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+
+def clear_resume_state(local_zip_path):
+    try:
+        os.remove(resume_state_path(local_zip_path))
+    except FileNotFoundError:
+        pass
+
+# Kênh đóng mà không có exit status (paramiko trả -1) = mất kết nối giữa lệnh -> lỗi tạm thời
+def check_sha256_status(stdout, stderr):
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status == -1:
+        raise TransientError("Mat ket noi khi chay sha256sum tren VPS")
+    if exit_status != 0:
+        raise Exception(f"Loi tinh sha256 tren VPS: {stderr.read().decode()}")
+
+def remote_sha256(ssh, remote_path):
+    stdin, stdout, stderr = ssh.exec_command(f"sha256sum {shlex.quote(remote_path)}")
+    check_sha256_status(stdout, stderr)
+    return stdout.read().decode().split()[0]
+
+# Upload local_path -> remote_path, tiếp tục từ kích thước file đang có trên VPS.
+# SHA-256 được tính trong cùng 1 lượt đọc file local (đoạn đã có chỉ đọc để hash,
+# đoạn còn lại vừa hash vừa gửi). Trả về (sha256 hex của file local, số byte đã gửi lần này).
+def put_resumable(sftp, host, local_path, remote_path, throttle=None):
+    local_size = os.path.getsize(local_path)
+    try:
+        remote_size = sftp.stat(remote_path).st_size
+    except IOError:
+        remote_size = 0
+    if remote_size > local_size:
+        log(host, "   ⚠️  File tam tren VPS lon hon file local -> upload lai tu dau.")
+        sftp.remove(remote_path)
+        remote_size = 0
+    if remote_size:
+        log(host, f"   ↪️  Tiep tuc upload tu byte {remote_size}/{local_size}...")
+
+    sha256 = hashlib.sha256()
+    with open(local_path, 'rb') as src:
+        remaining = remote_size
+        while remaining:
+            chunk = src.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            sha256.update(chunk)
+            remaining -= len(chunk)
+
+        with sftp.open(remote_path, 'r+b' if remote_size else 'wb') as dst:
+            dst.seek(remote_size)
+            dst.set_pipelined(True)
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                dst.write(chunk)
+                if throttle:
+                    throttle(len(chunk))
+    return sha256.hexdigest(), local_size - remote_size
+
+# --- Zip lớn: chia thành nhiều phần, upload song song ---
+# 1 kênh SFTP bị giới hạn bởi window của paramiko nên 1 luồng put không dùng hết đường truyền.
+# Zip >= split_threshold_mb được chia thành các phần split_part_mb, upload đồng thời qua
+# split_channels kênh SFTP mở thêm trên cùng SSH transport, vào tmp_<job>/<zip>.partNNNN.
+# Sau đó VPS kiểm tra sha256 từng phần, ghép lại thành <zip> (qua file .joining, kiểm tra kích thước)
+# rồi mới tới bước mv commit như bình thường. Phần đã có đủ trên VPS (resume/thử lại) không gửi lại.
+# Mặc định tắt ("split_threshold_mb": 0); bật bằng vd "split_threshold_mb": 512 (VPS cần cat/stat/sha256sum).
+
+def split_parts(local_size, part_size):
+    return [(offset, min(part_size, local_size - offset)) for offset in range(0, local_size, part_size)]
+
+def remote_part_path(remote_zip_path, index):
+    return f"{remote_zip_path}.part{index:04d}"
+
+# Upload 1 đoạn [offset, offset + length) của file local, tiếp tục từ kích thước phần đang có trên VPS.
+# Trả về (sha256 hex của đoạn, số byte đã gửi lần này).
+def put_part(sftp, local_path, offset, length, remote_path, throttle=None):
+    try:
+        remote_size = sftp.stat(remote_path).st_size
+    except IOError:
+        remote_size = 0
+    if remote_size > length:
+        sftp.remove(remote_path)
+        remote_size = 0
+
+    sha256 = hashlib.sha256()
+    with open(local_path, 'rb') as src:
+        src.seek(offset)
+        remaining = remote_size
+        while remaining:
+            chunk = src.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            sha256.update(chunk)
+            remaining -= len(chunk)
+        if remote_size < length:
+            with sftp.open(remote_path, 'r+b' if remote_size else 'wb') as dst:
+                dst.seek(remote_size)
+                dst.set_pipelined(True)
+                remaining = length - remote_size
+                while remaining:
+                    chunk = src.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise Exception(f"File local bi ngan lai khi dang upload: {local_path}")
+                    sha256.update(chunk)
+                    dst.write(chunk)
+                    remaining -= len(chunk)
+                    if throttle:
+                        throttle(len(chunk))
+    return sha256.hexdigest(), length - remote_size
+
+# Upload các phần song song. Trả về ([(đường dẫn phần trên VPS, sha256)], tổng số byte đã gửi).
+def put_split(ssh, host, local_path, remote_zip_path, part_size, channel_count, throttle=None):
+    parts = split_parts(os.path.getsize(local_path), part_size)
+    results = [None] * len(parts)
+    work = queue.Queue()
+    for index in range(len(parts)):
+        work.put(index)
+
+    # Mỗi thread tự mở kênh SFTP của mình: mở kênh tốn vài RTT, mở song song đỡ hơn mở lần lượt
+    def part_worker(_):
+        sftp = ssh.open_sftp()
+        try:
+            while True:
+                try:
+                    index = work.get_nowait()
+                except queue.Empty:
+                    return
+                offset, length = parts[index]
+                remote_path = remote_part_path(remote_zip_path, index)
+                sha256, sent = put_part(sftp, local_path, offset, length, remote_path, throttle)
+                results[index] = (remote_path, sha256, sent)
+        finally:
+            try:
+                sftp.close()
+            except Exception:
+                pass
+
+    channel_count = max(1, min(channel_count, len(parts)))
+    log(host, f"   Chia {len(parts)} phan x {part_size / (1024 * 1024):.0f} MB, upload qua {channel_count} kenh SFTP...")
+    with ThreadPoolExecutor(max_workers=channel_count) as pool:
+        list(pool.map(part_worker, range(channel_count)))
+    return [(remote_path, sha256) for remote_path, sha256, _ in results], sum(sent for _, _, sent in results)
+
+# Kiểm tra sha256 từng phần trên VPS, ghép thành remote_zip_path và xóa các phần.
+# Phần lệch checksum bị xóa để lần thử lại chỉ gửi lại phần đó.
+def join_parts(ssh, remote_zip_path, parts, local_size):
+    quoted_parts = " ".join(shlex.quote(remote_path) for remote_path, _ in parts)
+    stdin, stdout, stderr = ssh.exec_command(f"sha256sum {quoted_parts}")
+    output = stdout.read().decode()
+    check_sha256_status(stdout, stderr)
+    remote_hashes = {}
+    for line in output.splitlines():
+        fields = line.split(None, 1)
+        if len(fields) == 2:
+            remote_hashes[fields[1].lstrip('*')] = fields[0]
+    bad_parts = [remote_path for remote_path, sha256 in parts if remote_hashes.get(remote_path) != sha256]
+    if bad_parts:
+        ssh.exec_command("rm -f " + " ".join(shlex.quote(remote_path) for remote_path in bad_parts))[1].channel.recv_exit_status()
+        raise TransientError(f"Checksum SHA-256 khong khop o {len(bad_parts)}/{len(parts)} phan")
+
+    joining_path = shlex.quote(f"{remote_zip_path}.joining")
+    stdin, stdout, stderr = ssh.exec_command(
+        f"cat {quoted_parts} > {joining_path} && [ \"$(stat -c %s {joining_path})\" = {local_size} ] "
+        f"&& mv {joining_path} {shlex.quote(remote_zip_path)} && rm -f {quoted_parts}"
+    )
+    if stdout.channel.recv_exit_status() != 0:
+        raise TransientError(f"Ghep cac phan tren VPS that bai: {stderr.read().decode().strip() or 'sai kich thuoc'}")
+
+# Streaming mode: nén folder ảnh thẳng vào file handle SFTP, không tạo zip local.
+# Trả về stats của write_folder_zip (thêm "bytes_written", "sha256" của zip đã gửi).
+def put_folder_stream(sftp, folder_path, remote_path, store_exts=None, image_index=None, prefix=None, throttle=None):
+    with sftp.open(remote_path, 'wb') as dst:
+        dst.set_pipelined(True)
+        writer = StreamWriter(dst, throttle)
+        stats = write_folder_zip(writer, folder_path, store_exts, image_index, prefix)
+    remote_size = sftp.stat(remote_path).st_size
+    if remote_size != writer.bytes_written:
+        raise TransientError(f"Kich thuoc file tren VPS ({remote_size}) khac so byte da gui ({writer.bytes_written})")
+    stats["bytes_written"] = writer.bytes_written
+    stats["sha256"] = writer.sha256.hexdigest()
+    return stats
+
+# File local đọc qua lớp này: SHA-256 được tính trên chính các block sftp.putfo đọc ra để gửi
+class HashingReader:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+# Như sftp.put nhưng không đọc file lần 2 để hash. Trả về sha256 hex của file local.
+def put_hashed(sftp, local_path, remote_path, throttle=None):
+    with open(local_path, 'rb') as src:
+        reader = HashingReader(src)
+        sftp.putfo(reader, remote_path, os.path.getsize(local_path), callback=throttle_callback(throttle))
+    return reader.sha256.hexdigest()
+
+# So SHA-256 của zip trên VPS với hash tính lúc gửi (None = không có hash local, vd: zip chia phần
+# đã được kiểm tra từng phần). Lệch -> xóa zip tạm và ném TransientError để chỉ job này được gửi lại.
+# Trả về sha256 của zip trên VPS.
+def verify_remote_zip(ssh, sftp, remote_zip_path, local_sha256):
+    remote_hash = remote_sha256(ssh, remote_zip_path)
+    if local_sha256 is not None and remote_hash != local_sha256:
+        sftp.remove(remote_zip_path)
+        raise TransientError("Checksum SHA-256 khong khop sau khi upload")
+    return remote_hash
+
+# sftp.put gọi callback(bytes_da_gui, tong) sau mỗi block -> throttle phần chênh lệch
+def throttle_callback(throttle):
+    if not throttle:
+        return None
+    sent = [0]
+    def callback(transferred, total):
+        throttle(transferred - sent[0])
+        sent[0] = transferred
+    return callback
+
+class DuplicateBatch(Exception):
+    pass
+
+# Ghi hash các ảnh của job vừa commit vào index. Lỗi index không làm hỏng job đã commit.
+def record_uploaded_images(host, package, opts, stream_stats):
+    image_index = opts.get('image_index')
+    if image_index is None:
+        return
+    try:
+        if stream_stats is not None:
+            entries = stream_stats["images"]
+        else:
+            entries = load_zip_hashes(package['local_zip_path'], VALID_IMG_EXTS)
+        image_index.add(package['meta_content']['prefix'], entries)
+        if package['local_zip_path']:
+            clear_zip_hashes(package['local_zip_path'])
+        log(host, f"   🗂️  Da ghi {len(entries)} hash anh vao index.")
+    except Exception as e:
+        log(host, f"   [LOI] Khong the cap nhat index anh: {e}")
+
+def remote_dir_exists(sftp, remote_path):
+    try:
+        sftp.stat(remote_path)
+        return True
+    except IOError:
+        return False
+
+# --- Pre-flight: hàng đợi + dung lượng trống trên VPS trước khi upload ---
+# 1 lượt listdir (đếm job_* đang chờ worker trên VPS xử lý) + statvfs trên remote_queue_dir.
+#   remote_queue_max_jobs: số job_* tối đa được nằm chờ trên VPS (0 = không giới hạn)
+#   remote_min_free_mb   : dung lượng phải còn trống sau khi upload hết job của lượt (0 = không kiểm tra)
+# Cả 2 mặc định 0 (tắt, không tốn thêm lượt listdir/statvfs); bật bằng vd "remote_queue_max_jobs": 50,
+# "remote_min_free_mb": 1024 trong config.json hoặc host_overrides.
+# Job vượt giới hạn bị hoãn (xem ktb_scheduler.admit_jobs): không upload lượt này,
+# file/folder local giữ nguyên để lần chạy sau (watch mode: sau watch_retry_seconds) upload tiếp.
+
+# Byte trống (cho user thường) của filesystem chứa path, qua extension statvfs@openssh.com
+# (paramiko chưa có hàm riêng, phải dùng SFTPClient._request nội bộ). Server không hỗ trợ,
+# hoặc bản paramiko khác đổi/bỏ _request -> None (pre-flight bỏ qua kiểm tra dung lượng).
+def remote_free_bytes(sftp, path):
+    try:
+        t, msg = sftp._request(CMD_EXTENDED, "statvfs@openssh.com", path)
+        if t != CMD_EXTENDED_REPLY:
+            return None
+        # f_bsize, f_frsize, f_blocks, f_bfree, f_bavail, ...
+        f_bsize, f_frsize, f_blocks, f_bfree, f_bavail = (msg.get_int64() for _ in range(5))
+    except (IOError, AttributeError, TypeError, ValueError, paramiko.SSHException):
+        return None
+    return (f_frsize or f_bsize) * f_bavail
+
+def probe_host(sftp, remote_queue_dir):
+    names = sftp.listdir(remote_queue_dir)
+    return {"queue_depth": sum(1 for name in names if name.startswith('job_')),
+            "free_bytes": remote_free_bytes(sftp, remote_queue_dir)}
+
+# Trả về (job được upload, [(job bị hoãn, lý do)]). Không kiểm tra được -> upload bình thường.
+def preflight_host(host, sftp, file_list, opts):
+    max_jobs = int(host_option(opts, host, 'remote_queue_max_jobs', 0) or 0)
+    min_free = int(float(host_option(opts, host, 'remote_min_free_mb', 0) or 0) * 1024 * 1024)
+    if not file_list or (not max_jobs and not min_free):
+        return file_list, []
+    metrics = opts.get('metrics') or NULL_METRICS
+    try:
+        with metrics.phase("preflight", host):
+            probe = probe_host(sftp, opts['remote_queue_dir'])
+    except Exception as e:
+        log(host, f"⚠️  Khong kiem tra duoc hang doi / dung luong VPS ({e}) -> Upload binh thuong.")
+        return file_list, []
+
+    free_bytes = probe["free_bytes"]
+    log(host, f"📥 Hang doi VPS: {probe['queue_depth']} job dang cho"
+        + (f", trong {free_bytes / (1024 * 1024):.0f} MB." if free_bytes is not None else ", khong doc duoc dung luong trong."))
+    split_threshold = int(float(host_option(opts, host, 'split_threshold_mb', 0) or 0) * 1024 * 1024)
+    admitted, deferred = admit_jobs(file_list, probe["queue_depth"], free_bytes, max_jobs, min_free, split_threshold)
+    metrics.record("preflight", host=host, queue_depth=probe["queue_depth"], free_bytes=free_bytes,
+                   jobs=len(file_list), deferred=len(deferred))
+    return admitted, deferred
+
+# --- Vòng đời 1 job ---
+# transfer_job: mkdir -> put zip (tính SHA-256 lúc gửi) -> so với sha256sum trên VPS -> ghi meta.json
+#               (từ bộ nhớ, kèm zip_sha256), vào tmp_<job>
+# commit_jobs:  mv tmp_<job> -> <job>; gom nhiều job của 1 host vào 1 lệnh remote
+# finish_job:   dọn dẹp local/remote theo kết quả, trả về (dòng report, upload_successful)
+
+COMMIT_BATCH_SIZE = 100
+
+def transfer_job(ssh, sftp, host, package, opts):
+    remote_queue_dir = opts['remote_queue_dir']
+
+    filename = package['original_filename']
+    local_zip_path = package['local_zip_path']
+    meta_content = package['meta_content']
+    job_dir_name = package['unique_job_dir_name']
+    source_folder = package.get('source_folder')
+
+    # Resumable: dùng lại tên job của lần chạy bị ngắt trước đó (nếu có).
+    # Zip streaming được tạo lại mỗi lần nên không resume được.
+    resumable = opts.get('resumable_uploads', False) and not source_folder
+    if resumable:
+        job_dir_name = load_resume_job_dir(local_zip_path, host) or job_dir_name
+    throttle = opts['bandwidth'].for_host(host) if opts.get('bandwidth') else None
+    metrics = opts.get('metrics') or NULL_METRICS
+    split_threshold = int(float(host_option(opts, host, 'split_threshold_mb', 0) or 0) * 1024 * 1024)
+
+    remote_job_dir_path_tmp = f"{remote_queue_dir}/tmp_{job_dir_name}"
+    job = {
+        "package": package,
+        "filename": filename,
+        "job_dir_name": job_dir_name,
+        "resumable": resumable,
+        "remote_job_dir_path_tmp": remote_job_dir_path_tmp,
+        "remote_job_dir_path_final": f"{remote_queue_dir}/{job_dir_name}",
+        "remote_zip_path": f"{remote_job_dir_path_tmp}/{filename}",
+        "remote_meta_path": f"{remote_job_dir_path_tmp}/meta.json",
+        "stream_stats": None,
+        "sha256": None,
+        "bytes_sent": 0,
+        "transfer_seconds": 0.0,
+        "status": "failed",     # ready -> committed | failed | skipped
+        "error": None,
+        "transient": False,     # failed do lỗi tạm thời -> upload_with_session thử lại
+    }
+
+    started = time.perf_counter()
+    try:
+        # Zip bị xóa/di chuyển sau khi quét -> chỉ job này lỗi, không làm hỏng cả host
+        local_size = os.path.getsize(local_zip_path) if local_zip_path else 0
+
+        # Thử lại sau lỗi tạm thời: mv có thể đã chạy xong trước khi mất kết nối
+        if package.get('retry') and remote_dir_exists(sftp, job["remote_job_dir_path_final"]):
+            log(host, f"   Job {job_dir_name} da duoc kich hoat o lan truoc.")
+            mark_committed(host, job, opts)
+            return job
+
+        journal_state(opts, package, 'uploading', host=host)
+
+        if (resumable or package.get('retry')) and remote_dir_exists(sftp, remote_job_dir_path_tmp):
+            log(host, f"   Dung lai job folder tam: tmp_{job_dir_name}...")
+        else:
+            log(host, f"   Tao job folder tam: tmp_{job_dir_name}...")
+            with metrics.phase("mkdir", host, filename):
+                sftp.mkdir(remote_job_dir_path_tmp)
+        if resumable:
+            save_resume_state(local_zip_path, host, job_dir_name)
+
+        if source_folder:
+            log(host, f"   Streaming {os.path.basename(source_folder)} -> {filename} (tam)...")
+            with metrics.phase("stream", host, filename) as phase:
+                stream_stats = put_folder_stream(sftp, source_folder, job["remote_zip_path"], opts.get('zip_store_exts'),
+                                                 opts.get('image_index'), meta_content['prefix'], throttle)
+                phase["bytes"] = job["bytes_sent"] = stream_stats['bytes_written']
+            job["stream_stats"] = stream_stats
+            if opts.get('image_index') is not None and stream_stats["image_files"] == 0:
+                raise DuplicateBatch(f"ca {stream_stats['duplicates']} anh da upload truoc do")
+            log(host, f"   Da stream {stream_stats['bytes_written'] / (1024 * 1024):.1f} MB.")
+            local_sha256 = stream_stats["sha256"]
+        elif split_threshold and local_size >= split_threshold:
+            log(host, f"   Uploading {filename} ({local_size / (1024 * 1024):.0f} MB, chia phan) (tam)...")
+            part_size = max(1, int(float(host_option(opts, host, 'split_part_mb', 64)) * 1024 * 1024))
+            channel_count = int(host_option(opts, host, 'split_channels', opts.get('sftp_channels_per_host', 1)))
+            with metrics.phase("put", host, filename) as phase:
+                parts, phase["bytes"] = put_split(ssh, host, local_zip_path, job["remote_zip_path"], part_size,
+                                                  channel_count, throttle)
+                job["bytes_sent"] = phase["bytes"]
+            with metrics.phase("join", host, filename):
+                join_parts(ssh, job["remote_zip_path"], parts, local_size)
+            log(host, f"   Da ghep {len(parts)} phan, checksum SHA-256 khop.")
+            # Từng phần đã được so sha256 -> chỉ ghi lại hash của zip đã ghép vào meta.json
+            local_sha256 = None
+        elif resumable or package.get('retry'):
+            # Thử lại sau lỗi tạm thời: tmp_<job> được giữ lại -> gửi tiếp từ kích thước zip trên VPS
+            # (cả khi tắt resumable_uploads); checksum bên dưới bắt phần đã gửi bị hỏng
+            log(host, f"   Uploading {filename} (tam)...")
+            with metrics.phase("put", host, filename) as phase:
+                local_sha256, phase["bytes"] = put_resumable(sftp, host, local_zip_path, job["remote_zip_path"], throttle)
+                job["bytes_sent"] = phase["bytes"]
+        else:
+            log(host, f"   Uploading {filename} (tam)...")
+            with metrics.phase("put", host, filename) as phase:
+                local_sha256 = put_hashed(sftp, local_zip_path, job["remote_zip_path"], throttle)
+                phase["bytes"] = job["bytes_sent"] = os.path.getsize(local_zip_path)
+
+        # Chỉ kích hoạt job khi zip trên VPS khớp hash tính lúc gửi (lệch -> xóa zip tạm, thử lại job này)
+        with metrics.phase("checksum", host, filename):
+            job["sha256"] = verify_remote_zip(ssh, sftp, job["remote_zip_path"], local_sha256)
+        if local_sha256 is not None:
+            log(host, "   Checksum SHA-256 khop.")
+
+        # meta.json ghi sau zip, kèm zip_sha256 để importer trên VPS kiểm tra lại
+        # (ghi thẳng từ bộ nhớ, không tạo file tạm local, không stat xác nhận)
+        log(host, "   Uploading meta.json (tam)...")
+        with metrics.phase("meta", host, filename):
+            with sftp.open(job["remote_meta_path"], 'wb') as f:
+                f.write(json.dumps(dict(meta_content, zip_sha256=job["sha256"])).encode('utf-8'))
+
+        job["status"] = "ready"
+        journal_state(opts, package, 'uploaded')
+
+    except DuplicateBatch as e:
+        job["status"] = "skipped"
+        job["error"] = str(e)
+    except Exception as e:
+        job["error"] = str(e) or type(e).__name__
+        job["transient"] = is_transient_error(e, ssh)
+
+    job["transfer_seconds"] = time.perf_counter() - started
+    return job
+
+# Job đã được mv trên VPS: ghi nhật ký ngay (không chờ finish_job), để script bị dừng trước
+# khi dọn dẹp thì lần chạy sau không gửi lại zip (thư mục job có thể đã bị worker VPS xử lý xong)
+def mark_committed(host, job, opts):
+    job["status"] = "committed"
+    journal_state(opts, job["package"], 'committed', host=host)
+
+# Kích hoạt các job "ready" bằng 1 lệnh remote cho mỗi COMMIT_BATCH_SIZE job.
+# Mỗi mv chạy độc lập: 1 job lỗi không chặn các job còn lại.
+def commit_jobs(ssh, host, jobs, opts):
+    metrics = opts.get('metrics') or NULL_METRICS
+    ready_jobs = [job for job in jobs if job["status"] == "ready"]
+    for start in range(0, len(ready_jobs), COMMIT_BATCH_SIZE):
+        batch = ready_jobs[start:start + COMMIT_BATCH_SIZE]
+        log(host, f"   Kich hoat {len(batch)} job (doi ten thu muc)...")
+        command = "; ".join(
+            f"if err=$(mv {shlex.quote(job['remote_job_dir_path_tmp'])} {shlex.quote(job['remote_job_dir_path_final'])} 2>&1); "
+            f"then echo OK {index}; else echo FAIL {index} $err; fi"
+            for index, job in enumerate(batch)
+        )
+        results = {}
+        try:
+            with metrics.phase("commit", host, f"{len(batch)} job"):
+                stdin, stdout, stderr = ssh.exec_command(command)
+                output = stdout.read().decode()
+                stdout.channel.recv_exit_status()
+            for line in output.splitlines():
+                parts = line.split(' ', 2)
+                if len(parts) >= 2 and parts[1].isdigit():
+                    results[int(parts[1])] = (parts[0], parts[2] if len(parts) > 2 else "")
+        except Exception as e:
+            for job in batch:
+                job["status"] = "failed"
+                job["error"] = f"Loi doi ten thu muc job: {e}"
+                job["transient"] = is_transient_error(e, ssh)
+            continue
+
+        for index, job in enumerate(batch):
+            status, message = results.get(index, ("FAIL", "khong co ket qua tu VPS"))
+            job["transient"] = False
+            if status == "OK":
+                mark_committed(host, job, opts)
+            else:
+                job["status"] = "failed"
+                job["error"] = f"Loi doi ten thu muc job: {message}"
+
+def finish_job(sftp, host, job, opts):
+    package = job["package"]
+    filename = job["filename"]
+    local_zip_path = package['local_zip_path']
+    source_folder = package.get('source_folder')
+    upload_successful = job["status"] == "committed"
+    (opts.get('metrics') or NULL_METRICS).job(host, filename, job["bytes_sent"], job["transfer_seconds"], job["status"])
+
+    if upload_successful:
+        if job["resumable"]:
+            clear_resume_state(local_zip_path)
+        record_uploaded_images(host, package, opts, job["stream_stats"])
+        log(host, f"   ✅ {filename}: Da xep hang thanh cong.")
+        report_line = f"\n[OK] {filename} -> {host} ({opts['ok_label']})"
+    elif job["status"] == "skipped":
+        # Không có ảnh mới -> bỏ job tạm trên VPS, folder gốc xóa như đã commit
+        log(host, f"   ⏭️ {filename}: Bo qua ({job['error']}).")
+        report_line = f"\n[BO QUA] {filename} ({job['error']})"
+    else:
+        log(host, f"   [LOI] {filename}: Upload that bai: {job['error']}")
+        report_line = f"\n[LOI] {filename} (Upload failed: {job['error']})"
+        # Lần chạy sau upload lại (cùng job_id)
+        journal_state(opts, package, 'staged', job['error'])
+
+    if not upload_successful:
+        if job["resumable"] and job["status"] != "skipped":
+            # Giữ lại file tạm trên VPS để lần chạy sau tiếp tục từ offset hiện có
+            log(host, f"   ↪️  Giu lai tmp_{job['job_dir_name']} de tiep tuc o lan chay sau.")
+        else:
+            try:
+                # Xóa cả các phần còn sót (zip chia phần, xem put_split)
+                for name in sftp.listdir(job["remote_job_dir_path_tmp"]):
+                    sftp.remove(f"{job['remote_job_dir_path_tmp']}/{name}")
+                sftp.rmdir(job["remote_job_dir_path_tmp"])
+            except: pass
+
+    if job["status"] == "skipped":
+        journal_state(opts, package, 'cleaned', job['error'])
+        shutil.rmtree(source_folder, ignore_errors=True)
+    elif upload_successful and source_folder:
+        # Chỉ xóa folder gốc sau khi mv commit thành công
+        try:
+            shutil.rmtree(source_folder)
+            log(host, f"   🧹 Da xoa folder goc: {source_folder}")
+        except Exception as e_del:
+            log(host, f"   [LOI] Khong the xoa folder goc {source_folder}: {e_del}")
+    elif source_folder:
+        log(host, f"   ⚠️  Folder '{source_folder}' van con do upload loi.")
+    elif upload_successful and opts['delete_local']:
+        try:
+            os.remove(local_zip_path)
+            journal_state(opts, package, 'cleaned')
+            log(host, f"   🧹 Da xoa file local: {local_zip_path}")
+        except Exception as e_del:
+            log(host, f"   [LOI] Khong the xoa file local {local_zip_path}: {e_del}")
+    elif not upload_successful:
+        log(host, f"   ⚠️  File zip '{filename}' van con trong '{opts['local_tmp_dir']}' do upload loi.")
+
+    return report_line, upload_successful
+
+# --- Phiên kết nối tới 1 host: 1 SSH transport + N kênh SFTP ---
+# upload_host mở/đóng phiên cho mỗi lần chạy; watch mode (ktb-watch.py) giữ phiên "ấm" giữa các lượt.
+def open_host_session(host, port, opts, channel_count):
+    with (opts.get('metrics') or NULL_METRICS).phase("connect", host):
+        ssh = connect_host(host, port, opts)
+        if opts.get('keepalive_seconds'):
+            ssh.get_transport().set_keepalive(int(opts['keepalive_seconds']))
+        # port/channel_count giữ lại để reconnect_session mở lại đúng phiên
+        session = {"ssh": ssh, "sftp_channels": [], "port": port, "channel_count": channel_count}
+        try:
+            for _ in range(max(1, channel_count)):
+                session["sftp_channels"].append(ssh.open_sftp())
+        except Exception:
+            close_host_session(session)
+            raise
+    return session
+
+# Mở phiên, thử lại lỗi tạm thời với backoff (sai mật khẩu/key thì ném lỗi ngay)
+def open_host_session_with_retry(host, port, opts, channel_count):
+    retries = max(0, int(opts.get('upload_retries', 0)))
+    for attempt in range(1, retries + 2):
+        try:
+            return open_host_session(host, port, opts, channel_count)
+        except Exception as e:
+            if attempt > retries or not is_transient_error(e):
+                raise
+            delay = backoff_delay(attempt, opts)
+            log(host, f"⚠️  Ket noi that bai ({e}), thu lai sau {delay:.1f}s (lan {attempt}/{retries})...")
+            time.sleep(delay)
+
+# Đóng phiên hỏng và mở lại tại chỗ (cùng dict session, nên watch mode giữ được phiên mới)
+def reconnect_session(host, session, opts):
+    close_host_session(session)
+    fresh = open_host_session(host, session["port"], opts, session["channel_count"])
+    session.update(fresh)
+    log(host, f"🔌 Da ket noi lai {host} ({len(session['sftp_channels'])} kenh SFTP).")
+
+def transport_alive(ssh):
+    transport = ssh.get_transport()
+    return transport is not None and transport.is_active()
+
+def session_is_alive(session):
+    return transport_alive(session["ssh"])
+
+def close_host_session(session):
+    for sftp in session["sftp_channels"]:
+        try:
+            sftp.close()
+        except Exception:
+            pass
+    try:
+        session["ssh"].close()
+    except Exception:
+        pass
+
+def needs_retry(job):
+    return job is not None and job["status"] == "failed" and job["transient"]
+
+# Upload file_list qua 1 phiên đã mở. Trả về (report_content, total_files_queued).
+# Job được sắp theo upload_order (xem ktb_scheduler.py), report theo đúng thứ tự đó.
+# Nếu phiên có nhiều kênh SFTP: mỗi kênh 1 thread lấy job từ hàng đợi chung
+# (trình tự từng job giữ nguyên).
+# Nếu batch_commit (mặc định tắt, bật bằng "batch_commit": true trong config.json): chỉ upload
+# trong lúc chạy, sau đó mv tất cả job xong bằng 1 lệnh.
+# Lỗi tạm thời (mất kết nối giữa chừng...): các job chưa xong được thử lại tối đa
+# upload_retries lượt (mặc định 0 = không thử lại, đặt vd "upload_retries": 3 trong config.json),
+# mỗi lượt chờ backoff rồi kết nối lại, tiếp tục từ job bị lỗi; zip đang gửi dở gửi tiếp từ byte đã có.
+def upload_with_session(host, session, file_list, opts):
+    report_content = ""
+    total_files_queued = 0
+    batch_commit = opts.get('batch_commit', False)
+    retries = max(0, int(opts.get('upload_retries', 0)))
+    metrics = opts.get('metrics') or NULL_METRICS
+    started = time.perf_counter()
+    file_list = schedule_jobs(file_list, opts)
+
+    # Hàng đợi VPS đầy / sắp hết dung lượng -> hoãn bớt job (chỉ kiểm tra 1 lần, trước khi upload)
+    file_list, deferred = preflight_host(host, session["sftp_channels"][0], file_list, opts)
+    deferred_report = ""
+    for package, reason in deferred:
+        log(host, f"   ⏸️ {package['original_filename']}: Hoan upload ({reason}).")
+        deferred_report += f"\n[HOAN] {package['original_filename']} ({reason})"
+
+    jobs = [None] * len(file_list)        # job mới nhất của từng package
+    results = [None] * len(file_list)     # (report_line, upload_successful) khi đã xong
+    bytes_sent = [0] * len(file_list)
+
+    progress = opts.get('progress')
+    progress_lock = threading.Lock()
+    done_count = [0]
+
+    def report_progress():
+        if progress:
+            with progress_lock:
+                done_count[0] += 1
+                progress(host, f"{'da gui' if batch_commit else 'xong'} {done_count[0]}/{len(file_list)} job")
+
+    def channel_worker(sftp, work):
+        while True:
+            # Transport đã chết -> để các job còn lại cho lượt sau (sau khi kết nối lại)
+            if not session_is_alive(session):
+                return
+            try:
+                index = work.get_nowait()
+            except queue.Empty:
+                return
+            job = transfer_job(session["ssh"], sftp, host, file_list[index], opts)
+            jobs[index] = job
+            bytes_sent[index] += job["bytes_sent"]
+            if not batch_commit:
+                # Kích hoạt ngay từng job
+                commit_jobs(session["ssh"], host, [job], opts)
+            if needs_retry(job):
+                log(host, f"   ⚠️  {job['filename']}: loi tam thoi ({job['error']}), se thu lai.")
+                continue
+            if not batch_commit:
+                results[index] = finish_job(sftp, host, job, opts)
+            report_progress()
+
+    def retry_wait(attempt, count):
+        delay = backoff_delay(attempt, opts)
+        log(host, f"🔁 {count} job chua xong do loi tam thoi -> ket noi lai sau {delay:.1f}s (lan {attempt}/{retries})...")
+        time.sleep(delay)
+        try:
+            reconnect_session(host, session, opts)
+        except paramiko.AuthenticationException:
+            raise
+        except Exception as e:
+            log(host, f"⚠️  Ket noi lai that bai: {e}")
+
+    pending = list(range(len(file_list)))
+    for attempt in range(retries + 1):
+        if attempt:
+            retry_wait(attempt, len(pending))
+            for index in pending:
+                file_list[index]['retry'] = True
+        work = queue.Queue()
+        for index in pending:
+            work.put(index)
+        sftp_channels = session["sftp_channels"][:max(1, len(pending))]
+        if len(sftp_channels) == 1:
+            channel_worker(sftp_channels[0], work)
+        else:
+            with ThreadPoolExecutor(max_workers=len(sftp_channels)) as pool:
+                list(pool.map(lambda sftp: channel_worker(sftp, work), sftp_channels))
+        pending = [index for index in pending if jobs[index] is None or needs_retry(jobs[index])]
+        if not pending:
+            break
+
+    if batch_commit:
+        ready = [job for job in jobs if job is not None and job["status"] == "ready"]
+        for attempt in range(retries + 1):
+            if attempt:
+                retry_wait(attempt, len(ready))
+                for job in ready:
+                    # mv có thể đã chạy xong trước khi mất kết nối
+                    if remote_dir_exists(session["sftp_channels"][0], job["remote_job_dir_path_final"]):
+                        mark_committed(host, job, opts)
+                    else:
+                        job["status"] = "ready"
+            commit_jobs(session["ssh"], host, ready, opts)
+            ready = [job for job in ready if needs_retry(job)]
+            if not ready:
+                break
+            for job in ready:
+                job["status"] = "ready"
+        for index, job in enumerate(jobs):
+            if job is not None and results[index] is None:
+                results[index] = finish_job(session["sftp_channels"][0], host, job, opts)
+    else:
+        # Hết lượt thử lại: job lỗi tạm thời vẫn phải dọn dẹp + báo lỗi
+        for index, job in enumerate(jobs):
+            if job is not None and results[index] is None:
+                results[index] = finish_job(session["sftp_channels"][0], host, job, opts)
+
+    # Giữ thứ tự report theo file_list, không phụ thuộc kênh nào xong trước
+    for index, result in enumerate(results):
+        if result is None:
+            # Chưa kịp upload lần nào (mất kết nối suốt các lượt thử lại)
+            filename = file_list[index]['original_filename']
+            log(host, f"   [LOI] {filename}: Khong upload duoc (mat ket noi).")
+            report_content += f"\n[LOI] {filename} (Mat ket noi, chua upload)"
+            continue
+        report_line, upload_successful = result
+        report_content += report_line
+        if upload_successful:
+            total_files_queued += 1
+    report_content += deferred_report
+
+    metrics.host(host, len(file_list), total_files_queued, sum(bytes_sent), time.perf_counter() - started)
+    if progress:
+        progress(host, f"✅ hoan tat: {total_files_queued}/{len(file_list)} job da xep hang"
+                 + (f", hoan {len(deferred)} job" if deferred else ""))
+    return report_content, total_files_queued
+
+# Upload toàn bộ job của 1 host (mở phiên -> upload -> đóng phiên).
+# Trả về (report_content, total_files_queued) của riêng host đó.
+def upload_host(host, port, file_list, opts):
+    report_content = ""
+    total_files_queued = 0
+
+    log(host, f"🚀 Dang ket noi den Host: {host}:{port} (User: {opts['username']}) - Su dung {opts['auth_label']}")
+
+    session = None
+    try:
+        channel_count = min(int(opts.get('sftp_channels_per_host', 1)), len(file_list))
+        session = open_host_session_with_retry(host, port, opts, channel_count)
+        log(host, f"✅ Ket noi {host} thanh cong. Bat dau upload {len(file_list)} job ({len(session['sftp_channels'])} kenh SFTP)...")
+        report_content, total_files_queued = upload_with_session(host, session, file_list, opts)
+
+    except paramiko.AuthenticationException:
+        log(host, f"❌ LOI: Xac thuc {opts['auth_label']} voi {host} that bai!")
+        report_content += f"\n\n❌ LỖI KẾT NỐI {host}: XÁC THỰC THẤT BẠI."
+        if opts.get('progress'):
+            opts['progress'](host, "❌ xac thuc that bai")
+    except Exception as e:
+        log(host, f"❌ LOI SCRIPT voi {host}: {e}")
+        report_content += f"\n\n❌ LỖI SCRIPT {host}: {e}"
+        if opts.get('progress'):
+            opts['progress'](host, f"❌ loi: {e}")
+    finally:
+        if session: close_host_session(session)
+        log(host, f"--- Da ngat ket noi khoi {host} ---")
+
+    return report_content, total_files_queued
+
+# Chạy upload_host song song, mỗi host 1 worker (giới hạn bởi max_parallel_hosts).
+# Kết quả gộp theo đúng thứ tự files_by_host nên báo cáo Telegram vẫn là
+# 1 tin nhắn duy nhất, không phụ thuộc host nào xong trước.
+def upload_all_hosts(files_by_host, opts):
+    if not files_by_host:
+        return "", 0
+
+    max_workers = max(1, min(int(opts.get('max_parallel_hosts', 1)), len(files_by_host)))
+    print(f"\n⚙️  Upload {len(files_by_host)} host, toi da {max_workers} host cung luc.")
+    print_schedule(files_by_host, opts)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(upload_host, host_key[0], host_key[1], file_list, opts)
+            for host_key, file_list in files_by_host.items()
+        ]
+        results = [future.result() for future in futures]
+
+    report_content = ""
+    total_files_queued = 0
+    for host_report, host_count in results:
+        report_content += host_report
+        total_files_queued += host_count
+    return report_content, total_files_queued
@@ -0,0 +1,192 @@
+import os
+import time
+import zlib
+import zipfile
+import hashlib
+
+# --- Logic nén zip dùng chung cho prepare_zip.py, prepare_zip_manual.py và ktb-user-upload.py ---
+
+# Đường dẫn folder ảnh (Nằm ngang hàng với folder chứa script này)
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(CURRENT_DIR)
+IMAGE_SOURCE_DIR = os.path.join(PROJECT_ROOT, 'ktbproject', 'ktbimage', 'OutputImage')
+
+VALID_IMG_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp')
+
+# Định dạng đã nén sẵn -> STORE (DEFLATE gần như không giảm dung lượng, chỉ tốn CPU).
+# Các đuôi khác (bmp, txt, json...) vẫn DEFLATE. Ghi đè bằng 'zip_store_exts' trong config.json.
+DEFAULT_STORE_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+# Đo tốc độ DEFLATE trên 1 mẫu nhỏ để ước lượng thời gian tiết kiệm nhờ STORE
+DEFLATE_SAMPLE_SIZE = 1024 * 1024
+
+# Chọn tên zip chưa dùng: {base}.zip, {base}2.zip, ... (tránh tên trong reserved_names
+# và file đã có trong exists_dir). Tên được thêm vào reserved_names.
+def reserve_zip_filename(base_zip_name, reserved_names, exists_dir=None):
+    zip_filename = f"{base_zip_name}.zip"
+    counter = 1
+    while zip_filename in reserved_names or (exists_dir and os.path.exists(os.path.join(exists_dir, zip_filename))):
+        counter += 1
+        zip_filename = f"{base_zip_name}{counter}.zip"
+    reserved_names.add(zip_filename)
+    return zip_filename
+
+# Trả về [(folder_name, folder_path, site_config)] của các folder con trong source_dir
+# khớp prefix của 1 site (router: ktb_router.SiteRouter) và có ít nhất 1 file ảnh.
+def find_image_folders(source_dir, router, verbose=True):
+    result = []
+    for folder_name in os.listdir(source_dir):
+        folder_path = os.path.join(source_dir, folder_name)
+        if not os.path.isdir(folder_path):
+            continue
+
+        matched_site = router.match_site(folder_name)
+        if not matched_site:
+            continue
+
+        has_image = any(f.lower().endswith(VALID_IMG_EXTS) for f in os.listdir(folder_path))
+        if not has_image:
+            if verbose:
+                print(f"   ⚠️ Bo qua {folder_name} (Khong co anh)")
+            continue
+
+        result.append((folder_name, folder_path, matched_site))
+    return result
+
+# Wrapper chỉ có write(): zipfile thấy stream không seek được nên ghi header
+# tuần tự (data descriptor) thay vì seek ngược lại -> ghi thẳng ra file SFTP.
+# throttle(n_bytes): giới hạn băng thông (xem ktb_scheduler.BandwidthLimiter).
+class StreamWriter:
+    def __init__(self, fileobj, throttle=None):
+        self.fileobj = fileobj
+        self.throttle = throttle
+        self.bytes_written = 0
+        # SHA-256 của đúng các byte đã gửi (kiểm tra với file trên VPS, xem ktb_uploader.verify_remote_zip)
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.sha256.update(data)
+        self.bytes_written += len(data)
+        if self.throttle:
+            self.throttle(len(data))
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+def compression_for(name, store_exts):
+    return zipfile.ZIP_STORED if name.lower().endswith(store_exts) else zipfile.ZIP_DEFLATED
+
+def measure_deflate_rate(file_path):
+    with open(file_path, 'rb') as f:
+        sample = f.read(DEFLATE_SAMPLE_SIZE)
+    if not sample:
+        return None
+    started = time.perf_counter()
+    zlib.compress(sample, zlib.Z_DEFAULT_COMPRESSION)
+    elapsed = time.perf_counter() - started
+    return len(sample) / elapsed if elapsed > 0 else None
+
+# [(đường dẫn, tên entry)] của toàn bộ folder_path (tên entry tương đối như shutil.make_archive),
+# gồm cả entry thư mục con.
+def folder_entries(folder_path):
+    for dirpath, dirnames, filenames in os.walk(folder_path):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, folder_path)
+        if rel_dir != os.curdir:
+            yield dirpath, rel_dir
+        for name in sorted(filenames):
+            yield os.path.join(dirpath, name), os.path.normpath(os.path.join(rel_dir, name))
+
+# Nén toàn bộ folder_path vào fileobj, xem write_files_zip.
+def write_folder_zip(fileobj, folder_path, store_exts=None, image_index=None, prefix=None):
+    return write_files_zip(fileobj, folder_entries(folder_path), store_exts, image_index, prefix)
+
+# Nén các entry [(đường dẫn, tên entry)] vào fileobj, chọn STORE/DEFLATE theo đuôi file.
+# Trả về dict thống kê (xem format_zip_stats).
+# Nếu có image_index (ktb_image_index.ImageIndex): ảnh đã upload cho prefix này
+# (hoặc trùng nội dung trong cùng zip) bị bỏ khỏi zip; stats["images"] là
+# [(tên entry, sha256)] các ảnh đã cho vào zip để ghi index sau khi commit.
+def write_files_zip(fileobj, entries, store_exts=None, image_index=None, prefix=None):
+    store_exts = tuple(store_exts) if store_exts is not None else DEFAULT_STORE_EXTS
+    stats = {"files": 0, "raw_bytes": 0, "zip_bytes": 0, "stored_files": 0, "stored_bytes": 0, "seconds": 0.0, "seconds_saved": 0.0,
+             "image_files": 0, "duplicates": 0, "images": []}
+    seen_hashes = set()
+    deflate_rate = None
+    started = time.perf_counter()
+
+    with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for file_path, arcname in entries:
+            if os.path.isdir(file_path):
+                zf.write(file_path, arcname)
+                continue
+            name = os.path.basename(file_path)
+            compress_type = compression_for(name, store_exts)
+            is_image = name.lower().endswith(VALID_IMG_EXTS)
+
+            if image_index is not None and is_image:
+                # Đọc ảnh 1 lần: vừa hash để kiểm tra trùng, vừa ghi vào zip
+                with open(file_path, 'rb') as f:
+                    data = f.read()
+                sha256 = hashlib.sha256(data).hexdigest()
+                if sha256 in seen_hashes or image_index.contains(prefix, sha256):
+                    stats["duplicates"] += 1
+                    continue
+                seen_hashes.add(sha256)
+                info = zipfile.ZipInfo.from_file(file_path, arcname)
+                info.compress_type = compress_type
+                zf.writestr(info, data)
+                stats["images"].append((info.filename, sha256))
+            else:
+                zf.write(file_path, arcname, compress_type=compress_type)
+
+            info = zf.infolist()[-1]
+            stats["files"] += 1
+            if is_image:
+                stats["image_files"] += 1
+            stats["raw_bytes"] += info.file_size
+            stats["zip_bytes"] += info.compress_size
+            if compress_type == zipfile.ZIP_STORED:
+                stats["stored_files"] += 1
+                stats["stored_bytes"] += info.file_size
+                if deflate_rate is None:
+                    deflate_rate = measure_deflate_rate(file_path)
+
+    stats["seconds"] = time.perf_counter() - started
+    if deflate_rate:
+        stats["seconds_saved"] = stats["stored_bytes"] / deflate_rate
+    return stats
+
+def merge_zip_stats(stats_list):
+    total = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                total[key] = total.get(key, 0) + value
+    return total
+
+def format_zip_stats(stats):
+    raw_mb = stats["raw_bytes"] / (1024 * 1024)
+    zip_mb = stats["zip_bytes"] / (1024 * 1024)
+    ratio = (stats["zip_bytes"] / stats["raw_bytes"] * 100) if stats["raw_bytes"] else 100.0
+    return (f"{raw_mb:.1f} MB -> {zip_mb:.1f} MB ({ratio:.1f}%), "
+            f"STORE {stats['stored_files']}/{stats['files']} file, "
+            f"nen {stats['seconds']:.1f}s, tiet kiem ~{stats['seconds_saved']:.1f}s"
+            + (f", bo {stats['duplicates']} anh trung" if stats.get('duplicates') else ""))
+
+# Nén folder ra file zip local: ghi vào <zip>.part rồi đổi tên, để uploader
+# (chỉ lấy *.zip) không bao giờ thấy file zip đang ghi dở.
+def zip_folder_to_file(folder_path, zip_path, store_exts=None, image_index=None, prefix=None):
+    return zip_entries_to_file(folder_entries(folder_path), zip_path, store_exts, image_index, prefix)
+
+def zip_entries_to_file(entries, zip_path, store_exts=None, image_index=None, prefix=None):
+    part_path = f"{zip_path}.part"
+    try:
+        with open(part_path, 'wb') as f:
+            stats = write_files_zip(f, entries, store_exts, image_index, prefix)
+        os.replace(part_path, zip_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return stats
@@ -1,20 +1,92 @@
 import os
-import json
 import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
+from ktb_zip import IMAGE_SOURCE_DIR, find_image_folders, reserve_zip_filename, zip_folder_to_file, format_zip_stats, merge_zip_stats
+from ktb_image_index import open_image_index, save_zip_hashes
+from ktb_router import load_routing
+from ktb_metrics import open_metrics, NULL_METRICS
+from ktb_image_opt import optimize_image_folders
 
 # --- CẤU HÌNH ---
 load_dotenv()
 INPUT_ZIP_DIR = 'InputZip'
 CONFIG_FILE = 'config.json'
+# Đường dẫn folder ảnh và VALID_IMG_EXTS: xem ktb_zip.py
 
-# Đường dẫn folder ảnh (Nằm ngang hàng với folder chứa script này)
-CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
-PROJECT_ROOT = os.path.dirname(CURRENT_DIR) 
-IMAGE_SOURCE_DIR = os.path.join(PROJECT_ROOT, 'ktbproject', 'ktbimage', 'OutputImage')
+# Worker nén 1 folder (chạy trong process pool). Trả về (folder_name, zip_filename, loi_hoac_None, stats).
+# Mỗi worker tự mở index ảnh (SQLite cho phép nhiều process cùng đọc).
+def compress_folder(folder_name, folder_path, zip_filename, store_exts=None, image_index_db=None, prefix=None):
+    image_index = None
+    try:
+        print(f"   📦 Dang nen: {folder_name} -> {zip_filename}...")
+        zip_path = os.path.join(INPUT_ZIP_DIR, zip_filename)
+        image_index = open_image_index(image_index_db)
+        stats = zip_folder_to_file(folder_path, zip_path, store_exts, image_index, prefix)
 
-VALID_IMG_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp')
+        if image_index is not None:
+            if stats["image_files"] == 0:
+                # Toàn bộ ảnh đã upload trước đó -> không cần zip này
+                os.remove(zip_path)
+            else:
+                save_zip_hashes(zip_path, prefix, stats["images"])
+        
+        # --- QUAN TRỌNG: Xóa folder gốc sau khi nén thành công ---
+        # Vì tool upload gốc sẽ xóa file zip sau khi up, 
+        # nên ta cần xóa folder gốc ngay tại đây để tránh duplicate lần sau.
+        shutil.rmtree(folder_path) 
+        return folder_name, zip_filename, None, stats
+    except Exception as e:
+        return folder_name, zip_filename, str(e), None
+    finally:
+        if image_index is not None:
+            image_index.close()
+
+def report_result(folder_name, zip_filename, error, stats, metrics=NULL_METRICS):
+    metrics.zip(folder_name, zip_filename, stats, error)
+    if error:
+        print(f"      ❌ Loi nen {folder_name}: {error}")
+        return None
+    if stats["image_files"] == 0:
+        print(f"      ⏭️ Bo qua {folder_name}: ca {stats['duplicates']} anh da upload truoc do (da xoa folder goc).")
+        return None
+    print(f"      ✅ Da nen & xoa folder goc: {folder_name} -> {zip_filename}")
+    print(f"         {format_zip_stats(stats)}")
+    return stats
+
+# Tên zip được chọn hết ở process chính TRƯỚC khi nén, nên các worker
+# chạy song song không bao giờ tranh nhau cùng 1 tên.
+def plan_zip_tasks(folders, config, wp_author):
+    reserved_names = set()
+    store_exts = config.get('zip_store_exts')
+    image_index_db = config.get('image_index_db')
+    tasks = []
+    for folder_name, folder_path, matched_site in folders:
+        prefix = matched_site['prefix']
+        # Xử lý trùng tên (tăng số đếm)
+        zip_filename = reserve_zip_filename(f"{prefix}.{wp_author}", reserved_names, INPUT_ZIP_DIR)
+        tasks.append((folder_name, folder_path, zip_filename, store_exts, image_index_db, prefix))
+    return tasks
+
+# Nén các task (song song nếu zip_workers > 1). Trả về stats của các zip đã tạo.
+# Worker trả stats về process chính, chỉ process chính ghi metrics.
+def run_zip_tasks(tasks, config, metrics=NULL_METRICS):
+    zip_workers = max(1, int(config.get('zip_workers', 1)))
+    done_stats = []
+
+    if zip_workers == 1 or len(tasks) <= 1:
+        results = (compress_folder(*task) for task in tasks)
+        for result in results:
+            done_stats.append(report_result(*result, metrics))
+    else:
+        print(f"   ⚙️ Nen {len(tasks)} folder voi {zip_workers} process...")
+        with ProcessPoolExecutor(max_workers=min(zip_workers, len(tasks))) as pool:
+            futures = [pool.submit(compress_folder, *task) for task in tasks]
+            for future in as_completed(futures):
+                done_stats.append(report_result(*future.result(), metrics))
+
+    return [stats for stats in done_stats if stats]
 
 def main():
     print("--- [PRE-PROCESS] Quet folder anh & Tao Zip ---")
@@ -32,56 +104,28 @@ def main():
         return
 
     # 2. Đọc Config để lấy Prefix và Author
-    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-        config = json.load(f)
+    config, router = load_routing(CONFIG_FILE)
     
     wp_author = config.get('default_user_author', 'unknown')
-    sites = config.get('sites', [])
-    
-    # 3. Quét folder
-    subfolders = [f for f in os.listdir(IMAGE_SOURCE_DIR) if os.path.isdir(os.path.join(IMAGE_SOURCE_DIR, f))]
-    count = 0
 
-    for folder_name in subfolders:
-        folder_path = os.path.join(IMAGE_SOURCE_DIR, folder_name)
-        
-        # Check Prefix
-        matched_site = next((site for site in sites if folder_name.startswith(site['prefix'])), None)
-        if not matched_site:
-            continue 
-
-        # Check có ảnh không
-        has_image = any(f.lower().endswith(VALID_IMG_EXTS) for f in os.listdir(folder_path))
-        if not has_image:
-            print(f"   ⚠️ Bo qua {folder_name} (Khong co anh)")
-            continue
-
-        # Tạo tên file Zip
-        prefix = matched_site['prefix']
-        base_zip_name = f"{prefix}.{wp_author}"
-        zip_filename = f"{base_zip_name}.zip"
-        
-        # Xử lý trùng tên (tăng số đếm)
-        counter = 1
-        while os.path.exists(os.path.join(INPUT_ZIP_DIR, zip_filename)):
-            counter += 1
-            zip_filename = f"{base_zip_name}{counter}.zip"
+    # Streaming mode: ktb-user-upload.py tự nén folder thẳng lên VPS, không tạo zip local
+    if config.get('stream_zip_upload', False):
+        print("   ℹ️ 'stream_zip_upload' dang bat -> Bo qua buoc nen local.")
+        return
+    
+    # 3. Quét folder (khớp prefix + có ảnh), tối ưu ảnh (nếu site bật image_optimize) và đặt tên zip
+    metrics = open_metrics(config.get('metrics_file'), 'prepare_zip')
+    folders = find_image_folders(IMAGE_SOURCE_DIR, router)
+    optimize_image_folders(folders, config, metrics)
+    tasks = plan_zip_tasks(folders, config, wp_author)
 
-        output_zip_path_no_ext = os.path.join(INPUT_ZIP_DIR, zip_filename.replace('.zip', ''))
-        
-        try:
-            print(f"   📦 Dang nen: {folder_name} -> {zip_filename}...")
-            shutil.make_archive(output_zip_path_no_ext, 'zip', folder_path)
-            
-            # --- QUAN TRỌNG: Xóa folder gốc sau khi nén thành công ---
-            # Vì tool upload gốc sẽ xóa file zip sau khi up, 
-            # nên ta cần xóa folder gốc ngay tại đây để tránh duplicate lần sau.
-            shutil.rmtree(folder_path) 
-            print(f"      ✅ Da nen & xoa folder goc: {folder_name}")
-            count += 1
-        except Exception as e:
-            print(f"      ❌ Loi nen {folder_name}: {e}")
+    # 4. Nén (song song nếu zip_workers > 1)
+    done_stats = run_zip_tasks(tasks, config, metrics)
 
+    count = len(done_stats)
+    if count:
+        print(f"   📊 Tong: {format_zip_stats(merge_zip_stats(done_stats))}")
+    print(metrics.summary(folders=len(tasks), zips=count))
     print(f"--- [DONE] Da tao {count} file zip moi ---\n")
 
 if __name__ == "__main__":
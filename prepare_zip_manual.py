@@ -1,34 +1,188 @@
 import os
-import json
-import shutil
 import sys
+import json
+from datetime import datetime
 from dotenv import load_dotenv
+from ktb_zip import zip_entries_to_file, format_zip_stats, merge_zip_stats, reserve_zip_filename
+from ktb_image_index import open_image_index, save_zip_hashes, sha256_file
+from ktb_router import load_routing
+from ktb_metrics import open_metrics
+from ktb_image_opt import site_settings, optimize_images
 
 # --- CẤU HÌNH ---
 load_dotenv()
 INPUT_ZIP_DIR = 'InputZip'
 CONFIG_FILE = 'config.json'
 
-# Tên folder cụ thể cần xử lý (nằm ngang hàng với ktbupload)
-TARGET_FOLDER_NAME = 'printiment.chi' 
+# Folder thủ công: mọi folder '<prefix>.<suffix>' nằm ngang hàng với ktbupload (vd: printiment.chi),
+# <prefix> phải là prefix của 1 site trong config.json. Truyền tên folder qua dòng lệnh để chỉ xử lý các folder đó:
+#   python prepare_zip_manual.py printiment.chi ktbtee.chi
 
 # Các đuôi file ảnh hợp lệ
 VALID_IMG_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp')
 
+# --- Đóng gói tăng dần (delta zip) ---
+# Manifest ('manual_manifest_file' trong config.json) ghi lại từng file đã đóng gói:
+#   {folder: {đường dẫn tương đối: {size, mtime, sha256, zip, packaged_at}}}
+# Mỗi lần chạy chỉ nén file mới / đã thay đổi (so size + mtime, khác thì so sha256),
+# nên chạy lại sau khi bị dừng giữa chừng không nén lại những gì đã có trong zip trước.
+# 'manual_delete_after_zip' (mặc định true): xóa ảnh đã đóng gói, kể cả ảnh sót lại từ lần chạy bị dừng.
+MANIFEST_FILE = 'manual_manifest.json'
+
+def load_manifest(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+# Ghi ra file tạm rồi đổi tên -> manifest không bao giờ bị ghi dở
+def save_manifest(path, manifest):
+    part_path = f"{path}.part"
+    with open(part_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(part_path, path)
+
+# [(folder_name, folder_path, route)] các folder thủ công ngang hàng với ktbupload
+def find_manual_folders(parent_dir, router, names=None):
+    result = []
+    for folder_name in sorted(names or os.listdir(parent_dir)):
+        folder_path = os.path.join(parent_dir, folder_name)
+        if not os.path.isdir(folder_path) or '.' not in folder_name.strip('.'):
+            if names:
+                print(f"❌ [LOI] Khong tim thay folder '{folder_name}' ngang hang voi ktbupload.")
+            continue
+        # ktbtee.chi -> prefix là ktbtee
+        prefix = folder_name.split('.')[0]
+        route = router.route_for_prefix(prefix)
+        if not route:
+            if names:
+                print(f"❌ [LOI] Prefix '{prefix}' khong co trong config.json.")
+                print("   Hay dam bao ten folder bat dau bang prefix hop le (vi du: ktbtee.chi).")
+            continue
+        result.append((folder_name, folder_path, route))
+    return result
+
+# File (đường dẫn tương đối) trong folder, bỏ file ẩn (file .part của bước tối ưu ảnh...)
+def list_folder_files(folder_path):
+    files = []
+    for dirpath, dirnames, filenames in os.walk(folder_path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for name in sorted(filenames):
+            if not name.startswith('.'):
+                files.append(os.path.relpath(os.path.join(dirpath, name), folder_path))
+    return files
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, int(stat.st_mtime)
+
+# Chia file trong folder thành (đã đóng gói, mới). File khác size/mtime nhưng trùng sha256
+# với 1 file đã đóng gói (copy lại, đổi tên) cũng tính là đã đóng gói.
+def split_packaged(folder_path, files, entries):
+    packaged_hashes = {entry["sha256"] for entry in entries.values()}
+    packaged, new = [], []
+    for rel_path in files:
+        path = os.path.join(folder_path, rel_path)
+        size, mtime = file_signature(path)
+        entry = entries.get(rel_path)
+        if entry and entry["size"] == size and entry["mtime"] == mtime:
+            packaged.append(rel_path)
+            continue
+        sha256 = sha256_file(path)
+        if sha256 in packaged_hashes:
+            entries[rel_path] = dict(entry or {}, size=size, mtime=mtime, sha256=sha256)
+            packaged.append(rel_path)
+        else:
+            new.append(rel_path)
+    return packaged, new
+
+def mark_packaged(folder_path, entries, rel_paths, zip_filename):
+    packaged_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    for rel_path in rel_paths:
+        path = os.path.join(folder_path, rel_path)
+        size, mtime = file_signature(path)
+        entries[rel_path] = {"size": size, "mtime": mtime, "sha256": sha256_file(path),
+                             "zip": zip_filename, "packaged_at": packaged_at}
+
+# Đóng gói các file mới của 1 folder thành 1 delta zip. Trả về stats của zip (None nếu không tạo zip).
+def package_folder(folder_name, folder_path, route, config, manifest, manifest_path, wp_author,
+                   image_index, reserved_names, metrics):
+    prefix = route['prefix']
+    entries = manifest.setdefault(folder_name, {})
+    print(f"\n--- [MANUAL PREPARE] Xu ly folder: {folder_name} ---")
+    print(f"📂 Duong dan tuyet doi: {folder_path}")
+
+    # 1. Tìm file mới (chưa có trong manifest)
+    with metrics.phase("manifest", job=folder_name):
+        packaged, new_files = split_packaged(folder_path, list_folder_files(folder_path), entries)
+    new_images = [f for f in new_files if f.lower().endswith(VALID_IMG_EXTS)]
+    print(f"✅ {len(new_images)} anh moi, {len(packaged)} file da dong goi truoc do.")
+
+    stats = None
+    if new_images:
+        # 2. Tối ưu ảnh mới (nếu site bật image_optimize); đổi định dạng thì tên file đổi
+        settings = site_settings(config, route['site'])
+        if settings:
+            optimized = optimize_images([(os.path.join(folder_path, f), settings) for f in new_images], config, metrics)
+            if optimized:
+                renamed = {old: os.path.relpath(path, folder_path) for old, path in zip(new_images, optimized["paths"])}
+                new_files = [renamed.get(f, f) for f in new_files]
+                new_images = [renamed[f] for f in new_images]
+
+        # 3. Nén file mới thành delta zip (ảnh đã nén sẵn -> STORE, xem ktb_zip.py).
+        # Ảnh đã upload trước đó cho prefix này (theo image_index_db) bị bỏ khỏi zip.
+        zip_filename = reserve_zip_filename(f"{prefix}.{wp_author}", reserved_names, INPUT_ZIP_DIR)
+        output_zip_path = os.path.join(INPUT_ZIP_DIR, zip_filename)
+        print(f"📦 Dang nen {len(new_files)} file moi thanh: {zip_filename}...")
+        try:
+            stats = zip_entries_to_file([(os.path.join(folder_path, f), f) for f in new_files], output_zip_path,
+                                        config.get('zip_store_exts'), image_index, prefix)
+        except Exception as e:
+            print(f"❌ Gặp lỗi trong quá trình nén: {e}")
+            metrics.zip(folder_name, zip_filename, None, str(e))
+            return None
+        metrics.zip(folder_name, zip_filename, stats)
+        print("✅ Nen thanh cong.")
+        print(f"   {format_zip_stats(stats)}")
+
+        if image_index is not None:
+            if stats["image_files"] == 0:
+                os.remove(output_zip_path)
+                print(f"⏭️ Ca {stats['duplicates']} anh da upload truoc do -> Khong tao zip.")
+                zip_filename, stats = None, None
+            else:
+                save_zip_hashes(output_zip_path, prefix, stats["images"])
+
+        # 4. Ghi manifest ngay khi zip đã nằm trong InputZip
+        mark_packaged(folder_path, entries, new_files, zip_filename)
+        save_manifest(manifest_path, manifest)
+        packaged += new_files
+        if zip_filename:
+            print(f"👉 File zip da san sang tai: {INPUT_ZIP_DIR}/{zip_filename}")
+
+    # 5. Chỉ xóa file ảnh đã đóng gói, KHÔNG xóa folder
+    if config.get('manual_delete_after_zip', True):
+        deleted_count = 0
+        with metrics.phase("cleanup", job=folder_name):
+            for rel_path in packaged:
+                if not rel_path.lower().endswith(VALID_IMG_EXTS):
+                    continue
+                try:
+                    os.remove(os.path.join(folder_path, rel_path))
+                    deleted_count += 1
+                except Exception as del_err:
+                    print(f"   ⚠️ Khong xoa duoc {rel_path}: {del_err}")
+        if deleted_count:
+            print(f"🧹 Da xoa {deleted_count} file anh da dong goi khoi folder '{folder_name}'.")
+        print(f"📁 Folder '{folder_name}' van duoc giu nguyen.")
+    return stats
+
 def main():
     # 1. Xác định đường dẫn
     current_dir = os.path.dirname(os.path.abspath(__file__)) # Folder ktbupload
     parent_dir = os.path.dirname(current_dir)                # Folder cha chung
-    target_folder_path = os.path.join(parent_dir, TARGET_FOLDER_NAME)
-
-    print(f"--- [MANUAL PREPARE] Xu ly folder: {TARGET_FOLDER_NAME} ---")
-    print(f"📂 Duong dan tuyet doi: {target_folder_path}")
 
-    # 2. Kiểm tra folder tồn tại
-    if not os.path.exists(target_folder_path):
-        print(f"❌ [LOI] Khong tim thay folder '{TARGET_FOLDER_NAME}' ngang hang voi ktbupload.")
-        return
-    
     if not os.path.exists(INPUT_ZIP_DIR):
         os.makedirs(INPUT_ZIP_DIR)
 
@@ -36,73 +190,40 @@ def main():
         print(f"[LOI] Khong tim thay {CONFIG_FILE}")
         return
 
-    # 3. Kiểm tra xem trong đó có ảnh không
-    files_in_folder = os.listdir(target_folder_path)
-    image_files = [f for f in files_in_folder if f.lower().endswith(VALID_IMG_EXTS)]
-    
-    if not image_files:
-        print("⚠️  Khong tim thay file anh nao trong folder nay -> Dung lai.")
-        return
-
-    print(f"✅ Tim thay {len(image_files)} file anh.")
-
-    # 4. Đọc Config để lấy Author (dùng cho tên zip)
+    # 2. Đọc Config để lấy Author (dùng cho tên zip)
     try:
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = json.load(f)
+        config, router = load_routing(CONFIG_FILE)
         wp_author = config.get('default_user_author', 'manual')
-        sites = config.get('sites', [])
     except Exception as e:
         print(f"[LOI] Doc config that bai: {e}")
         return
 
-    # 5. Xác định Prefix từ tên folder (ktbtee.chi -> prefix là ktbtee)
-    # Logic: Lấy phần đầu trước dấu chấm làm prefix
-    prefix_candidate = TARGET_FOLDER_NAME.split('.')[0] 
-    
-    # Kiểm tra prefix này có trong config không
-    matched_site = next((site for site in sites if site['prefix'] == prefix_candidate), None)
-    
-    if not matched_site:
-        print(f"❌ [LOI] Prefix '{prefix_candidate}' khong co trong config.json.")
-        print("   Hay dam bao ten folder bat dau bang prefix hop le (vi du: ktbtee.chi).")
+    # 3. Tìm các folder '<prefix>.<suffix>'
+    folders = find_manual_folders(parent_dir, router, sys.argv[1:])
+    if not folders:
+        print("⚠️  Khong tim thay folder thu cong nao (<prefix>.<suffix>) -> Dung lai.")
         return
 
-    # 6. Tạo tên file Zip
-    base_zip_name = f"{prefix_candidate}.{wp_author}"
-    zip_filename = f"{base_zip_name}.zip"
-    
-    # Xử lý trùng tên (tăng số đếm)
-    counter = 1
-    while os.path.exists(os.path.join(INPUT_ZIP_DIR, zip_filename)):
-        counter += 1
-        zip_filename = f"{base_zip_name}{counter}.zip"
-
-    output_zip_path_no_ext = os.path.join(INPUT_ZIP_DIR, zip_filename.replace('.zip', ''))
-
-    # 7. Thực hiện Nén & Xóa file
+    # 4. Đóng gói phần mới của từng folder
+    manifest_path = config.get('manual_manifest_file') or MANIFEST_FILE
+    manifest = load_manifest(manifest_path)
+    reserved_names = set()
+    image_index = None
+    metrics = open_metrics(config.get('metrics_file'), 'prepare_zip_manual')
+    done_stats = []
     try:
-        print(f"📦 Dang nen thanh: {zip_filename}...")
-        shutil.make_archive(output_zip_path_no_ext, 'zip', target_folder_path)
-        print("✅ Nen thanh cong.")
-
-        # --- QUAN TRỌNG: Chỉ xóa file ảnh, KHÔNG xóa folder ---
-        print("🧹 Dang don dep cac file anh da nen...")
-        deleted_count = 0
-        for img_file in image_files:
-            file_path = os.path.join(target_folder_path, img_file)
-            try:
-                os.remove(file_path)
-                deleted_count += 1
-            except Exception as del_err:
-                print(f"   ⚠️ Khong xoa duoc {img_file}: {del_err}")
-
-        print(f"✅ Da xoa {deleted_count} file anh khoi folder '{TARGET_FOLDER_NAME}'.")
-        print(f"📁 Folder '{TARGET_FOLDER_NAME}' van duoc giu nguyen.")
-        print(f"👉 File zip da san sang tai: {INPUT_ZIP_DIR}/{zip_filename}")
-
-    except Exception as e:
-        print(f"❌ Gặp lỗi trong quá trình nén/xóa: {e}")
+        image_index = open_image_index(config.get('image_index_db'))
+        for folder_name, folder_path, route in folders:
+            stats = package_folder(folder_name, folder_path, route, config, manifest, manifest_path, wp_author,
+                                   image_index, reserved_names, metrics)
+            if stats:
+                done_stats.append(stats)
+    finally:
+        if image_index is not None:
+            image_index.close()
+        if done_stats:
+            print(f"\n📊 Tong: {len(done_stats)} zip moi, {format_zip_stats(merge_zip_stats(done_stats))}")
+        print(metrics.summary(folders=len(folders), zips=len(done_stats)))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
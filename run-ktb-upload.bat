@@ -10,7 +10,7 @@ echo --- Bat dau quy trinh KTB Upload ---
 echo.
 echo Dang chay tu thu muc: %cd%
 echo.
-python ktb-admin-upload.py
+python ktb.py admin-upload
 
 echo.
 echo --- Qua trinh hoan tat. ---
@@ -10,7 +10,7 @@ echo --- Bat dau quy trinh Upload cho User ---
 echo.
 echo Dang chay tu thu muc: %cd%
 echo.
-python ktb-user-upload.py
+python ktb.py upload
 
 echo.
 echo --- Qua trinh hoan tat. ---
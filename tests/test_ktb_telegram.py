@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ktb_telegram
+from ktb_telegram import TelegramNotifier, split_message, summarize_report
+
+# Kiểm thử ktb_telegram với server HTTP giả lập (TELEGRAM_API_BASE), không gọi Telegram thật:
+#   python -m unittest discover -s tests
+
+class FakeTelegram(BaseHTTPRequestHandler):
+    # Mã trả về cho các request đầu tiên, sau đó luôn 200
+    statuses = []
+    received = []    # text của các tin được trả 200
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status == 429:
+            payload = {"ok": False, "error_code": 429, "parameters": {"retry_after": 3}}
+        elif status == 200:
+            self.received.append(body['text'])
+            payload = {"ok": True}
+        else:
+            payload = {"ok": False, "error_code": status}
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class SplitMessageTest(unittest.TestCase):
+    def test_short_text_is_one_part(self):
+        self.assertEqual(split_message("a\nb\n", limit=10), ["a\nb\n"])
+
+    def test_cuts_at_line_start(self):
+        text = "".join(f"line {i}\n" for i in range(10))
+        parts = split_message(text, limit=20)
+        self.assertEqual("".join(parts), text)
+        for part in parts:
+            self.assertLessEqual(len(part), 20)
+            self.assertTrue(part.endswith("\n"))
+
+    def test_long_line_is_hard_split(self):
+        parts = split_message("x" * 25, limit=10)
+        self.assertEqual(parts, ["x" * 10, "x" * 10, "x" * 5])
+
+    def test_blank_parts_are_dropped(self):
+        self.assertEqual(split_message("\n\n\n", limit=10), [])
+
+class SummarizeReportTest(unittest.TestCase):
+    def test_short_report_unchanged(self):
+        text = "header\n[OK] a.zip\n[LOI] b.zip (x)"
+        self.assertEqual(summarize_report(text, limit=100, max_parts=2), text)
+
+    def test_ok_lines_collapsed_errors_kept(self):
+        lines = ["header"] + [f"[OK] file_{i}.zip -> host" for i in range(50)] + ["[LOI] bad.zip (loi)", "footer"]
+        summary = summarize_report("\n".join(lines), limit=100, max_parts=2)
+        self.assertEqual(summary.splitlines(), [
+            "header",
+            "[OK] 50 file (an chi tiet do bao cao qua dai)",
+            "[LOI] bad.zip (loi)",
+            "footer",
+        ])
+
+class NotifierRetryTest(unittest.TestCase):
+    def setUp(self):
+        FakeTelegram.statuses = [429, 500]
+        FakeTelegram.received = []
+        self.server = HTTPServer(("127.0.0.1", 0), FakeTelegram)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.env = mock.patch.dict(os.environ, {"TELEGRAM_API_BASE": base})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_close_delivers_every_part_after_429_and_500(self):
+        text = "".join(f"[LOI] file_{i}.zip (Upload failed: timeout)\n" for i in range(300))
+        parts = split_message(summarize_report(text))
+        self.assertGreater(len(parts), 1)
+
+        with mock.patch.object(ktb_telegram.time, 'sleep') as sleep:
+            notifier = TelegramNotifier("token", "chat")
+            notifier.send(text)
+            notifier.close(timeout=30)
+
+        self.assertFalse(notifier.thread.is_alive())
+        self.assertEqual(FakeTelegram.received, parts)
+        # 429: chờ đúng retry_after (3s), 500: backoff gấp đôi
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [3, 6])
+
+if __name__ == "__main__":
+    unittest.main()